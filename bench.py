@@ -0,0 +1,500 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Benchmark
+
+## Overview
+Starts the server core in this process on localhost, with a fresh storage directory, and lets a number of simulated
+clients hammer it over the real protocol (login, `hello`, `mux`, then `MuxClient` requests), without any GUI.
+
+- **Mix**: how often each operation is picked, e.g. `--mix upload=30,download=40,list=20,delete=10`.
+- **Sizes**: the distribution uploaded file sizes are drawn from, e.g. `--sizes 4k=60,256k=30,8m=10`.
+- **Catalog**: how many files are uploaded before the clock starts, so `list` and the metadata have something to chew on.
+
+At the end it prints ops/s, MB/s and latency percentiles per operation, the peak RSS of the process (server and
+clients together), and the server's own metrics (its `stats` command). `--json` saves all of it, and `--baseline`
+compares a run against such a file and fails if throughput dropped or p95 latency rose by more than `--tolerance`.
+
+## How to Run
+`python bench.py --clients 16 --duration 20 --catalog 2000 --json baseline.json`, then after a change
+`python bench.py --clients 16 --duration 20 --catalog 2000 --baseline baseline.json`.
+
+## Notes
+- Uploaded content is random, so it neither compresses nor deduplicates, unless `--content text` is used.
+- Numbers only compare between runs on the same machine with the same options.
+"""
+
+
+import argparse
+import hashlib
+import io
+import json
+import os
+import random
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+import compression
+import framing
+from metrics import Metrics, PERCENTILES
+from mux import MuxClient
+from server_core import METADATA_BACKENDS, StorageServer
+
+
+OPERATIONS = ("upload", "download", "list", "delete")
+
+DEFAULT_MIX = "upload=30,download=40,list=20,delete=10"
+DEFAULT_SIZES = "4k=60,256k=30,4m=10"
+
+LIST_PAGE_SIZE = 500
+
+# different contents generated per size, every upload picks one of them
+PAYLOADS_PER_SIZE = 4
+
+UNITS = {"": 1, "k": 1024, "m": 1024 ** 2, "g": 1024 ** 3}
+
+TEXT_LINE = b"2024-01-01 12:00:00 INFO request served in 12 ms, status 200, bytes 4096\n"
+
+
+def parse_size(text):
+    text = text.strip().lower().removesuffix("b")
+    unit = text[-1:] if text[-1:] in UNITS else ""
+    try:
+        return int(float(text[:len(text) - len(unit)]) * UNITS[unit])
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"not a size: {text}") from None
+
+
+def parse_weights(text, parse_key=str):
+    """
+    - `"a=3,b=1"` -> `[(a, 3.0), (b, 1.0)]`.
+    """
+    weights = []
+    for item in text.split(","):
+        key, _, weight = item.partition("=")
+        try:
+            weights.append((parse_key(key.strip()), float(weight or 1)))
+        except ValueError:
+            raise argparse.ArgumentTypeError(f"bad weight in {item}") from None
+    if sum(weight for _, weight in weights) <= 0:
+        raise argparse.ArgumentTypeError(f"no positive weights in {text}")
+    return weights
+
+
+def parse_mix(text):
+    mix = parse_weights(text)
+    for operation, _ in mix:
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError(f"unknown operation {operation}, pick from {', '.join(OPERATIONS)}")
+    return mix
+
+
+def parse_sizes(text):
+    return parse_weights(text, parse_size)
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, kilobytes everywhere else
+    return peak / 1024 ** 2 if sys.platform == "darwin" else peak / 1024
+
+
+class Payload:
+    def __init__(self, data):
+        self.data = data
+        self.size = len(data)
+        self.sha256 = hashlib.sha256(data).hexdigest()
+
+
+def make_payloads(sizes, content, rng):
+    """
+    - Contents are generated up front, so the clients spend their time on the protocol and not on `randbytes`.
+    """
+    payloads = {}
+    for size, _ in sizes:
+        if content == "text":
+            text = TEXT_LINE * (size // len(TEXT_LINE) + 1)
+            # a different first byte each, so they don't deduplicate either
+            payloads[size] = [Payload(bytes([65 + i]) + text[1:size]) if size else Payload(b"")
+                              for i in range(PAYLOADS_PER_SIZE)]
+        else:
+            payloads[size] = [Payload(rng.randbytes(size)) for _ in range(PAYLOADS_PER_SIZE)]
+    return payloads
+
+
+class Discard:
+    """
+    - A file that forgets what is written into it, downloads are only timed.
+    """
+
+    def write(self, data):
+        return len(data)
+
+
+class Catalog:
+    """
+    - The files the clients know are on the server, shared by all of them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.files = []
+
+    def add(self, owner, name):
+        with self.lock:
+            self.files.append((owner, name))
+
+    def pick(self, rng):
+        with self.lock:
+            return rng.choice(self.files) if self.files else None
+
+    def take(self, owner, rng):
+        """
+        - Remove and return one of `owner`'s files (only the owner may delete it), or `None`.
+        """
+        with self.lock:
+            own = [i for i, (file_owner, _) in enumerate(self.files) if file_owner == owner]
+            if not own:
+                return None
+            i = rng.choice(own)
+            self.files[i], self.files[-1] = self.files[-1], self.files[i]
+            return self.files.pop()[1]
+
+
+class BenchClient:
+    """
+    - One simulated client with its own connection and name.
+    - Every operation returns `(bytes moved, error)`, `run` keeps `(operation, seconds, bytes, error)` of each.
+    """
+
+    def __init__(self, server_address, username, codecs, sizes, payloads, catalog, seed):
+        self.username = username
+        self.sizes = [size for size, _ in sizes]
+        self.size_weights = [weight for _, weight in sizes]
+        self.payloads = payloads
+        self.catalog = catalog
+        self.rng = random.Random(seed)
+        self.results = []
+        self.uploaded = 0
+
+        self.sock = socket.create_connection(server_address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock.sendall(username.encode())
+        reply = self.sock.recv(1024).decode()
+        if reply != "CONNECTED":
+            self.sock.close()
+            raise ConnectionError(reply or "Server closed the connection.")
+        framing.send_frame(self.sock, {"type": "hello", "codecs": codecs})
+        codec = framing.recv_frame(self.sock).get("codec")
+        framing.send_frame(self.sock, {"type": "mux"})
+        framing.recv_frame(self.sock)
+        self.mux = MuxClient(self.sock, codec=codec)
+
+    def close(self):
+        self.mux.close()
+
+    def run(self, operation):
+        start = time.perf_counter()
+        try:
+            moved, error = getattr(self, operation)()
+        except Exception:
+            moved, error = 0, True
+        self.results.append((operation, time.perf_counter() - start, moved, error))
+
+    def upload(self, size=None):
+        if size is None:
+            size = self.rng.choices(self.sizes, self.size_weights)[0]
+        payload = self.rng.choice(self.payloads[size])
+        self.uploaded += 1
+        name = f"bench_{self.uploaded}.bin"
+
+        command = {"type": "upload_stream", "filename": name, "size": size, "sha256": payload.sha256}
+        with self.mux.request(command) as request:
+            response = request.recv()
+            if response.get("status") == "READY":
+                request.send_file(io.BytesIO(payload.data), size)
+                response = request.recv()
+        stored = response.get("status") in ("UPLOAD_SUCCESS", "UPLOAD_SKIPPED")
+        if stored:
+            self.catalog.add(self.username, name)
+        return size, not stored
+
+    def download(self):
+        picked = self.catalog.pick(self.rng)
+        if picked is None:
+            return 0, False
+        owner, name = picked
+        with self.mux.request({"type": "download_stream", "filename": name, "owner": owner}) as request:
+            response = request.recv()
+            if response.get("status") != "SUCCESS":
+                # deleted by its owner in the meantime, still a full round trip
+                return 0, False
+            request.recv_to_file(response["size"], Discard())
+        return response["size"], False
+
+    def list(self):
+        with self.mux.request({"type": "list", "page_size": LIST_PAGE_SIZE}) as request:
+            while True:
+                page = request.recv()
+                if page.get("status") != "PAGE":
+                    return 0, True
+                if page["last"]:
+                    return 0, False
+
+    def delete(self):
+        name = self.catalog.take(self.username, self.rng)
+        if name is None:
+            return 0, False
+        response = self.mux.call({"type": "delete", "filename": name})
+        return 0, response.get("status") == "ERROR"
+
+
+def start_server(args, directory):
+    """
+    - Runs the server on its own thread, on a free port, and returns it with the address it listens on.
+    """
+    files_dir = os.path.join(directory, "files")
+    os.mkdir(files_dir)
+    metadata_file = os.path.join(directory, METADATA_BACKENDS[args.metadata_backend][1])
+    server = StorageServer(
+        files_dir, 0, host="127.0.0.1", metadata_file=metadata_file,
+        log=print if args.verbose else (lambda message: None),
+        max_connections=args.clients + 16, io_workers=args.io_workers, metadata_backend=args.metadata_backend,
+        dedup=args.dedup, compress_at_rest=args.compress_at_rest, cache_bytes=int(args.cache_mb * 1024 * 1024),
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+
+    deadline = time.monotonic() + 10
+    while not server.running:
+        if time.monotonic() > deadline or not thread.is_alive():
+            raise RuntimeError("Server did not start.")
+        time.sleep(0.01)
+    return server, thread, server.server.sockets[0].getsockname()[:2]
+
+
+def run_threads(clients, work):
+    threads = [threading.Thread(target=work, args=(client,)) for client in clients]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+
+def seed_catalog(clients, count, size):
+    """
+    - Upload `count` files of `size` bytes, spread over all clients.
+    """
+    shares = {client: count // len(clients) + (i < count % len(clients)) for i, client in enumerate(clients)}
+
+    def work(client):
+        for _ in range(shares[client]):
+            client.upload(size)
+
+    run_threads(clients, work)
+
+
+def run_load(clients, mix, duration, ops):
+    """
+    - Every client keeps picking an operation from `mix` until `duration` seconds passed or it did `ops` of them.
+    - Returns the wall time it took.
+    """
+    operations = [operation for operation, _ in mix]
+    weights = [weight for _, weight in mix]
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+
+    def work(client):
+        done = 0
+        while (not ops or done < ops) and (deadline is None or time.perf_counter() < deadline):
+            client.run(client.rng.choices(operations, weights)[0])
+            done += 1
+
+    run_threads(clients, work)
+    return time.perf_counter() - start
+
+
+def summarize(clients, elapsed):
+    metrics = Metrics()
+    for client in clients:
+        for operation, seconds, moved, error in client.results:
+            metrics.record(operation, seconds, moved if operation == "upload" else 0,
+                           moved if operation == "download" else 0, error)
+
+    operations = {}
+    total_count = total_bytes = total_errors = 0
+    for name, stats in metrics.snapshot()["commands"].items():
+        moved = stats["bytes_in"] + stats["bytes_out"]
+        operations[name] = {
+            "count": stats["count"],
+            "errors": stats["errors"],
+            "ops_per_s": stats["count"] / elapsed,
+            "mb_per_s": moved / elapsed / 1e6,
+            "mean": stats["mean"],
+            **{f"p{p}": stats[f"p{p}"] for p in PERCENTILES},
+            "max": stats["max"],
+        }
+        total_count += stats["count"]
+        total_errors += stats["errors"]
+        total_bytes += moved
+
+    return {
+        "elapsed": elapsed,
+        "ops": total_count,
+        "errors": total_errors,
+        "ops_per_s": total_count / elapsed,
+        "mb_per_s": total_bytes / elapsed / 1e6,
+        "operations": operations,
+    }
+
+
+def format_report(report):
+    lines = [
+        f"{report['ops']} operations in {report['elapsed']:.1f}s: {report['ops_per_s']:.1f} ops/s, "
+        f"{report['mb_per_s']:.1f} MB/s, {report['errors']} errors, peak RSS "
+        + (f"{report['peak_rss_mb']:.0f} MB" if report["peak_rss_mb"] is not None else "unknown"),
+        f"{'operation':<12}{'count':>8}{'errors':>7}{'ops/s':>9}{'MB/s':>8}"
+        + "".join(f"{f'p{p} ms':>9}" for p in PERCENTILES) + f"{'max ms':>9}",
+    ]
+    for name, stats in report["operations"].items():
+        lines.append(
+            f"{name:<12}{stats['count']:>8}{stats['errors']:>7}{stats['ops_per_s']:>9.1f}{stats['mb_per_s']:>8.1f}"
+            + "".join(f"{stats[f'p{p}'] * 1000:>9.2f}" for p in PERCENTILES) + f"{stats['max'] * 1000:>9.2f}"
+        )
+    return "\n".join(lines)
+
+
+def compare(report, baseline, tolerance):
+    """
+    - Lines describing how `report` differs from `baseline`, and whether anything got worse than `tolerance` allows.
+    """
+    lines, regressed = [], False
+
+    def check(label, old, new, higher_is_better):
+        nonlocal regressed
+        if not old:
+            return
+        change = (new - old) / old
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > tolerance:
+            flag = "  <-- REGRESSION"
+            regressed = True
+        lines.append(f"{label:<24}{old:>12.3f}{new:>12.3f}{change:>+9.1%}{flag}")
+
+    lines.append(f"{'':<24}{'baseline':>12}{'now':>12}{'change':>9}")
+    check("ops/s", baseline["ops_per_s"], report["ops_per_s"], True)
+    check("MB/s", baseline["mb_per_s"], report["mb_per_s"], True)
+    for name, stats in report["operations"].items():
+        old = baseline["operations"].get(name)
+        if old:
+            check(f"{name} ops/s", old["ops_per_s"], stats["ops_per_s"], True)
+            check(f"{name} p95 ms", old["p95"] * 1000, stats["p95"] * 1000, False)
+    return lines, regressed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test the Cloud File SUtorage server over its real protocol.")
+    parser.add_argument("--clients", type=int, default=8, help="simulated clients, each with its own connection")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run (0: until every client did --ops)")
+    parser.add_argument("--ops", type=int, default=0, help="operations per client (0: no limit)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help=f"weights of the operations (default: {DEFAULT_MIX})")
+    parser.add_argument("--sizes", type=parse_sizes, default=parse_sizes(DEFAULT_SIZES),
+                        help=f"weights of the uploaded file sizes (default: {DEFAULT_SIZES})")
+    parser.add_argument("--catalog", type=int, default=1000, help="files uploaded before the clock starts")
+    parser.add_argument("--catalog-size", type=parse_size, default=4096, help="size of those files")
+    parser.add_argument("--content", choices=("random", "text"), default="random",
+                        help="random: incompressible, text: repetitive log lines")
+    parser.add_argument("--codecs", default="", help="compression codecs the clients offer, e.g. zlib (default: none)")
+    parser.add_argument("--metadata-backend", choices=sorted(METADATA_BACKENDS), default="journal")
+    parser.add_argument("--dedup", action="store_true", help="run the server with content-addressed storage")
+    parser.add_argument("--compress-at-rest", choices=compression.CODECS, default=None)
+    parser.add_argument("--io-workers", type=int, default=8)
+    parser.add_argument("--cache-mb", type=float, default=0, help="run the server with a small-file cache this big")
+    parser.add_argument("--seed", type=int, default=408, help="makes the operation sequence repeatable")
+    parser.add_argument("--json", default=None, help="save the results (a baseline) to this file")
+    parser.add_argument("--baseline", default=None, help="compare against a saved baseline, exit 1 if it got worse")
+    parser.add_argument("--tolerance", type=float, default=0.10,
+                        help="how much worse than the baseline still passes (default: 0.10 = 10%%)")
+    parser.add_argument("--keep", action="store_true", help="keep the storage directory")
+    parser.add_argument("--verbose", action="store_true", help="print the server's log")
+    args = parser.parse_args()
+
+    if args.clients < 1 or (not args.duration and not args.ops):
+        parser.error("need at least one client, and a --duration or --ops")
+    codecs = [codec for codec in args.codecs.split(",") if codec]
+    rng = random.Random(args.seed)
+    sizes = args.sizes + [(args.catalog_size, 0)]
+    payloads = make_payloads(sizes, args.content, rng)
+
+    directory = tempfile.mkdtemp(prefix="sutorage-bench-")
+    server, thread, address = start_server(args, directory)
+    clients = []
+    try:
+        catalog = Catalog()
+        clients = [
+            BenchClient(address, f"bench{i}", codecs, args.sizes, payloads, catalog, rng.random())
+            for i in range(args.clients)
+        ]
+        if args.catalog:
+            print(f"Uploading {args.catalog} files for the catalog...")
+            seed_catalog(clients, args.catalog, args.catalog_size)
+
+        print(f"Running {args.clients} clients...")
+        elapsed = run_load(clients, args.mix, args.duration, args.ops)
+        report = summarize(clients, elapsed)
+        report["peak_rss_mb"] = peak_rss_mb()
+        report["server"] = clients[0].mux.call({"type": "stats"}).get("stats")
+        report["config"] = {
+            "clients": args.clients, "duration": args.duration, "ops": args.ops,
+            "mix": dict(args.mix), "sizes": {str(size): weight for size, weight in args.sizes}, "catalog": args.catalog,
+            "catalog_size": args.catalog_size, "content": args.content, "codecs": codecs,
+            "metadata_backend": args.metadata_backend, "dedup": args.dedup,
+            "compress_at_rest": args.compress_at_rest, "io_workers": args.io_workers, "cache_mb": args.cache_mb,
+            "seed": args.seed,
+        }
+    finally:
+        for client in clients:
+            client.close()
+        server.stop()
+        thread.join()
+        if args.keep:
+            print(f"Storage kept in {directory}")
+        else:
+            shutil.rmtree(directory, ignore_errors=True)
+
+    print(format_report(report))
+
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(report, f, indent=2)
+        print(f"Saved to {args.json}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline.get("config") != report["config"]:
+            print("Note: the baseline was run with different options.")
+        lines, regressed = compare(report, baseline, args.tolerance)
+        print("\n".join(lines))
+        if regressed:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -21,10 +21,16 @@ The application supports the following functionality:
 - **Download File**: Allows the user to download a file from the server by specifying the filename and owner.
 - **Delete File**: Allows the user to delete a file on the server.
 
-The program uses multi-threading for handling incoming notifications from the server while the user interacts with the GUI. This ensures that the client remains responsive and can handle server messages without freezing.
+The GUI only asks for paths and names, the work itself is done by a `StorageClient` (see `storage_client.py`), which can also be used without any GUI, e.g. from its command line to sync whole directory trees.
+
+Right after connecting, the client switches the connection to multiplexed frames (see `mux.py`). A single reader thread routes every frame to the request waiting for it, and messages the server sends on its own (e.g. that someone downloaded one of your files, see `events.py`) are logged as notifications, so nothing else ever reads the socket. Before that, it offers the server the compression codecs it knows (`hello`), and file data that compresses well is then sent and received compressed chunk by chunk.
+
+Nothing slow runs on the Tk main thread: transfers are queued on a small thread pool (`MAX_TRANSFERS` run at once), listing and deleting run on another one, so the window stays responsive while a big file moves. Each running transfer shows its progress, speed and time left below the buttons. Worker threads never touch a widget themselves, they queue their updates (and log messages) for the main thread, which picks them up every `UI_POLL_MS` milliseconds.
+
+If the connection drops, the client logs in again by itself (with growing pauses between attempts, see `session_pool.py`) and retries what is safe to repeat; TCP keepalive makes sure a connection that died silently is noticed.
 
 ## How to Run:
-1. Make sure you have Python installed along with the required libraries: `socket`, `tkinter`, `pickle`, `os`, and `time`.
+1. Make sure you have Python installed along with the required libraries: `socket`, `tkinter`, `os`, and `time`.
 2. Run the script.
 3. The GUI will appear. Enter the server's IP address, port, and your desired username to connect to the server.
 4. Once connected, you can upload, list, download, and delete files from the server.
@@ -46,13 +52,80 @@ Local Host is 127.0.0.1
 """
 
 
-import socket
-import threading
 import tkinter as tk
 from tkinter import filedialog, messagebox
-import pickle
+import itertools
 import os
+import queue
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor
+
+from storage_client import LIST_PAGE_SIZE, LoginError, StorageClient
+
+
+# transfers running at once, later ones wait in the pool's queue
+MAX_TRANSFERS = 3
+
+# how often the main thread applies the updates worker threads queued for it
+UI_POLL_MS = 50
+
+# a transfer's progress line is refreshed at most this often (seconds)
+REPORT_INTERVAL = 0.5
+
+
+def format_size(size):
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size:.0f} {unit}" if unit == "B" else f"{size:.1f} {unit}"
+        size /= 1024
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes}:{seconds:02}"
+
+
+class ProgressMeter:
+    """
+    - The `progress(moved, total)` callback of one transfer, adds up the bytes from any thread.
+    - Hands a status line (done, percentage, MB/s, time left) to `show` at most every `REPORT_INTERVAL` seconds.
+    """
+
+    def __init__(self, label, show):
+        self.label = label
+        self.show = show
+        self.lock = threading.Lock()
+        self.done = 0
+        self.total = None
+        self.start = time.perf_counter()
+        self.last_report = 0.0
+
+    def __call__(self, moved, total):
+        with self.lock:
+            self.done += moved
+            self.total = total
+            now = time.perf_counter()
+            if now - self.last_report < REPORT_INTERVAL:
+                return
+            self.last_report = now
+            text = self.describe(now)
+        self.show(text)
+
+    def describe(self, now):
+        rate = self.done / max(now - self.start, 1e-6)
+        text = f"{self.label}: {format_size(self.done)}"
+        if self.total:
+            text += f" of {format_size(self.total)} ({100 * self.done / self.total:.0f}%)"
+        text += f", {format_size(rate)}/s"
+        if self.total and rate > 0:
+            text += f", {format_duration((self.total - self.done) / rate)} left"
+        return text
+
+    def summary(self):
+        elapsed = time.perf_counter() - self.start
+        return f"{format_size(self.done)} in {elapsed:.1f}s ({format_size(self.done / max(elapsed, 1e-6))}/s)"
 
 
 class ClientGUI:
@@ -88,6 +161,10 @@ class ClientGUI:
         )
         self.hint_label.grid(row=2, column=0, columnspan=2, padx=10, pady=(0, 10), sticky="w")
 
+        # one line per running (or queued) transfer
+        self.transfer_label = tk.Label(self.root, text="", fg="blue", justify="left", anchor="w")
+        self.transfer_label.grid(row=3, column=0, columnspan=2, padx=10, pady=(0, 10), sticky="w")
+
         # Add buttons
         self.button_frame = tk.Frame(self.root)
         self.button_frame.grid(row=1, column=0, columnspan=2, pady=10, sticky="ew")
@@ -108,14 +185,74 @@ class ClientGUI:
         self.delete_button = tk.Button(self.button_frame, text="Delete File", command=self.delete_file, state=tk.DISABLED)
         self.delete_button.grid(row=0, column=4, padx=5)
 
-        self.client_socket = None
+        # every request goes through this once connected, see `storage_client.py`
+        self.client = None
         self.username = None
 
+        # the slow work happens on these, see the overview
+        self.transfer_pool = ThreadPoolExecutor(max_workers=MAX_TRANSFERS, thread_name_prefix="transfer")
+        self.request_pool = ThreadPoolExecutor(max_workers=2, thread_name_prefix="request")
+        # (function, args) that worker threads want run on the main thread
+        self.ui_calls = queue.SimpleQueue()
+        # transfer id -> its progress line
+        self.transfers = {}
+        self.transfer_ids = itertools.count()
+
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.root.after(UI_POLL_MS, self.apply_ui_calls)
+
+    # Tk widgets may only be touched from the main thread, everyone else goes through here
+    def in_gui(self, function, *args):
+        self.ui_calls.put((function, args))
+
+    def apply_ui_calls(self):
+        while True:
+            try:
+                function, args = self.ui_calls.get_nowait()
+            except queue.Empty:
+                break
+            function(*args)
+        self.root.after(UI_POLL_MS, self.apply_ui_calls)
+
+    # `work(progress)` runs on the transfer pool, while its progress line is shown below the buttons
+    def start_transfer(self, label, work):
+        transfer_id = next(self.transfer_ids)
+        meter = ProgressMeter(label, lambda text: self.in_gui(self.show_transfer, transfer_id, text))
+        self.show_transfer(transfer_id, f"{label}: waiting for a free slot...")
+
+        def run():
+            meter.start = time.perf_counter()
+            try:
+                work(meter)
+            finally:
+                self.in_gui(self.show_transfer, transfer_id, None)
+
+        self.transfer_pool.submit(run)
+
+    def show_transfer(self, transfer_id, text):
+        if text is None:
+            self.transfers.pop(transfer_id, None)
+        else:
+            self.transfers[transfer_id] = text
+        self.transfer_label.config(text="\n".join(self.transfers.values()))
+
+    def close(self):
+        # queued work never starts, running transfers fail as soon as the connection is gone
+        self.transfer_pool.shutdown(wait=False, cancel_futures=True)
+        self.request_pool.shutdown(wait=False, cancel_futures=True)
+        if self.client is not None:
+            self.client.close()
+        self.root.destroy()
+
 
     # a log box that is responsive to size changes, 
     # has selectable text and 
     # wraps long messages
+    # (the log methods may be called from any thread)
     def log(self, message):
+        if threading.current_thread() is not threading.main_thread():
+            self.in_gui(self.log, message)
+            return
         self.log_box.configure(state="normal")  # Enable editing temporarily
         self.log_box.insert(tk.END, message + "\n\n")
         self.log_box.see(tk.END)  # Scroll to the latest message
@@ -123,11 +260,24 @@ class ClientGUI:
 
     # for a single item logging, has one less newline
     def log_item(self, message):
+        if threading.current_thread() is not threading.main_thread():
+            self.in_gui(self.log_item, message)
+            return
         self.log_box.configure(state="normal")  # Enable editing temporarily
         self.log_box.insert(tk.END, message + "\n")
         self.log_box.see(tk.END)  # Scroll to the latest message
         self.log_box.configure(state="disabled")  # Make it read-only again
 
+    # for many items at once (e.g. a page of the file list), with a single insert
+    def log_items(self, messages):
+        if threading.current_thread() is not threading.main_thread():
+            self.in_gui(self.log_items, messages)
+            return
+        self.log_box.configure(state="normal")  # Enable editing temporarily
+        self.log_box.insert(tk.END, "\n".join(messages) + "\n")
+        self.log_box.see(tk.END)  # Scroll to the latest message
+        self.log_box.configure(state="disabled")  # Make it read-only again
+
     # a single pop-up window for connection with 3 fields to complete
     def connect_to_server(self):
         
@@ -168,33 +318,34 @@ class ClientGUI:
 
             connection_window.destroy()
             self.username = username
+            self.connect_button.config(state=tk.DISABLED)
+            self.request_pool.submit(connect, server_ip, server_port, username)
 
-            self.client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # runs on the request pool, connecting may take a while
+        def connect(server_ip, server_port, username):
             try:
-                self.client_socket.connect((server_ip, server_port))
-                self.client_socket.sendall(self.username.encode())
-                response = self.client_socket.recv(1024).decode()
-                if "ERROR" in response:
-                    self.log(response)
-                    self.client_socket.close()
-                    self.client_socket = None
-                else:
-                    self.log(f"<s> Connected to server as {self.username}")
-                    
-                    # user should now be able to use the 4 main buttons
-                    self.enable_buttons()
-
-                    # the new hint must inform the client about how they can close the GUI
-                    self.update_hint(
-                        "NOTE > In order to close this GUI, press the 'close' button of the app's window.",
-                        "gray"
-                    )
-
-                    # begin the thread to listen for incoming messages
-                    threading.Thread(target=self.listen_for_notifications, daemon=True).start()
+                client = StorageClient(server_ip, server_port, username, on_event=self.on_notification, log=self.log)
+            except LoginError as e:
+                self.log(str(e))
+                self.in_gui(self.connect_button.config, {"state": tk.NORMAL})
             except Exception as e:
                 self.log(f"<e> Error connecting to server: {e}")
-                self.client_socket = None
+                self.in_gui(self.connect_button.config, {"state": tk.NORMAL})
+            else:
+                self.in_gui(connected, client)
+
+        def connected(client):
+            self.client = client
+            self.log(f"<s> Connected to server as {self.username}")
+
+            # user should now be able to use the 4 main buttons
+            self.enable_buttons()
+
+            # the new hint must inform the client about how they can close the GUI
+            self.update_hint(
+                "NOTE > In order to close this GUI, press the 'close' button of the app's window.",
+                "gray"
+            )
 
         # Create a new window for connection details
         connection_window = tk.Toplevel(self.root)
@@ -232,16 +383,18 @@ class ClientGUI:
     def update_hint(self, new_text, new_color):
         self.hint_label.config(text=new_text, fg=new_color)
 
-    def listen_for_notifications(self):
-        while True:
-            try:
-                data = self.client_socket.recv(4096)
-                if not data:
-                    break
-                self.log(data.decode())
-            except Exception as e:
-                self.log(f"<e> Error in listening for notifications: {e}")
-                break
+    # called by the mux reader thread for messages the server sends without being asked, like the events of our files
+    def on_notification(self, message):
+        if isinstance(message, dict) and "event" in message:
+            verb = {"upload": "uploaded", "download": "downloaded", "delete": "deleted"}.get(message["event"], message["event"])
+            text = f"<s> Your file {message['name']} was {verb} by {message['by']}"
+            if message.get("count", 1) > 1:
+                text += f" ({message['count']} times)"
+            if message.get("dropped"):
+                text += f"\n\t({message['dropped']} earlier notifications were skipped, list the files to catch up)"
+            self.log(text)
+            return
+        self.log(message.get("message", str(message)) if isinstance(message, dict) else str(message))
 
     # user can gain access to the other buttons now
     def enable_buttons(self):
@@ -259,62 +412,55 @@ class ClientGUI:
             return
 
         filename = os.path.basename(file_path)
-        try:
-            with open(file_path, 'rb') as f:
-                # this block almost never fails,
-                # hence the file can be read successfully
-                content = f.read()
-
-            command = {"type": "upload", "filename": filename, "content": content}
-            self.send_with_size(self.client_socket, command)
-            self.log(f"<s> Successfully uploaded the file: {filename}")
-        except Exception as e:
-            self.log(f"<e> Error in uploading file: {e}")
+
+        def work(progress):
+            try:
+                response = self.client.upload(file_path, filename, progress=progress)
+
+                status = response.get("status") if response else None
+                if status == "UPLOAD_SKIPPED":
+                    self.log(f"<s> The server already has this exact file, nothing to upload: {filename}")
+                elif status == "UPLOAD_SUCCESS":
+                    self.log(f"<s> Successfully uploaded the file: {filename} ({progress.summary()})")
+                else:
+                    message = response.get("message", "") if response else ""
+                    self.log(f"<e> Server could not store the file: {filename}\n\t{message}")
+            except Exception as e:
+                self.log(f"<e> Error in uploading file: {e}")
+
+        self.start_transfer(f"Uploading {filename}", work)
 
     def list_files(self):
+        self.request_pool.submit(self.fetch_file_list)
+
+    def fetch_file_list(self):
         """
-        - Ensure the client processes only valid data (a list of dictionaries). If the response is malformed, ignore it or log a warning.
-        - If an error occurs, implement a retry mechanism to reattempt the operation after a short delay.
+        - Runs on the request pool. The server streams the list page by page, and each page is drawn with one insert as soon as it arrives.
+        - Ensure the client processes only valid data (pages of dictionaries). If the response is malformed, log a warning.
+        - A dropped connection is reconnected by the `StorageClient`, which picks the listing up again after the last page.
         """
-        retries = 2 # can be changed to any number, but the higher it gets, the longer it takes
-        for attempt in range(retries):
-            try:
-                command = {"type": "list"}
-                self.send_with_size(self.client_socket, command)
-                file_list = self.recv_all(self.client_socket)
-
-                # Validate the response
-                if not isinstance(file_list, list):  
-                    raise ValueError("<e> Server response is not a valid file list.\n")
-
-
-                try:
-                    self.log_item("\nFiles on the Server:")
-                    
-                    # for better viewing experience,
-                    # calculate the maximum file name length
-                    # optional extra padding for uniformity
-                    const_padding = 8 # change this as needed
-                    max_name_length = max(len(file['filename'].split('_', 1)[1]) for file in file_list) + const_padding
-                    
-                    # Format each row with aligned columns
-                    for file in file_list:
-                        file_name = file['filename'].split('_', 1)[1]
-                        owner = file['owner']
-                        self.log_item(f"> Name: {file_name.ljust(max_name_length)}|  Owner: {owner}")
-                    
-                    self.log("\n\t\t<----- End of List ----->")
-                    return  # Exit if successful
-                except KeyError:
-                    pass  # Ignore this iteration if the data is malformed
-            except Exception as e:
-                self.log(f"<e> Error listing files: {e}\n")
-                if attempt < retries - 1:
-                    wait_time = 0.1
-                    # self.log(f"- Attempt {attempt}: Trying again after {wait_time} seconds...")
-                    time.sleep(wait_time)  # Wait before retrying
-                else:
-                    self.log("<e> Unable to retrieve file list after multiple attempts.")
+        try:
+            self.log_item("\nFiles on the Server:")
+
+            # for better viewing experience, the name column is as wide as the longest name seen so far
+            # optional extra padding for uniformity
+            const_padding = 8 # change this as needed
+            name_width = 0
+
+            # pages that aren't valid raise a ValueError in `list_pages`
+            for files in self.client.list_pages(page_size=LIST_PAGE_SIZE):
+                if files:
+                    name_width = max(name_width, max(len(file['name']) for file in files) + const_padding)
+                    # drawn by the main thread as soon as it gets to it, not after the whole list has arrived
+                    self.log_items([
+                        f"> Name: {file['name'].ljust(name_width)}|  Owner: {file['owner']}"
+                        for file in files
+                    ])
+
+            self.log("\n\t\t<----- End of List ----->")
+        except Exception as e:
+            self.log(f"<e> Error listing files: {e}\n")
+            self.log("<e> Unable to retrieve file list.")
 
 
     def delete_file(self):
@@ -322,13 +468,14 @@ class ClientGUI:
         if not filename:
             return
 
-        try:
-            command = {"type": "delete", "filename": filename}
-            self.send_with_size(self.client_socket, command)
-            response = self.recv_all(self.client_socket)
-            self.log(response.get("message", "File deleted successfully."))
-        except Exception as e:
-            self.log(f"<e> Error deleting file: {e}")
+        def work():
+            try:
+                response = self.client.delete(filename)
+                self.log(response.get("message", "File deleted successfully."))
+            except Exception as e:
+                self.log(f"<e> Error deleting file: {e}")
+
+        self.request_pool.submit(work)
 
     def download_file(self):
         filename = tk.simpledialog.askstring("Input", "Enter the filename to download:")
@@ -336,51 +483,22 @@ class ClientGUI:
         if not filename or not owner:
             return
 
-        try:
-            command = {"type": "download", "filename": filename, "owner": owner}
-            self.send_with_size(self.client_socket, command)
-            response = self.recv_all(self.client_socket)
-
-            if response["status"] == "SUCCESS":
-                save_path = filedialog.asksaveasfilename()
-                if save_path:
-                    with open(save_path, 'wb') as f:
-                        f.write(response["content"])
-                    self.log(f"File downloaded: {filename}")
-            else:
-                self.log(f"<e> Error in file download's status code:\n\t{response['message']}")
-        except Exception as e:
-            self.log(f"<e> Error downloading file: {e}")
-
-    def run(self):
-        self.root.mainloop()
+        # asked up front, so a half-finished earlier download to the same place can be picked up again
+        save_path = filedialog.asksaveasfilename()
+        if not save_path:
+            return
 
-    def send_with_size(self, sock, data):
-        """
-        - Send data with its size prepended.
-        - Can change the fixed-width manually.
-        """
-        serialized_data = pickle.dumps(data)
-        data_length = len(serialized_data)
+        def work(progress):
+            try:
+                if self.client.download(filename, owner, save_path, progress=progress):
+                    self.log(f"File downloaded: {filename} ({progress.summary()})")
+            except Exception as e:
+                self.log(f"<e> Error downloading file: {e}\n\tRun the same download again to resume it.")
 
-        # to send length as a fixed-width 10-character string
-        sock.sendall(f"{data_length:<10}".encode())
-        sock.sendall(serialized_data)
+        self.start_transfer(f"Downloading {filename}", work)
 
-    def recv_all(self, sock):
-        """
-        - Receive all data from the socket.
-        - Note that they're encoded as binary earlier.
-        """
-        # to read the size of the incoming data
-        data_length = int(sock.recv(10).decode().strip()) 
-        data = b"" # for handling binary encodings/decodings
-        while len(data) < data_length:
-            packet = sock.recv(4096)
-            if not packet:
-                break
-            data += packet
-        return pickle.loads(data)
+    def run(self):
+        self.root.mainloop()
 
 if __name__ == "__main__":
     client = ClientGUI()
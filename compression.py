@@ -0,0 +1,255 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Compression
+
+## Overview
+Logs and CSVs shrink 5-10x, so on a slow link it is faster to compress them than to send them as they are.
+
+- **Negotiation**: right after logging in, the client sends `hello` with the codecs it knows (best first), and the
+  server answers with the first one it knows too (or `None`). That codec is used for the rest of the connection.
+- **Per chunk**: on a multiplexed connection (see `mux.py`), every piece of file data is compressed on its own and
+  marked with `FLAG_COMPRESSED`, so the receiver can unpack it without any earlier piece.
+- **Skipping**: content that already looks compressed (zip, gzip, jpeg, ...) is sent as it is, and a transfer stops
+  trying as soon as a chunk doesn't get noticeably smaller.
+- **At rest** (`--compress-at-rest`): the server can store files as a container of compressed chunks, see `compress_file`.
+
+## Container Layout
+`CONTAINER_HEADER` (magic, version, codec, raw size, chunk size), then one record per chunk of `chunk size` raw bytes
+(the last one may be shorter): `RECORD_HEADER` (whether it is compressed, stored length) followed by the stored bytes.
+A range of the file is read by hopping over the record headers, so it never decompresses more than it has to.
+
+## Notes
+- Only the standard library's `zlib` and `lzma` are used.
+- Decompression is capped at the chunk size, so a tiny malicious chunk can't blow up into gigabytes.
+"""
+
+
+import lzma
+import os
+import struct
+import tempfile
+import zlib
+
+
+# in order of preference, zlib is far faster, lzma squeezes more out of text
+CODECS = ("zlib", "lzma")
+
+# raw bytes per chunk, both on the wire and in a container
+CHUNK_SIZE = 256 * 1024
+
+# a chunk is only sent compressed if it shrinks at least to this fraction
+WORTH_IT = 0.9
+
+ZLIB_LEVEL = 3
+LZMA_PRESET = 1
+
+# file signatures of formats that are compressed already
+COMPRESSED_MAGIC = (
+    b"\x1f\x8b",            # gzip
+    b"PK\x03\x04",          # zip, docx, xlsx, jar, ...
+    b"\xfd7zXZ\x00",        # xz
+    b"BZh",                 # bzip2
+    b"7z\xbc\xaf\x27\x1c",  # 7z
+    b"(\xb5/\xfd",          # zstd
+    b"Rar!",                # rar
+    b"\xff\xd8\xff",        # jpeg
+    b"\x89PNG",             # png
+    b"GIF8",                # gif
+    b"OggS",                # ogg
+    b"fLaC",                # flac
+    b"ID3",                 # mp3
+    b"%PDF",                # pdf (its streams are deflated)
+)
+
+# magic, version, codec id, raw size, chunk size
+CONTAINER_MAGIC = b"SUTZ"
+CONTAINER_VERSION = 1
+CONTAINER_HEADER = struct.Struct("!4sBBQI")
+# compressed or not, stored length
+RECORD_HEADER = struct.Struct("!BI")
+
+CODEC_IDS = {name: i + 1 for i, name in enumerate(CODECS)}
+
+
+def negotiate(offered):
+    """
+    - The first codec the client offered that we know as well, or `None`.
+    """
+    for codec in offered or ():
+        if codec in CODEC_IDS:
+            return codec
+    return None
+
+
+def looks_compressed(chunk):
+    return bytes(chunk[:8]).startswith(COMPRESSED_MAGIC)
+
+
+def compress(codec, data):
+    if codec == "zlib":
+        return zlib.compress(data, ZLIB_LEVEL)
+    if codec == "lzma":
+        return lzma.compress(data, preset=LZMA_PRESET, check=lzma.CHECK_NONE)
+    raise ValueError(f"Unknown codec {codec}.")
+
+
+def decompress(codec, data, max_size=CHUNK_SIZE):
+    """
+    - Unpack one chunk, refusing anything that would be longer than `max_size`.
+    """
+    if codec == "zlib":
+        decompressor = zlib.decompressobj()
+        raw = decompressor.decompress(data, max_size)
+        complete = decompressor.eof and not decompressor.unconsumed_tail
+    elif codec == "lzma":
+        decompressor = lzma.LZMADecompressor()
+        raw = decompressor.decompress(data, max_size)
+        complete = decompressor.eof
+    else:
+        raise ValueError(f"Unknown codec {codec}.")
+    if not complete:
+        raise ValueError("Compressed chunk is corrupt or larger than allowed.")
+    return raw
+
+
+class ChunkCompressor:
+    """
+    - Compresses the chunks of one transfer, for as long as that pays off.
+    - `compress(chunk)` returns `(compressed, data)`, where `data` is the chunk itself if compressing didn't help.
+    """
+
+    def __init__(self, codec):
+        self.codec = codec
+        self.enabled = codec is not None
+        self.first = True
+
+    def compress(self, chunk):
+        if self.first:
+            self.first = False
+            if self.enabled and looks_compressed(chunk):
+                self.enabled = False
+        if not self.enabled or not chunk:
+            return False, chunk
+
+        packed = compress(self.codec, chunk)
+        if len(packed) > len(chunk) * WORTH_IT:
+            # random-looking data, the rest of the file is most likely the same
+            self.enabled = False
+            return False, chunk
+        return True, packed
+
+
+# compressed at rest
+
+def compress_file(path, codec, chunk_size=CHUNK_SIZE, force=False):
+    """
+    - Turn the plain file at `path` into a container in place (blocking, run it on the I/O pool).
+    - Returns `False` (and leaves the file alone) if its content doesn't compress, unless `force` is set,
+      then chunks that don't compress are just stored as they are.
+    """
+    raw_size = os.path.getsize(path)
+    compressor = ChunkCompressor(codec)
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, temp_path = tempfile.mkstemp(prefix=".compress_", suffix=".tmp", dir=directory)
+    try:
+        with open(path, 'rb') as src, os.fdopen(fd, 'wb') as dst:
+            dst.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC, CONTAINER_VERSION, CODEC_IDS[codec], raw_size, chunk_size))
+            stored = CONTAINER_HEADER.size
+            for chunk in iter(lambda: src.read(chunk_size), b""):
+                compressed, data = compressor.compress(chunk)
+                if not compressor.enabled and not force:
+                    break
+                dst.write(RECORD_HEADER.pack(compressed, len(data)))
+                dst.write(data)
+                stored += RECORD_HEADER.size + len(data)
+
+        if not force and (not compressor.enabled or stored >= raw_size):
+            os.remove(temp_path)
+            return False
+        os.replace(temp_path, path)
+        return True
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def starts_like_container(path):
+    """
+    - Such a file must be stored as a container, or it would be mistaken for one when it is read back.
+    """
+    with open(path, 'rb') as f:
+        return f.read(len(CONTAINER_MAGIC)) == CONTAINER_MAGIC
+
+
+class Container:
+    """
+    - Read access to a compressed file, opened by `open_container`.
+    """
+
+    def __init__(self, f, codec, raw_size, chunk_size):
+        self.f = f
+        self.codec = codec
+        self.raw_size = raw_size
+        self.chunk_size = chunk_size
+
+    def records(self, offset, size):
+        """
+        - Yield `(skip, take, raw_length, compressed, data)` for every chunk overlapping `size` bytes from `offset`:
+          of the chunk's `raw_length` raw bytes, `take` bytes starting at `skip` belong to the range.
+        - Blocking, meant to be iterated on the I/O pool (or in a plain thread).
+        """
+        if size <= 0:
+            return
+        index = offset // self.chunk_size
+        self.f.seek(CONTAINER_HEADER.size)
+        for _ in range(index):
+            _, length = RECORD_HEADER.unpack(self.f.read(RECORD_HEADER.size))
+            self.f.seek(length, os.SEEK_CUR)
+
+        position = index * self.chunk_size
+        end = offset + size
+        while position < end:
+            header = self.f.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                raise IOError("Compressed file is truncated.")
+            compressed, length = RECORD_HEADER.unpack(header)
+            data = self.f.read(length)
+            raw_length = min(self.chunk_size, self.raw_size - position)
+
+            skip = max(0, offset - position)
+            take = min(raw_length, end - position) - skip
+            yield skip, take, raw_length, bool(compressed), data
+            position += raw_length
+
+    def read_range(self, offset, size):
+        """
+        - The raw bytes of a range, chunk by chunk.
+        """
+        for skip, take, _, compressed, data in self.records(offset, size):
+            if compressed:
+                data = decompress(self.codec, data, self.chunk_size)
+            yield data[skip:skip + take]
+
+    def read_all(self):
+        return b"".join(self.read_range(0, self.raw_size))
+
+
+def open_container(f):
+    """
+    - A `Container` if the open file `f` is a compressed one, otherwise `None` (blocking).
+    - Either way, `f` is left at its start.
+    """
+    f.seek(0)
+    header = f.read(CONTAINER_HEADER.size)
+    f.seek(0)
+    if len(header) < CONTAINER_HEADER.size:
+        return None
+    magic, version, codec_id, raw_size, chunk_size = CONTAINER_HEADER.unpack(header)
+    if magic != CONTAINER_MAGIC or version != CONTAINER_VERSION or not 0 < codec_id <= len(CODECS):
+        return None
+    return Container(f, CODECS[codec_id - 1], raw_size, chunk_size)
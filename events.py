@@ -0,0 +1,118 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Server Events
+
+## Overview
+Owners want to know when their files are uploaded, downloaded by someone or deleted, without polling `list`. The
+server publishes an event for each of these to an `EventBus`, which fans it out to the sessions of that file's owner
+that asked for events (`subscribe`).
+
+- **Queues**: every subscription has its own bounded queue, so one slow client never holds up the command that
+  published the event, or anybody else's events.
+- **Coalescing**: a pending event for the same file and kind is merged with the new one, its `count` says how many
+  it stands for. A file downloaded a thousand times in a second is one event, not a thousand.
+- **Dropping**: if the queue is still full, the oldest event goes. The next event that is delivered carries `dropped`,
+  so the client knows it missed some and can `list` if it cares.
+
+## Notes
+- Events go out on the multiplexed connection as frames of request id `EVENT_REQUEST_ID` (see `framing.py`), so they
+  are interleaved with answers frame by frame and can never end up inside one.
+- An event is `{"event": "upload" | "download" | "delete", "owner", "name", "by", "time"}`, plus `count` and
+  `dropped` where they apply.
+- Used from the server's event loop thread only, like the metrics, so there is no locking.
+"""
+
+
+import asyncio
+import time
+from collections import OrderedDict
+
+
+# events waiting for one slow client before the oldest are dropped
+QUEUE_SIZE = 256
+
+
+class Subscription:
+    def __init__(self, client_name, size=QUEUE_SIZE):
+        self.client_name = client_name
+        self.size = size
+        # (event, owner, name) -> pending event, oldest first
+        self.pending = OrderedDict()
+        self.dropped = 0
+        self.ready = asyncio.Event()
+
+    def put(self, event):
+        """
+        - Queue `event`, merged into a pending one for the same file if there is one. Returns what happened to it.
+        """
+        key = (event["event"], event["owner"], event["name"])
+        queued = self.pending.get(key)
+        if queued is not None:
+            # the latest one wins, it just counts the ones it replaced
+            event["count"] = queued.get("count", 1) + event.get("count", 1)
+            self.pending[key] = event
+            self.pending.move_to_end(key)
+            return "coalesced"
+
+        result = "queued"
+        if len(self.pending) >= self.size:
+            self.pending.popitem(last=False)
+            self.dropped += 1
+            result = "dropped"
+        self.pending[key] = event
+        self.ready.set()
+        return result
+
+    async def get(self):
+        while not self.pending:
+            self.ready.clear()
+            await self.ready.wait()
+        _, event = self.pending.popitem(last=False)
+        if self.dropped:
+            event = dict(event, dropped=self.dropped)
+            self.dropped = 0
+        return event
+
+
+class EventBus:
+    def __init__(self):
+        # client name -> its subscriptions
+        self.subscriptions = {}
+
+        self.published = 0
+        self.coalesced = 0
+        self.dropped = 0
+
+    def subscribe(self, client_name):
+        subscription = Subscription(client_name)
+        self.subscriptions.setdefault(client_name, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscriptions = self.subscriptions.get(subscription.client_name)
+        if subscriptions is not None:
+            subscriptions.discard(subscription)
+            if not subscriptions:
+                del self.subscriptions[subscription.client_name]
+
+    def publish(self, kind, owner, name, by):
+        """
+        - Tell the subscribed sessions of `owner` that `by` did `kind` to its file `name`. Never waits.
+        """
+        subscriptions = self.subscriptions.get(owner)
+        if not subscriptions:
+            return
+        self.published += 1
+        for subscription in subscriptions:
+            result = subscription.put({"event": kind, "owner": owner, "name": name, "by": by, "time": time.time()})
+            if result == "coalesced":
+                self.coalesced += 1
+            elif result == "dropped":
+                self.dropped += 1
+
+    def pending(self):
+        return sum(len(subscription.pending) for subs in self.subscriptions.values() for subscription in subs)
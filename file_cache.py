@@ -0,0 +1,80 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# File Cache
+
+## Overview
+A few small files (configs and the like) may be downloaded thousands of times a minute. Opening, reading and closing
+them every time is wasted work, so the server can keep the content of small files in memory.
+
+- **Budget**: at most `max_bytes` of content in total, the least recently downloaded files are dropped first.
+- **Threshold**: only files of at most `max_file_size` bytes are kept, big files would just push everything else out.
+- **Keys**: the stored filename (`<owner>_<name>`), and every upload or delete of that name drops its entry.
+- **Counters**: `hits`, `misses` (of files small enough to be kept) and `evictions`, reported with the server's metrics.
+
+## Notes
+- A download that read the file before an upload replaced it must not put the old content back afterwards, so `put`
+  takes the `generation` seen before reading, and is ignored if anything was invalidated since.
+- Used from the server's event loop thread only, like the metrics, so there is no locking.
+"""
+
+
+from collections import OrderedDict
+
+
+class FileCache:
+    def __init__(self, max_bytes, max_file_size):
+        self.max_bytes = max_bytes
+        self.max_file_size = max_file_size
+
+        # filename -> (content, etag), least recently used first
+        self.entries = OrderedDict()
+        self.size = 0
+        # bumped by every invalidation
+        self.generation = 0
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, filename):
+        """
+        - The `(content, etag)` of `filename`, or `None`. That only counts as a miss once `put` is given the content,
+          a file too big to ever be kept isn't one.
+        """
+        entry = self.entries.get(filename)
+        if entry is None:
+            return None
+        self.entries.move_to_end(filename)
+        self.hits += 1
+        return entry
+
+    def put(self, filename, content, etag, generation):
+        """
+        - Keep `content` (read while the cache was at `generation`), if it is small enough and still current.
+        """
+        if len(content) > self.max_file_size or len(content) > self.max_bytes:
+            return
+        # it would have been here if it had been read before
+        self.misses += 1
+        if generation != self.generation:
+            return
+        self.discard(filename)
+        self.entries[filename] = (content, etag)
+        self.size += len(content)
+        while self.size > self.max_bytes:
+            _, (old, _) = self.entries.popitem(last=False)
+            self.size -= len(old)
+            self.evictions += 1
+
+    def invalidate(self, filename):
+        self.generation += 1
+        self.discard(filename)
+
+    def discard(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            self.size -= len(entry[0])
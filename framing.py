@@ -0,0 +1,304 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Framing Layer
+
+## Overview
+Shared by `client.py` and `server_core.py` so both ends speak exactly the same wire format.
+
+Every message is a frame: an 8-byte big-endian length prefix followed by that many bytes of payload.
+The payload is the message encoded with `wire.py` (never pickle, so a peer can't make us run code).
+Raw file bodies (streamed uploads/downloads) are sent right after their header frame with no extra framing.
+
+## Multiplexed Framing
+After a client sends `{"type": "mux"}`, the rest of that connection uses multiplexed frames instead, so several
+requests can be in flight at once: `request_id (4) + stream_id (4) + flags (1) + length (4)` followed by the payload.
+- Stream `STREAM_CONTROL` carries encoded messages, stream `STREAM_DATA` carries raw file bytes in pieces of at most
+  `MUX_CHUNK_SIZE`, so a small reply never waits behind more than one piece of a big transfer.
+- The server marks the end of every request with an empty `FLAG_END` frame. A client that gives up on a request sends
+  one too, the server then stops handling it (a cancel that crosses the server's own end is ignored).
+- A data frame with `FLAG_COMPRESSED` holds one chunk compressed with the codec negotiated by `hello`.
+- Request id `EVENT_REQUEST_ID` (0) is never used by a client, it is reserved for messages the server sends on its own.
+
+## Notes
+- Reads go straight into a preallocated `bytearray` with `recv_into`, so a big frame is copied once, not O(n^2) times.
+- `recv_exact` keeps reading until it has all the bytes, so short reads (including of the length prefix) are fine.
+- The read size is configurable per call, or globally through `DEFAULT_READ_SIZE`.
+"""
+
+
+import asyncio
+import os
+import socket
+import struct
+
+import wire
+
+
+# 8-byte unsigned length, network byte order
+HEADER = struct.Struct("!Q")
+
+# how many bytes we ask the socket for in one go
+DEFAULT_READ_SIZE = 1024 * 1024
+
+# refuse to allocate a buffer for anything larger than this,
+# a corrupted length prefix would otherwise ask for petabytes
+MAX_FRAME_SIZE = 4 * 1024 * 1024 * 1024
+
+# request id, stream id, flags, payload length
+MUX_HEADER = struct.Struct("!IIBI")
+STREAM_CONTROL = 0
+STREAM_DATA = 1
+FLAG_END = 1
+# the data frame's payload is compressed with the connection's codec (see `compression.py`)
+FLAG_COMPRESSED = 2
+EVENT_REQUEST_ID = 0
+
+# the largest piece of file data in one multiplexed frame
+MUX_CHUNK_SIZE = 256 * 1024
+
+# TCP keepalive: probe after this many idle seconds, every `KEEPALIVE_INTERVAL`, give up after `KEEPALIVE_PROBES`
+KEEPALIVE_IDLE = 30
+KEEPALIVE_INTERVAL = 10
+KEEPALIVE_PROBES = 3
+
+
+def encode_message(data):
+    """
+    - The encoded message as a list of buffers, a big `content` is one of them as-is instead of being copied.
+    """
+    return wire.encode(data)
+
+
+def decode_message(payload):
+    return wire.decode(payload)
+
+
+def set_keepalive(sock):
+    """
+    - Let the OS probe an idle connection, so a peer that silently went away is noticed within about a minute.
+    - The timing options are not available everywhere, the defaults of the OS are used where they are missing.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for option, value in (
+        ("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_PROBES),
+    ):
+        if hasattr(socket, option):
+            sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, option), value)
+
+
+def recv_exact_into(sock, view, read_size=None):
+    """
+    - Fill the whole writable `view` with bytes from the socket.
+    - Raises `ConnectionError` if the peer closes before all of it has arrived.
+    """
+    read_size = read_size or DEFAULT_READ_SIZE
+    received = 0
+    total = len(view)
+    while received < total:
+        n = sock.recv_into(view[received:received + read_size])
+        if not n:
+            raise ConnectionError("Connection closed before the whole frame arrived.")
+        received += n
+
+
+def recv_exact(sock, size, read_size=None):
+    """
+    - Receive exactly `size` bytes into a preallocated buffer and return it.
+    """
+    buffer = bytearray(size)
+    recv_exact_into(sock, memoryview(buffer), read_size)
+    return buffer
+
+
+def send_frame(sock, data):
+    """
+    - Encode `data` and send it with its length prepended.
+    """
+    parts = encode_message(data)
+    sock.sendall(HEADER.pack(sum(len(part) for part in parts)))
+    for part in parts:
+        sock.sendall(part)
+
+
+def recv_frame(sock, read_size=None):
+    """
+    - Receive one frame and decode it.
+    - Returns `None` if the peer closed the connection cleanly between frames.
+    """
+    header = bytearray(HEADER.size)
+    view = memoryview(header)
+    first = sock.recv_into(view)
+    if not first:
+        return None
+    recv_exact_into(sock, view[first:], read_size)
+
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes is larger than the allowed maximum.")
+    return decode_message(recv_exact(sock, length, read_size))
+
+
+def send_mux_frame(sock, request_id, stream_id, flags, *parts):
+    """
+    - Send one multiplexed frame whose payload is `parts` one after the other.
+    - The caller makes sure no other thread writes to `sock` meanwhile.
+    """
+    sock.sendall(MUX_HEADER.pack(request_id, stream_id, flags, sum(len(part) for part in parts)))
+    for part in parts:
+        sock.sendall(part)
+
+
+def recv_mux_frame(sock, read_size=None):
+    """
+    - Receive one multiplexed frame as `(request_id, stream_id, flags, payload)`.
+    - Returns `None` if the peer closed the connection cleanly between frames.
+    """
+    header = bytearray(MUX_HEADER.size)
+    view = memoryview(header)
+    first = sock.recv_into(view)
+    if not first:
+        return None
+    recv_exact_into(sock, view[first:], read_size)
+
+    request_id, stream_id, flags, length = MUX_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes is larger than the allowed maximum.")
+    return request_id, stream_id, flags, recv_exact(sock, length, read_size)
+
+
+def recv_to_file(sock, size, f, read_size=None):
+    """
+    - Receive exactly `size` raw bytes and write them straight into the file `f`.
+    - Passing `None` as the file just drains the bytes from the socket.
+    """
+    read_size = read_size or DEFAULT_READ_SIZE
+    buffer = bytearray(min(size, read_size))
+    view = memoryview(buffer)
+    remaining = size
+    while remaining > 0:
+        received = sock.recv_into(view[:min(remaining, read_size)])
+        if not received:
+            raise ConnectionError("Connection closed in the middle of a file transfer.")
+        if f is not None:
+            f.write(view[:received])
+        remaining -= received
+
+
+def send_from_file(sock, f, size, read_size=None):
+    """
+    - Send exactly `size` bytes of the open file `f`, starting at its current position.
+    - Uses `sendfile` when the platform has it, otherwise a chunk loop through one reused buffer.
+    """
+    # `sendfile` would read a count of 0 as "until the end of the file"
+    if size <= 0:
+        return
+
+    offset = f.tell()
+    if hasattr(os, "sendfile"):
+        try:
+            sock.sendfile(f, offset, size)
+            return
+        except (OSError, ValueError):
+            # sendfile may refuse some files/sockets before sending anything,
+            # however, if it fails half-way there is no way to recover the stream
+            if f.tell() != offset:
+                raise
+            f.seek(offset)
+
+    read_size = read_size or DEFAULT_READ_SIZE
+    buffer = bytearray(min(size, read_size))
+    view = memoryview(buffer)
+    remaining = size
+    while remaining > 0:
+        read = f.readinto(view[:min(remaining, read_size)])
+        if not read:
+            raise IOError("File got shorter while it was being sent.")
+        sock.sendall(view[:read])
+        remaining -= read
+
+
+# the same framing, for code running on an asyncio event loop (see `server_core.py`)
+
+def encode_frame(data):
+    """
+    - Return the length prefix and the encoded message as a list of buffers, ready to be written one after the other.
+    """
+    parts = encode_message(data)
+    return [HEADER.pack(sum(len(part) for part in parts))] + parts
+
+
+async def read_frame(reader):
+    """
+    - Read one frame from an `asyncio.StreamReader` and decode it.
+    - Returns `None` if the peer closed the connection cleanly between frames.
+    """
+    try:
+        header = await reader.readexactly(HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed before the whole frame arrived.")
+
+    (length,) = HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes is larger than the allowed maximum.")
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed before the whole frame arrived.")
+    return decode_message(payload)
+
+
+async def read_mux_frame(reader):
+    """
+    - Read one multiplexed frame from an `asyncio.StreamReader` as `(request_id, stream_id, flags, payload)`.
+    - Returns `None` if the peer closed the connection cleanly between frames.
+    """
+    try:
+        header = await reader.readexactly(MUX_HEADER.size)
+    except asyncio.IncompleteReadError as e:
+        if not e.partial:
+            return None
+        raise ConnectionError("Connection closed before the whole frame arrived.")
+
+    request_id, stream_id, flags, length = MUX_HEADER.unpack(header)
+    if length > MAX_FRAME_SIZE:
+        raise ValueError(f"Frame of {length} bytes is larger than the allowed maximum.")
+    try:
+        payload = await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise ConnectionError("Connection closed before the whole frame arrived.")
+    return request_id, stream_id, flags, payload
+
+
+async def read_chunks(reader, size, read_size=None):
+    """
+    - Yield exactly `size` raw bytes from an `asyncio.StreamReader`, one chunk at a time.
+    """
+    read_size = read_size or DEFAULT_READ_SIZE
+    remaining = size
+    while remaining > 0:
+        chunk = await reader.read(min(remaining, read_size))
+        if not chunk:
+            raise ConnectionError("Connection closed in the middle of a file transfer.")
+        remaining -= len(chunk)
+        yield chunk
+
+
+async def write_from_file(writer, f, size):
+    """
+    - Send exactly `size` bytes of the open file `f` through an `asyncio.StreamWriter`.
+    - `loop.sendfile` uses the kernel's `sendfile` when it can and falls back to a read loop otherwise.
+    """
+    if size <= 0:
+        return
+
+    await writer.drain()
+    loop = asyncio.get_running_loop()
+    sent = await loop.sendfile(writer.transport, f, f.tell(), size)
+    if sent != size:
+        raise IOError("File got shorter while it was being sent.")
@@ -0,0 +1,50 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Striped Locks
+
+## Overview
+Two uploads to the same name, or an upload and a delete of it, must not interleave their commit steps. One global
+lock would make every commit wait for every other one, and one lock per name would grow with the catalog. A
+`StripedLock` has a fixed number of `asyncio.Lock`s, and a key always maps to the same one of them: operations on the
+same name are serialized, operations on different names almost always run side by side.
+
+## Notes
+- `hold(*keys)` takes the stripes of several keys at once, always in stripe order, so two holders can't deadlock.
+- Where locks of more than one `StripedLock` are needed, they are taken in a fixed order (the server takes its name
+  locks before its blob locks).
+"""
+
+
+import asyncio
+import contextlib
+
+
+DEFAULT_STRIPES = 64
+
+
+class StripedLock:
+    def __init__(self, stripes=DEFAULT_STRIPES):
+        self.locks = [asyncio.Lock() for _ in range(stripes)]
+
+    def stripe(self, key):
+        return hash(key) % len(self.locks)
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys):
+        """
+        - Hold the stripes of all `keys` (`None`s are ignored), each stripe once.
+        """
+        stripes = sorted({self.stripe(key) for key in keys if key is not None})
+        taken = []
+        try:
+            for stripe in stripes:
+                await self.locks[stripe].acquire()
+                taken.append(self.locks[stripe])
+            yield
+        finally:
+            for lock in reversed(taken):
+                lock.release()
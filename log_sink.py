@@ -0,0 +1,86 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Log Sink
+
+## Overview
+The server logs from its event loop and its I/O threads, but a Tkinter widget may only be touched by the GUI thread,
+and writing to a file or a slow terminal shouldn't hold up a request either.
+
+A `LogSink` is called like the old log functions, `sink(message)`, from any thread. It only timestamps the message and
+puts it into queues, which never blocks:
+- **GUI**: with `keep_for_gui=True`, the GUI takes the waiting lines out with `drain()` on a `root.after` timer
+  and inserts them in one go.
+- **File / stdout**: a background thread (`logging.handlers.QueueListener`) writes them to a rotating log file
+  (`path`) and/or a stream such as `sys.stdout`.
+
+## Notes
+- Call `close()` on the way out, it writes whatever is still queued.
+"""
+
+
+import logging
+import logging.handlers
+import queue
+from datetime import datetime
+
+
+TIMESTAMP_FORMAT = "[%Y-%m-%d %H:%M:%S]"
+
+# a rotating log file is cut at this size, and this many old ones are kept
+MAX_LOG_BYTES = 5 * 1024 * 1024
+LOG_BACKUPS = 3
+
+
+class LogSink:
+    def __init__(self, path=None, stream=None, keep_for_gui=False, max_bytes=MAX_LOG_BYTES, backups=LOG_BACKUPS):
+        # lines waiting for the GUI to pick them up
+        self.pending = queue.SimpleQueue() if keep_for_gui else None
+
+        handlers = []
+        if path is not None:
+            handlers.append(logging.handlers.RotatingFileHandler(
+                path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+            ))
+        if stream is not None:
+            handlers.append(logging.StreamHandler(stream))
+        for handler in handlers:
+            handler.setFormatter(logging.Formatter("[%(asctime)s] %(message)s", "%Y-%m-%d %H:%M:%S"))
+
+        self.records = queue.SimpleQueue()
+        self.listener = None
+        if handlers:
+            self.listener = logging.handlers.QueueListener(self.records, *handlers)
+            self.listener.start()
+        self.handlers = handlers
+
+    def __call__(self, message):
+        if self.pending is not None:
+            self.pending.put(f"{datetime.now().strftime(TIMESTAMP_FORMAT)} {message}")
+        if self.listener is not None:
+            self.records.put(logging.makeLogRecord({"msg": message, "levelno": logging.INFO, "levelname": "INFO"}))
+
+    def drain(self, limit=None):
+        """
+        - Take out the lines waiting for the GUI, at most `limit` of them.
+        """
+        lines = []
+        if self.pending is None:
+            return lines
+        while limit is None or len(lines) < limit:
+            try:
+                lines.append(self.pending.get_nowait())
+            except queue.Empty:
+                break
+        return lines
+
+    def close(self):
+        if self.listener is not None:
+            # writes everything that is still queued before returning
+            self.listener.stop()
+            self.listener = None
+        for handler in self.handlers:
+            handler.close()
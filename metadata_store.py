@@ -0,0 +1,403 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Metadata Store
+
+## Overview
+Keeps the metadata of every stored file: `stored filename -> {owner, name, size, mtime, sha256}`.
+
+Re-pickling the whole dictionary on every upload/delete is O(N) per operation and leaves a half-written file behind
+if the server dies in the middle of it. Instead, every operation appends one small record to a journal, and the
+whole dictionary is only written out once in a while (compaction), in the background.
+
+## Files
+- `<path>`: the snapshot, a pickled `dict`. Old `file_metadata.pkl` files (`stored filename -> owner`) still load as-is.
+- `<path>.journal`: the records written since the snapshot.
+- `<path>.journal.old`: only exists while a compaction is running (or if the server died during one, or it failed to
+  write the snapshot, then the next compaction appends the journal to it).
+
+## Notes
+- Each journal record is `length + crc32 + pickled (op, filename, entry)`. A torn record at the end (crash mid-write) is dropped on load.
+- `put_many`/`remove_many` write a whole batch as one `batch` record (its entry is the list of records), so a batch
+  is applied all or nothing, with one write.
+- Records are flushed to the OS right away and fsynced in groups by a background thread every `sync_interval` seconds.
+- The snapshot is written to a temp file, fsynced and then renamed over the old one, so it is always either the old or the new one.
+- Replaying is idempotent (a record just sets or removes one key), so replaying a record the snapshot already contains is harmless.
+- `snapshot()` freezes the catalog for a listing that spans several pages. The sorted copy is reused until the next
+  change, and entries are shared with the store: they are replaced on every `put`, never changed in place.
+- `sqlite_store.py` has the same interface, backed by an indexed SQLite database instead of an in-memory dict.
+"""
+
+
+import bisect
+import heapq
+import os
+import pickle
+import shutil
+import struct
+import tempfile
+import threading
+import zlib
+from operator import itemgetter
+
+
+# payload length and crc32 of one journal record
+RECORD_HEADER = struct.Struct("!II")
+
+OP_PUT = "put"
+OP_REMOVE = "remove"
+OP_BATCH = "batch"
+
+
+def make_entry(filename, owner, size=None, mtime=None, sha256=None):
+    """
+    - The metadata of one stored file, as both stores hand it out.
+    - `filename` is the stored name (`{owner}_{name}`), `name` is what the owner called it.
+    """
+    name = filename[len(owner) + 1:] if filename.startswith(f"{owner}_") else filename
+    return {"filename": filename, "owner": owner, "name": name, "size": size, "mtime": mtime, "sha256": sha256}
+
+
+class CatalogSnapshot:
+    """
+    - The catalog as it was at one moment, sorted by stored filename, with the same `query` as the store.
+    """
+
+    def __init__(self, filenames, entries):
+        self.filenames = filenames
+        self.entries = entries
+
+    def query(self, owner=None, prefix=None, cursor=None, limit=None):
+        start = bisect.bisect_right(self.filenames, cursor) if cursor is not None else 0
+        selected = []
+        for i in range(start, len(self.entries)):
+            entry = self.entries[i]
+            if (owner is None or entry["owner"] == owner) and (prefix is None or entry["name"].startswith(prefix)):
+                selected.append(entry)
+                # one extra, to know whether there is another page
+                if limit is not None and len(selected) > limit:
+                    break
+
+        has_more = limit is not None and len(selected) > limit
+        entries = [dict(entry) for entry in selected[:limit]]
+        next_cursor = entries[-1]["filename"] if has_more else None
+        return entries, next_cursor
+
+    def close(self):
+        pass
+
+
+class MetadataStore:
+    def __init__(self, path, log=print, sync_interval=0.05, compact_after=10000):
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.old_journal_path = path + ".journal.old"
+        self.log = log
+
+        # how long a record may sit un-fsynced, and how many records trigger a compaction
+        self.sync_interval = sync_interval
+        self.compact_after = compact_after
+
+        self.entries = {}
+        # owner -> their stored filenames, so listing one user's files doesn't scan everyone's
+        self.by_owner = {}
+        # sha256 -> how many entries have that content, for the deduplicating storage
+        self.refcounts = {}
+        self.lock = threading.Lock()
+        # bumped by every change, the sorted snapshot of the whole catalog is kept until the next one
+        self.version = 0
+        self.listing = None
+        self.listing_version = None
+        self.dirty = False
+        self.journal_records = 0
+        self.compacting = False
+        self.stopping = False
+        self.closed = False
+
+        self.load()
+        self.journal = open(self.journal_path, 'ab')
+
+        self.wake = threading.Event()
+        self.sync_thread = threading.Thread(target=self.sync_loop, name="metadata-sync", daemon=True)
+        self.sync_thread.start()
+
+    def get(self, filename):
+        entry = self.entries.get(filename)
+        return dict(entry) if entry is not None else None
+
+    def __contains__(self, filename):
+        return filename in self.entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def blob_refcount(self, sha256):
+        return self.refcounts.get(sha256, 0)
+
+    def query(self, owner=None, prefix=None, cursor=None, limit=None):
+        """
+        - Entries ordered by stored filename, optionally only one owner's and/or names starting with `prefix`.
+        - Only entries after `cursor` (a stored filename) are returned, at most `limit` of them.
+        - Returns `(entries, next_cursor)`, where `next_cursor` is `None` once there is nothing left.
+        """
+        with self.lock:
+            if owner is not None:
+                candidates = self.by_owner.get(owner, ())
+            else:
+                candidates = self.entries.keys()
+
+            matches = (
+                f for f in candidates
+                if (cursor is None or f > cursor)
+                and (prefix is None or self.entries[f]["name"].startswith(prefix))
+            )
+            if limit is None:
+                selected = sorted(matches)
+            else:
+                # one extra, to know whether there is another page
+                selected = heapq.nsmallest(limit + 1, matches)
+
+            has_more = limit is not None and len(selected) > limit
+            entries = [dict(self.entries[f]) for f in selected[:limit]]
+
+        next_cursor = entries[-1]["filename"] if has_more else None
+        return entries, next_cursor
+
+    def snapshot(self, owner=None):
+        """
+        - A `CatalogSnapshot` of every entry (or one owner's), for paging through a consistent listing.
+        - The whole catalog is only copied under the lock, sorting it doesn't hold up writers.
+        """
+        with self.lock:
+            if owner is not None:
+                filenames = sorted(self.by_owner.get(owner, ()))
+                return CatalogSnapshot(filenames, [self.entries[f] for f in filenames])
+            if self.listing is not None and self.listing_version == self.version:
+                return self.listing
+            version = self.version
+            items = list(self.entries.items())
+
+        items.sort(key=itemgetter(0))
+        listing = CatalogSnapshot([filename for filename, _ in items], [entry for _, entry in items])
+        with self.lock:
+            if self.version == version:
+                self.listing, self.listing_version = listing, version
+        return listing
+
+    def put(self, filename, owner, size=None, mtime=None, sha256=None):
+        self.append((OP_PUT, filename, make_entry(filename, owner, size, mtime, sha256)))
+
+    def remove(self, filename):
+        self.append((OP_REMOVE, filename, None))
+
+    def put_many(self, items):
+        """
+        - `put` for every `(filename, owner, size, mtime, sha256)` in `items`, as one record.
+        """
+        self.append_many([(OP_PUT, filename, make_entry(filename, *rest)) for filename, *rest in items])
+
+    def remove_many(self, filenames):
+        self.append_many([(OP_REMOVE, filename, None) for filename in filenames])
+
+    def append_many(self, records):
+        if len(records) == 1:
+            self.append(records[0])
+        elif records:
+            self.append((OP_BATCH, None, records))
+
+    def append(self, record):
+        """
+        - Apply one record in memory and append it to the journal: O(1), no matter how many files there are.
+        - The record reaches the disk with the next group fsync.
+        """
+        payload = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if self.closed:
+                raise RuntimeError("Metadata store is closed.")
+            self.apply(record)
+            self.journal.write(RECORD_HEADER.pack(len(payload), zlib.crc32(payload)))
+            self.journal.write(payload)
+            self.journal.flush()
+            self.journal_records += 1
+            self.dirty = True
+
+            # wake the background thread right away if a compaction is due
+            if self.journal_records >= self.compact_after and not self.compacting:
+                self.wake.set()
+
+    def apply(self, record):
+        op, filename, entry = record
+        self.version += 1
+        if op == OP_PUT:
+            if isinstance(entry, str):
+                # written before sizes and hashes were tracked, the value is just the owner
+                entry = make_entry(filename, entry)
+            self.forget(filename)
+            self.entries[filename] = entry
+            self.by_owner.setdefault(entry["owner"], set()).add(filename)
+            if entry["sha256"] is not None:
+                self.refcounts[entry["sha256"]] = self.refcounts.get(entry["sha256"], 0) + 1
+        elif op == OP_REMOVE:
+            self.forget(filename)
+        elif op == OP_BATCH:
+            for sub_record in entry:
+                self.apply(sub_record)
+
+    def forget(self, filename):
+        entry = self.entries.pop(filename, None)
+        if entry is not None:
+            owned = self.by_owner.get(entry["owner"])
+            owned.discard(filename)
+            if not owned:
+                del self.by_owner[entry["owner"]]
+
+            sha256 = entry["sha256"]
+            if sha256 is not None:
+                self.refcounts[sha256] -= 1
+                if not self.refcounts[sha256]:
+                    del self.refcounts[sha256]
+
+    def sync_loop(self):
+        while not self.stopping:
+            self.wake.wait(self.sync_interval)
+            self.wake.clear()
+            try:
+                self.sync()
+                if self.journal_records >= self.compact_after:
+                    self.compact()
+            except Exception as e:
+                self.log(f"<e> Error persisting metadata: {e}")
+
+    def sync(self):
+        """
+        - fsync every record appended so far, all of them with one call.
+        """
+        with self.lock:
+            if not self.dirty or self.closed:
+                return
+            self.journal.flush()
+            # a duplicate of the descriptor stays valid even if the journal is rotated meanwhile,
+            # so the (slow) fsync itself does not have to hold the lock
+            fd = os.dup(self.journal.fileno())
+            self.dirty = False
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def compact(self):
+        """
+        - Write a fresh snapshot and start an empty journal.
+        - Appends only wait for the journal rotation, not for the snapshot itself to be written.
+        """
+        with self.lock:
+            if self.compacting or self.closed:
+                return
+            self.journal.flush()
+            os.fsync(self.journal.fileno())
+            self.journal.close()
+            if os.path.exists(self.old_journal_path):
+                # an earlier compaction failed to write its snapshot, so the old journal's records are in none yet:
+                # these go after them instead of over them
+                append_file(self.journal_path, self.old_journal_path)
+                os.remove(self.journal_path)
+            else:
+                os.replace(self.journal_path, self.old_journal_path)
+            self.journal = open(self.journal_path, 'ab')
+            self.journal_records = 0
+            self.dirty = False
+            self.compacting = True
+            snapshot = dict(self.entries)
+
+        try:
+            self.write_snapshot(snapshot)
+            os.remove(self.old_journal_path)
+            self.log(f"<s> Compacted metadata ({len(snapshot)} files).")
+        finally:
+            self.compacting = False
+
+    def write_snapshot(self, snapshot):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, temp_path = tempfile.mkstemp(prefix=".metadata_", suffix=".tmp", dir=directory)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                pickle.dump(snapshot, f, protocol=pickle.HIGHEST_PROTOCOL)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+    def load(self):
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                snapshot = pickle.load(f)
+
+            for filename, entry in snapshot.items():
+                self.apply((OP_PUT, filename, entry))
+
+        # the old journal (from an interrupted compaction) is older than the current one
+        replayed = self.replay(self.old_journal_path) + self.replay(self.journal_path)
+        self.journal_records = replayed
+
+        # finish the interrupted compaction first, the next one would overwrite the old journal
+        if os.path.exists(self.old_journal_path):
+            self.write_snapshot(dict(self.entries))
+            os.remove(self.old_journal_path)
+
+        if self.entries or replayed:
+            self.log(f"<s> Loaded metadata ({len(self.entries)} files, {replayed} journal records).")
+
+    def replay(self, journal_path):
+        if not os.path.exists(journal_path):
+            return 0
+
+        count = 0
+        valid_length = 0
+        with open(journal_path, 'rb') as f:
+            data = f.read()
+
+        while valid_length + RECORD_HEADER.size <= len(data):
+            length, crc = RECORD_HEADER.unpack_from(data, valid_length)
+            start = valid_length + RECORD_HEADER.size
+            payload = data[start:start + length]
+            if len(payload) < length or zlib.crc32(payload) != crc:
+                break
+            self.apply(pickle.loads(payload))
+            valid_length = start + length
+            count += 1
+
+        if valid_length < len(data):
+            # the server died in the middle of a write, so we drop the torn tail
+            self.log(f"<e> Dropped a torn record at the end of {journal_path}.")
+            with open(journal_path, 'r+b') as f:
+                f.truncate(valid_length)
+        return count
+
+    def close(self):
+        """
+        - Stop the background thread, then fold the journal into a fresh snapshot.
+        """
+        self.stopping = True
+        self.wake.set()
+        self.sync_thread.join()
+
+        self.compact()
+        with self.lock:
+            self.closed = True
+            self.journal.close()
+        self.log("<s> Saved metadata.")
+
+
+def append_file(source_path, target_path):
+    """
+    - Append the content of `source_path` to `target_path`, on disk before it returns.
+    """
+    with open(source_path, 'rb') as source, open(target_path, 'ab') as target:
+        shutil.copyfileobj(source, target)
+        target.flush()
+        os.fsync(target.fileno())
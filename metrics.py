@@ -0,0 +1,136 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Metrics
+
+## Overview
+Counts what the server does, so hot spots can be found under load:
+- **Per command**: how often it ran, how often it failed, the file bytes it moved in and out, and a latency histogram
+  (p50/p95/p99/max).
+- **Gauges**: numbers read at the moment they are reported, like active connections or queue depths.
+
+`snapshot()` returns everything as plain data (what the `stats` command sends), `format_text()` as a small table
+(what the periodic dump logs).
+
+## Notes
+- Latencies go into fixed, geometrically growing buckets (`BUCKET_GROWTH` apart), so recording is O(1), memory stays
+  constant, and a percentile is accurate to within one bucket.
+- Everything is recorded and read on the server's event loop thread, so there is no locking.
+"""
+
+
+import bisect
+import time
+
+
+# bucket upper bounds from 50 microseconds up to about 10 minutes, each 20% above the previous one
+BUCKET_GROWTH = 1.2
+FIRST_BUCKET = 0.00005
+BUCKET_COUNT = 90
+BUCKETS = [FIRST_BUCKET * BUCKET_GROWTH ** i for i in range(BUCKET_COUNT)]
+
+PERCENTILES = (50, 95, 99)
+
+
+class Histogram:
+    def __init__(self):
+        # one more for anything beyond the last bound
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect.bisect_left(BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, p):
+        """
+        - The upper bound of the bucket the `p`th percentile falls into (never more than the largest value seen).
+        """
+        if not self.count:
+            return 0.0
+        rank = self.count * p / 100
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(BUCKETS[i], self.max) if i < len(BUCKETS) else self.max
+        return self.max
+
+
+class CommandStats:
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.latency = Histogram()
+
+    def snapshot(self):
+        stats = {
+            "count": self.count,
+            "errors": self.errors,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "mean": self.latency.total / self.count if self.count else 0.0,
+            "max": self.latency.max,
+        }
+        for p in PERCENTILES:
+            stats[f"p{p}"] = self.latency.percentile(p)
+        # how fast the bytes moved while the command was running
+        stats["mb_per_s"] = (self.bytes_in + self.bytes_out) / self.latency.total / 1e6 if self.latency.total else 0.0
+        return stats
+
+
+class Metrics:
+    def __init__(self):
+        self.started = time.time()
+        self.commands = {}
+        # name -> function returning the current value
+        self.gauges = {}
+        # bumped on every record, so a dump can tell whether anything happened since the last one
+        self.version = 0
+
+    def gauge(self, name, read):
+        self.gauges[name] = read
+
+    def record(self, command, seconds, bytes_in=0, bytes_out=0, error=False):
+        stats = self.commands.get(command)
+        if stats is None:
+            stats = self.commands[command] = CommandStats()
+        stats.count += 1
+        stats.errors += bool(error)
+        stats.bytes_in += bytes_in
+        stats.bytes_out += bytes_out
+        stats.latency.record(seconds)
+        self.version += 1
+
+    def snapshot(self):
+        return {
+            "uptime": time.time() - self.started,
+            "commands": {name: stats.snapshot() for name, stats in sorted(self.commands.items())},
+            "gauges": {name: read() for name, read in self.gauges.items()},
+        }
+
+    def format_text(self):
+        snapshot = self.snapshot()
+        lines = [
+            f"Stats after {snapshot['uptime']:.0f}s: "
+            + ", ".join(f"{name} {value}" for name, value in snapshot["gauges"].items()),
+            f"{'command':<16}{'count':>8}{'errors':>7}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'max ms':>9}"
+            f"{'MB in':>9}{'MB out':>9}{'MB/s':>8}",
+        ]
+        for name, stats in snapshot["commands"].items():
+            lines.append(
+                f"{name:<16}{stats['count']:>8}{stats['errors']:>7}"
+                f"{stats['p50'] * 1000:>9.2f}{stats['p95'] * 1000:>9.2f}{stats['p99'] * 1000:>9.2f}{stats['max'] * 1000:>9.2f}"
+                f"{stats['bytes_in'] / 1e6:>9.1f}{stats['bytes_out'] / 1e6:>9.1f}{stats['mb_per_s']:>8.1f}"
+            )
+        return "\n".join(lines)
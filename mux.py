@@ -0,0 +1,237 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Multiplexed Client Connection
+
+## Overview
+With plain frames the connection is strictly request/response: while a big file is on its way, nothing else can be
+asked. After the `mux` command, every frame carries a request id and a stream id (see `framing.py`), so several
+requests share the one socket at the same time.
+
+- Any number of threads can call `request()` (or `call()`) at once, each gets its own `MuxRequest`.
+- A single reader thread reads every frame and puts it into the queue of the request it belongs to.
+- Frames the server sends on its own (request id `EVENT_REQUEST_ID`) go to the `on_event` callback instead.
+
+## Notes
+- Writes are serialized by a lock, file bodies go out `MUX_CHUNK_SIZE` at a time, so a small request only waits
+  behind one piece of a big upload.
+- File data is compressed chunk by chunk with the codec the connection agreed on (`codec`), as long as that pays off.
+- Each request buffers a limited number of frames. If its caller falls behind, the reader thread waits for it,
+  which (through TCP) slows the server down instead of filling up memory.
+"""
+
+
+import queue
+import socket
+import threading
+
+import compression
+import framing
+
+
+# put into a request's queue once the server has finished it
+END = object()
+
+
+class RequestFailed(Exception):
+    pass
+
+
+class MuxRequest:
+    """
+    - One request in flight: send its messages and file body, receive its answers in order.
+    - Use it as a context manager (or call `close`), so frames arriving after the caller is done are dropped, and a
+      request the server hasn't ended yet is cancelled.
+    """
+
+    # frames buffered for this request before the reader thread waits for the caller
+    INBOX_FRAMES = 16
+
+    def __init__(self, client, request_id):
+        self.client = client
+        self.request_id = request_id
+        self.inbox = queue.Queue(maxsize=self.INBOX_FRAMES)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def send(self, data):
+        self.client.write_frame(self.request_id, framing.STREAM_CONTROL, 0, *framing.encode_message(data))
+
+    def send_file(self, f, size, progress=None):
+        """
+        - Send `size` bytes of `f` as data frames, compressed where it helps.
+        - `progress(n)` is called after every chunk with the number of (uncompressed) bytes it held.
+        """
+        compressor = compression.ChunkCompressor(self.client.codec)
+        buffer = bytearray(framing.MUX_CHUNK_SIZE)
+        view = memoryview(buffer)
+        remaining = size
+        while remaining > 0:
+            n = f.readinto(view[:min(len(buffer), remaining)])
+            if not n:
+                raise IOError("File got shorter while it was being sent.")
+            compressed, data = compressor.compress(view[:n])
+            flags = framing.FLAG_COMPRESSED if compressed else 0
+            self.client.write_frame(self.request_id, framing.STREAM_DATA, flags, data)
+            remaining -= n
+            if progress is not None:
+                progress(n)
+
+    def next_frame(self):
+        item = self.inbox.get()
+        if item is END:
+            raise RequestFailed("Server ended the request without an answer.")
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def recv(self):
+        stream_id, _, payload = self.next_frame()
+        if stream_id != framing.STREAM_CONTROL:
+            raise ValueError("Got file data where a message was expected.")
+        return framing.decode_message(payload)
+
+    def recv_to_file(self, size, f, progress=None):
+        """
+        - Write the next `size` bytes of file data into `f`, calling `progress(n)` for every chunk like `send_file`.
+        """
+        remaining = size
+        while remaining > 0:
+            stream_id, flags, payload = self.next_frame()
+            if stream_id != framing.STREAM_DATA:
+                raise ValueError("Got something else than the announced file data.")
+            if flags & framing.FLAG_COMPRESSED:
+                payload = compression.decompress(self.client.codec, payload, min(remaining, framing.MUX_CHUNK_SIZE))
+            if len(payload) > remaining:
+                raise ValueError("Got more file data than announced.")
+            f.write(payload)
+            remaining -= len(payload)
+            if progress is not None:
+                progress(len(payload))
+
+    def close(self):
+        if self.client.unregister(self.request_id):
+            # the server is still on it (or its end is on the way): tell it to stop, so an abandoned upload doesn't
+            # keep its handler waiting for bytes that never come
+            try:
+                self.client.write_frame(self.request_id, framing.STREAM_CONTROL, framing.FLAG_END)
+            except OSError:
+                pass
+        # the reader thread might be waiting for room in a full inbox
+        while True:
+            try:
+                self.inbox.get_nowait()
+            except queue.Empty:
+                break
+
+
+class MuxClient:
+    def __init__(self, sock, on_event=None, codec=None):
+        self.sock = sock
+        self.on_event = on_event
+        # compression codec agreed on with `hello`, or `None`
+        self.codec = codec
+
+        self.write_lock = threading.Lock()
+        self.lock = threading.Lock()
+        # request id -> request that still waits for frames
+        self.requests = {}
+        self.next_id = framing.EVENT_REQUEST_ID + 1
+        self.error = None
+
+        self.reader = threading.Thread(target=self.read_loop, name="mux-reader", daemon=True)
+        self.reader.start()
+
+    def request(self, command):
+        """
+        - Start a new request with `command` as its first message.
+        """
+        with self.lock:
+            if self.error is not None:
+                raise ConnectionError(f"Connection is closed: {self.error}")
+            request_id = self.next_id
+            self.next_id += 1
+            request = self.requests[request_id] = MuxRequest(self, request_id)
+
+        try:
+            request.send(command)
+        except BaseException:
+            request.close()
+            raise
+        return request
+
+    def call(self, command):
+        """
+        - For commands answered with exactly one message.
+        """
+        with self.request(command) as request:
+            return request.recv()
+
+    def write_frame(self, request_id, stream_id, flags, *parts):
+        with self.write_lock:
+            try:
+                framing.send_mux_frame(self.sock, request_id, stream_id, flags, *parts)
+            except OSError as e:
+                # broken for good, even if the reader thread hasn't noticed yet
+                with self.lock:
+                    if self.error is None:
+                        self.error = ConnectionError(f"Connection lost: {e}")
+                raise
+
+    def unregister(self, request_id):
+        """
+        - Returns whether the request was still waiting for frames.
+        """
+        with self.lock:
+            return self.requests.pop(request_id, None) is not None
+
+    def read_loop(self):
+        error = ConnectionError("Server closed the connection.")
+        try:
+            while True:
+                frame = framing.recv_mux_frame(self.sock)
+                if frame is None:
+                    break
+                request_id, stream_id, flags, payload = frame
+
+                if request_id == framing.EVENT_REQUEST_ID:
+                    if self.on_event is not None:
+                        self.on_event(framing.decode_message(payload))
+                    continue
+
+                with self.lock:
+                    request = self.requests.get(request_id)
+                    if flags & framing.FLAG_END:
+                        self.requests.pop(request_id, None)
+                if request is None:
+                    # its caller is not interested anymore
+                    continue
+                request.inbox.put(END if flags & framing.FLAG_END else (stream_id, flags, payload))
+        except Exception as e:
+            error = ConnectionError(f"Connection lost: {e}")
+        finally:
+            # wake up everyone still waiting, nothing more is going to arrive
+            with self.lock:
+                self.error = error
+                pending = list(self.requests.values())
+                self.requests.clear()
+            for request in pending:
+                request.inbox.put(error)
+
+    def close(self):
+        try:
+            # wakes the reader thread up, a plain close would leave it blocked in `recv`
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        try:
+            self.sock.close()
+        except OSError:
+            pass
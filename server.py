@@ -12,15 +12,20 @@
 # Server GUI Application Documentation
 
 ## Overview
-This Python application is a multi-client server with a graphical user interface (GUI) built using the Tkinter library. It allows clients to connect and interact with the server to perform file operations such as uploading, downloading, listing, and deleting files. The server is capable of handling multiple client connections simultaneously using threading.
+This Python application is a multi-client server with a graphical user interface (GUI) built using the Tkinter library. It allows clients to connect and interact with the server to perform file operations such as uploading, downloading, listing, and deleting files.
+
+The GUI is only a front end: the server itself lives in `server_core.py` and runs on an asyncio event loop in a background thread. The same core can be started without any display through `python server_core.py --dir <dir> --port <port>`.
 
 ## Structure
-- **ServerGUI Class**: Manages the GUI and server functionality.
+- **ServerGUI Class**: Manages the GUI and drives a `StorageServer` from `server_core.py`.
   - **Log box**: Displays logs and messages about the server and client interactions.
   - **Buttons**: Provides options for selecting the directory, starting the server, and viewing operations.
   - **Directory selection**: A dialog box that lets the user select a directory for file storage.
-  - **Server operations**: The server listens for incoming connections and handles client commands such as file uploads, downloads, deletions, and listing files.
-  - **Threading**: Each client is handled in a separate thread to allow concurrent connections.
+  - **Server operations**: The core listens for incoming connections and handles client commands such as file uploads, downloads, deletions, and listing files.
+  - **Threading**: The core's event loop runs in one background thread, all clients are served concurrently on it.
+  - **Logging**: The core never touches the log box. Its lines are queued in a `LogSink` (see `log_sink.py`) and the GUI
+    inserts them in batches every `LOG_FLUSH_MS` milliseconds. Only the last `MAX_LOG_LINES` lines stay in the box,
+    everything is also written to the rotating file `server.log`.
 
 ## Usage
 1. **Start the application**: Run the script to launch the GUI.
@@ -33,19 +38,19 @@ This Python application is a multi-client server with a graphical user interface
 ## Important Information
 - Local host IP is `127.0.0.1`.
 - The server requires a valid directory and port number to function.
-- File metadata (file ownership information) is saved and loaded from a file named `file_metadata.pkl`.
+- File metadata (file ownership information) is saved and loaded from a file named `file_metadata.pkl`, changes since the last snapshot are kept in `file_metadata.pkl.journal` (see `metadata_store.py`).
 
 ## Commands
 - `<s> ...`: Indicates a successful operation.
 - `<e> ...`: Indicates an error during an operation.
 
 ## Dependencies
-- `socket`: For creating the server socket and handling client connections.
-- `threading`: To allow concurrent client connections.
+- `server_core`: The headless server that does the actual work.
+- `threading`: To run the server core next to the Tkinter main loop.
 - `tkinter`: For the graphical user interface.
 - `os`: For handling file operations.
 - `pickle`: For serializing and deserializing metadata.
-- `datetime`: For adding timestamps to log messages.
+- `log_sink`: Queues log lines from any thread for the log box and the log file.
 
 ---
 
@@ -58,14 +63,23 @@ Local Host is 127.0.0.1
 """
 
 
-import socket
 import threading
-from threading import Lock
+import time
 import tkinter as tk
-from tkinter import filedialog, messagebox
-import os
-import pickle
-from datetime import datetime 
+from tkinter import filedialog, messagebox, simpledialog
+
+from log_sink import LogSink
+from server_core import StorageServer
+
+
+# how often queued log lines are moved into the log box, and how many at most per go
+LOG_FLUSH_MS = 100
+LOG_BATCH = 1000
+
+# older lines are dropped from the log box (they are still in the log file)
+MAX_LOG_LINES = 5000
+
+LOG_FILE = "server.log"
 
 
 class ServerGUI:
@@ -102,30 +116,37 @@ class ServerGUI:
         self.start_button = tk.Button(self.root, text="Start Server", command=self.start_server, width=20, state=tk.DISABLED)
         self.start_button.pack(pady=(5, 10))
 
-        self.server_socket = None
-        self.client_threads = []
         self.files_dir = None
-        self.clients = {}
-        self.file_owners = {}
-        self.running = True
 
-        # lock the thread for shared resources
-        self.lock = Lock()  
+        # the headless core that does the real work, and the thread its event loop runs on
+        self.server = None
+        self.server_thread = None
 
-        # Persist file metadata
-        self.metadata_file = "file_metadata.pkl"
-        self.load_metadata()
+        # safe to call from any thread, the lines reach the log box through `flush_log`
+        self.sink = LogSink(path=LOG_FILE, keep_for_gui=True)
+        self.root.after(LOG_FLUSH_MS, self.flush_log)
 
     def log(self, message):
-        self.log_box.config(state=tk.NORMAL)
-        
-        # Get the current timestamp
-        timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
-        
-        # Insert the message with the timestamp
-        self.log_box.insert(tk.END, f"{timestamp} {message}\n\n")
-        self.log_box.see(tk.END)
-        self.log_box.config(state=tk.DISABLED)
+        self.sink(message)
+
+    # runs on the GUI thread, so it is the only place that touches the log box
+    def flush_log(self):
+        lines = self.sink.drain(LOG_BATCH)
+        if lines:
+            self.log_box.config(state=tk.NORMAL)
+
+            # one insert for the whole batch, with the timestamps the sink added
+            self.log_box.insert(tk.END, "\n\n".join(lines) + "\n\n")
+
+            # each entry takes two lines, drop the oldest ones beyond the cap
+            line_count = int(self.log_box.index("end-1c").split(".")[0])
+            if line_count > MAX_LOG_LINES:
+                self.log_box.delete("1.0", f"{line_count - MAX_LOG_LINES + 1}.0")
+
+            self.log_box.see(tk.END)
+            self.log_box.config(state=tk.DISABLED)
+
+        self.root.after(LOG_FLUSH_MS, self.flush_log)
 
 
     def select_directory(self):
@@ -146,15 +167,19 @@ class ServerGUI:
 
         # the ask integer dialog makes sure that the user only enters a valid port number
         # which must be a positive integer number (i.e., negative/float numbers and/or characters are not allowed)
-        self.port = tk.simpledialog.askinteger("Input", "Enter server port:")
+        self.port = simpledialog.askinteger("Input", "Enter server port:")
         if not self.port:
             # can't have a server with no port yani
             return
 
-        self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.server_socket.bind(('', self.port))
-        self.server_socket.listen(5)
-        self.log(f"<s> Server started on port {self.port}")
+        # the core logs "Server started" by itself once it is listening
+        self.server = StorageServer(self.files_dir, self.port, log=self.sink)
+        self.server_thread = threading.Thread(target=self.server.run, daemon=True)
+        self.server_thread.start()
+
+        # one server per window
+        self.start_button.config(state=tk.DISABLED)
+        self.select_dir_button.config(state=tk.DISABLED)
 
         # the new hint must inform the client about how they can close the GUI
         self.update_hint(
@@ -162,228 +187,36 @@ class ServerGUI:
             "gray"
         )
 
-        threading.Thread(target=self.accept_clients, daemon=True).start()
-
 
     # to update the hint label's content and color
     def update_hint(self, new_text, new_color):
         self.hint_label.config(text=new_text, fg=new_color)
-    
-
-    # the server should accept more than one client 
-    def accept_clients(self):
-        # obviously, clients can only connect when the server is running
-        while self.running:
-            try:
-                client_socket, addr = self.server_socket.accept()
-                self.log(f"Connection attempt from {addr}...")
-
-                # each client needs a new thread
-                client_thread = threading.Thread(target=self.handle_client, 
-                                                 args=(client_socket,), 
-                                                 daemon=True)
-                self.client_threads.append(client_thread)
-                self.log("<s> New client added.")
-                client_thread.start()
-            except Exception as e:
-                self.log(f"<e> Error accepting client: {e}\n")
-                break # let others try to connect
-
-    def handle_client(self, client_socket):
-        client_name = None  # Ensure client_name is always defined
-        try:
-            client_name = client_socket.recv(1024).decode()
-            if client_name in self.clients:
-                client_socket.sendall(b"ERROR: Name already in use.")
-                client_socket.close()
-                return
-
-            self.clients[client_name] = client_socket
-            self.log(f"<s> Client connected: {client_name}")
-            client_socket.sendall(b"CONNECTED")
-
-            while self.running:
-                try:
-                    command = self.recv_all(client_socket)
-                    if not command:
-                        break
-
-                    if command["type"] == "upload":
-                        self.log(f"Client {client_name} attempted uploading...")
-                        self.handle_upload(client_name, command, client_socket)
-                    elif command["type"] == "list":
-                        self.log(f"Client {client_name} attempted file-listing...")
-                        self.handle_list(client_socket)
-                    elif command["type"] == "delete":
-                        self.log(f"Client {client_name} attempted deleting...")
-                        self.handle_delete(client_name, command, client_socket)
-                    elif command["type"] == "download":
-                        self.log(f"Client {client_name} attempted downloading...")
-                        self.handle_download(command, client_socket)
-                except Exception as e:
-                    self.log(f"<e> Error handling client command: {e}")
-                    break
-        except Exception as e:
-            self.log(f"<e> Error handling client: {e}")
-        finally:
-            if client_name in self.clients:
-                del self.clients[client_name]
-            try:
-                # used shutdown because we don't need to use it later
-                client_socket.shutdown(socket.SHUT_RDWR)
-                client_socket.close()
-            except Exception as e:
-                self.log(f"<e> Error closing socket for {client_name}: {e}")
-           
-            self.log(f"<s> Client disconnected: {client_name}")
-
-  
-    def handle_upload(self, client_name, command, client_socket):
-        # in some rare cases, upload would fail with no apparent reason
-        # hence, I used the try-catch block to determine the issue 
-        try:
-            filename = f"{client_name}_{command['filename']}"
-            filepath = os.path.join(self.files_dir, filename)
-            with open(filepath, 'wb') as f:
-                f.write(command['content'])
-            
-            self.file_owners[filename] = client_name
-            self.log(f"<s> File uploaded: ` {filename} ` by {client_name}")
-
-            # to use the content later
-            self.save_metadata()
-            self.send_with_size(client_socket, {"status": "UPLOAD_SUCCESS"})
-        except Exception as e:
-            self.log(f"<e> Error handling file upload: {e}")
-            self.send_with_size(client_socket, {"status": "UPLOAD_FAILED"})
-
-
-    def handle_list(self, client_socket):
-        """
-        - Use a threading lock to ensure `file_owners` is not being modified while it is being read for the `handle_list` function
-        - Validate `file_list` to ensure it's correctly formatted and non-empty before sending
-        """
-
-        # Ensure thread-safe access
-        with self.lock: 
-            self.log("Handling the list of files and owners...")
-            # this is a list, where each item is a dictionary
-            # and each dictionary has the file's name as the key,
-            # and the file's owner as its value because filenames are unique but not owner names
-            file_list = [{
-                "filename": f,
-                 "owner": o} 
-                for f, o in self.file_owners.items()
-            ]
-        
-        # Validate and send the response
-        if file_list:  # Ensure the list is not empty
-            self.send_with_size(client_socket, file_list)
-        else:
-            self.send_with_size(client_socket, [])
-
-
-    # in order to delete a file, that specific owner should determine the exact file
-    # obviously, one can NOT delete someone else's file
-    def handle_delete(self, client_name, command, client_socket):
-        filename = f"{client_name}_{command['filename']}"
-        filepath = os.path.join(self.files_dir, filename)
-        if os.path.exists(filepath):
-            # the desired file actually exists in the server
-            os.remove(filepath)
-            del self.file_owners[filename]
-
-            # update the server's cache
-            self.save_metadata()
-            self.log(f"<s> File deleted: {filename}")
-            self.send_with_size(client_socket, {"status": "DELETE_SUCCESS"})
-        else:
-            # can't delete file that doesn't exist on the server 
-            self.send_with_size(client_socket, {"status": "ERROR", "message": "File not found."})
-
-    # each client should be able to download any file as long as
-    # the inputs they give are valid
-    def handle_download(self, command, client_socket):
-        filename = f"{command['owner']}_{command['filename']}"
-        filepath = os.path.join(self.files_dir, filename)
-        if os.path.exists(filepath):
-            with open(filepath, 'rb') as f:
-                file_content = f.read()
-            self.send_with_size(client_socket, {"status": "SUCCESS", "content": file_content})
-        else:
-            # download almost never fails, however, there are some weird edge cases
-            # such as if you try to download cached files that actually don't exist
-            # but somehow appear in the files' list for no valid reason
-            self.send_with_size(client_socket, {"status": "ERROR", "message": "File not found."})
-
-    # we use this metadata for handling large files (download/upload)
-    def load_metadata(self):
-        if os.path.exists(self.metadata_file):
-            with open(self.metadata_file, 'rb') as f:
-                self.file_owners = pickle.load(f)
-                self.log("<s> Loaded metadata.")
-
-    def save_metadata(self):
-        with open(self.metadata_file, 'wb') as f:
-            pickle.dump(self.file_owners, f)
-            self.log("<s> Saved metadata.")
-
-    def send_with_size(self, sock, data):
-        """
-        - Send data with its size prepended.
-        - Can change the fixed-width manually.
-        """
-        serialized_data = pickle.dumps(data)
-        data_length = len(serialized_data)
-
-        # to send length as a fixed-width 10-character string
-        sock.sendall(f"{data_length:<10}".encode())  
-        sock.sendall(serialized_data)
-
-    def recv_all(self, sock):
-        """
-        - Receive all data from the socket.
-        - Note that they're encoded as binary earlier.
-        """
-        # to read the size of the incoming data
-        data_length = int(sock.recv(10).decode().strip())
-        data = b"" # for handling binary encodings/decodings
-        while len(data) < data_length:
-            packet = sock.recv(4096)
-            if not packet:
-                break
-            data += packet
-        return pickle.loads(data)
+
 
     def shutdown(self):
         self.log("Shutting down the server...")
-        self.running = False
-
-        # Close the server socket
-        if self.server_socket:
-            self.server_socket.close()
-
-        # Disconnect clients and close their sockets
-        for client_name, client_socket in self.clients.items():
-            try:
-                client_socket.shutdown(socket.SHUT_RDWR)
-                client_socket.close()
-            except Exception as e:
-                self.log(f"Error closing client socket for {client_name}: {e}")
-
-        # Wait for client threads to finish
-        for thread in self.client_threads:
-            thread.join(timeout=2)  # Set a timeout to avoid indefinite blocking
-
-        # Save metadata and gracefully exit
-        self.save_metadata()
-        self.log("Server shut down successfully.")
+
+        # the core disconnects the clients and saves the metadata by itself
+        if self.server:
+            self.server.stop()
+            self.shutdown_deadline = time.monotonic() + 2  # Set a timeout to avoid indefinite blocking
+            self.wait_for_server()
+        else:
+            self.root.quit()
+
+    # the core still logs into this window while it shuts down,
+    # so the main loop has to keep running instead of blocking on `join`
+    def wait_for_server(self):
+        if self.server_thread.is_alive() and time.monotonic() < self.shutdown_deadline:
+            self.root.after(50, self.wait_for_server)
+            return
         self.root.quit() # this works better than other techniques! do NOT change it please
 
 
     def run(self):
         self.root.protocol("WM_DELETE_WINDOW", self.shutdown)
         self.root.mainloop()
+        self.sink.close()
 
 
 
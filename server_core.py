@@ -0,0 +1,1712 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Server Core
+
+## Overview
+The actual storage server, with no GUI attached. It runs on an `asyncio` event loop, so a connected but idle client
+costs one coroutine instead of one thread, and thousands of them can stay connected on a headless box.
+
+`server.py` (the Tkinter GUI) is just an optional front end on top of this module.
+
+## Usage
+```
+python server_core.py --dir ./storage --port 5000 [--max-connections 1000] [--io-workers 8] [--cache-mb 64] [--log-file server.log] [--verbose]
+```
+Press `Ctrl+C` to shut the server down, the metadata is saved on the way out.
+
+## Logging
+Log lines go through a `LogSink` (see `log_sink.py`): to stdout, or to a rotating file with `--log-file`, written by a
+background thread so a slow terminal never holds up a request. Every command and connection attempt is only logged
+with `--verbose`, by default just the outcomes (uploads, deletes, errors, ...) are.
+
+## Limits
+- At most `max_connections` clients are served at once, anyone beyond that gets `ERROR: Server is full...` and is disconnected.
+- Disk I/O runs on a fixed pool of `io_workers` threads, never on the event loop.
+  A client whose writes are waiting for the pool is simply not read from, so TCP flow control slows it down.
+
+## Protocol
+Same as before, so the existing clients work unchanged:
+1. The client sends its username as plain bytes and gets `CONNECTED` (or `ERROR: ...`) back.
+2. After that every command and response is a frame (see `framing.py`).
+3. Commands: `upload`, `upload_stream`, `list`, `delete`, `download`, `download_stream`.
+4. `list` may carry `owner`, `prefix`, `cursor` and `limit`. Then the answer is
+   `{"status": "SUCCESS", "files": [...], "cursor": ...}` and the next page is asked for with that cursor.
+   Without any of them it is the plain list of every file, like it has always been.
+5. `list` with a `page_size` streams the answer instead: one `{"status": "PAGE", "files": [...], "cursor": ..., "last": ...}`
+   frame per page until `last` is true. An optional `limit` caps the entries sent, the final `cursor` then continues
+   from there (`None` means there is nothing left).
+6. `upload_stream` may carry the `sha256` of the content. The server then first answers `UPLOAD_SKIPPED` if that
+   file already has exactly this content (nothing else is sent), or `READY`, after which the bytes follow as usual.
+7. `download_stream` may carry `offset`, `length` and `if_match` (an earlier answer's `etag`) to fetch only a range
+   of the file. The answer always has the `total_size` and `etag`, and `code: CHANGED` if `if_match` no longer matches.
+8. Parallel transfers: `open_session` returns a token, and extra connections send `\0ATTACH <token>` instead of a
+   username to act for the same client, they are closed together with the connection that opened the session.
+   A big upload is `upload_begin` -> many `upload_part` (any connection, any order, raw bytes after each header)
+   -> `upload_commit`. A big download is just several ranged `download_stream`s.
+9. `mux` switches the connection to multiplexed frames: every frame carries a request id and a stream id, so several
+   requests can be in flight at once and their answers come back interleaved (see `MuxConnection`).
+10. `hello` with a list of `codecs` picks the compression codec of the connection, the answer's `codec` is the one
+    chosen (or `None`). File data on a multiplexed connection may then come in compressed chunks (see `compression.py`).
+11. `stats` (loopback connections only) answers with the server's metrics, as data (`stats`) and as a table (`text`).
+12. Batches of small files, one request each way instead of one per file, answered with a status per file (`files`):
+    - `upload_batch` lists `{filename, size, sha256}` per file. The first answer says `UPLOAD_SKIPPED` or `READY` per
+      file, then the contents of the ready ones follow back to back, and all of them are committed with one metadata write.
+    - `delete_batch` lists the names to delete, again with one metadata write.
+    - `download_batch` lists `{filename, owner}` per file. The answer has `size` and `etag` per file, followed by the
+      contents back to back. Files beyond `MAX_BATCH_BYTES` together get `code: TOO_BIG` and are fetched on their own.
+13. `subscribe` (multiplexed connections only) asks for the events of the client's own files: every upload, delete
+    and complete download of them is pushed as a frame of request id `EVENT_REQUEST_ID` (see `events.py`).
+
+## Metrics
+Every command is counted and timed (see `metrics.py`): per command the count, errors, file bytes in/out and latency
+percentiles, next to gauges like active connections and queue depths. A client on the same machine gets them with
+the `stats` command, and `--stats-interval` logs them as a table every so often (only if anything happened since).
+
+## Concurrency
+Everything that changes a stored name (committing an upload, deleting) holds that name's stripe of `name_locks`, so
+two writers to the same name take turns while different names are committed side by side. With `--dedup`, the
+content hashes involved are held in `blob_locks` as well (always after the name), so a blob is never freed while
+another name is about to reference it. A streamed `list` pages through one snapshot of the catalog (see the metadata
+stores' `snapshot`), so files changing meanwhile never make it skip or repeat anything. The metadata is made durable
+by the stores' own background threads, never by the request that changed it. Connection bookkeeping (`clients`,
+`connections`, sessions) only ever happens on the event loop thread, so it needs no locks.
+
+## Cache
+With `--cache-mb`, the content of small files (up to `--cache-max-file-kb`) is kept in memory, so files downloaded
+over and over are answered without touching the disk (see `file_cache.py`). Uploads and deletes drop the entries of
+the names they change, and the cache's hits and misses show up in the metrics.
+
+## Metadata
+`--metadata-backend journal` (default) keeps the catalog in memory with an append-only journal (`metadata_store.py`),
+`--metadata-backend sqlite` keeps it in an indexed SQLite database (`sqlite_store.py`), which suits very large catalogs.
+
+## Storage
+By default every upload is its own file in the storage directory. With `--dedup`, identical content is stored only
+once and per-user names just reference it (see `storage.py`). With `--compress-at-rest zlib|lzma`, content that
+compresses is kept compressed on disk, and handed to clients that use the same codec without unpacking it.
+"""
+
+
+import argparse
+import asyncio
+import contextlib
+import hashlib
+import ipaddress
+import os
+import secrets
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import compression
+import framing
+from events import EventBus
+from file_cache import FileCache
+from locks import StripedLock
+from log_sink import LogSink
+from metrics import Metrics
+from metadata_store import MetadataStore
+from sqlite_store import SQLiteMetadataStore
+from storage import ContentAddressedStorage, FlatStorage
+
+
+# a data connection sends this (plus a session token) instead of a username, usernames can't contain a NUL byte
+ATTACH_PREFIX = b"\x00ATTACH "
+
+# a streamed list never queries or holds more than this many entries at once
+MAX_PAGE_SIZE = 5000
+
+# a batch request may name at most this many files, and a batch download holds at most this much content in memory
+MAX_BATCH_FILES = 1000
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# answers that count as a failed command in the metrics
+ERROR_STATUSES = {"ERROR", "UPLOAD_FAILED"}
+
+# put into a request's inbox once the client has cancelled it
+CANCELLED = object()
+
+# what `dispatch_command` handles, the metrics put any other `type` a client sends under "unknown"
+COMMAND_TYPES = {
+    "upload", "upload_stream", "list", "delete", "download", "download_stream", "open_session", "upload_begin",
+    "upload_part", "upload_commit", "hello", "stats", "upload_batch", "delete_batch", "download_batch", "subscribe",
+}
+
+# metadata backends the server can run with, and the file each one uses by default
+METADATA_BACKENDS = {
+    "journal": (MetadataStore, "file_metadata.pkl"),
+    "sqlite": (SQLiteMetadataStore, "file_metadata.db"),
+}
+
+
+# used when the server runs headless and nobody gave us a GUI to log into
+def print_log(message):
+    timestamp = datetime.now().strftime("[%Y-%m-%d %H:%M:%S]")
+    print(f"{timestamp} {message}", flush=True)
+
+
+class ClientConnection:
+    """
+    - Wraps the reader/writer pair of one connected client.
+    - The handlers only talk to this object, never to the streams directly.
+    """
+
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.addr = writer.get_extra_info("peername")
+
+        # the task serving this connection, so shutdown can wait for it
+        self.task = asyncio.current_task()
+
+        # session tokens, unfinished parallel uploads and data connections attached with those tokens
+        # that this (control) connection owns, all of them die with it
+        self.tokens = set()
+        self.uploads = set()
+        self.attached = set()
+
+        # compression codec picked by `hello`, `None` until then
+        self.codec = None
+
+        # file bytes moved and whether an error was answered, for the metrics of the current command
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.failed = False
+
+    async def send(self, data):
+        if type(data) is dict and data.get("status") in ERROR_STATUSES:
+            self.failed = True
+        self.writer.writelines(framing.encode_frame(data))
+        await self.writer.drain()
+
+    async def recv(self):
+        return await framing.read_frame(self.reader)
+
+    async def read_chunks(self, size):
+        async for chunk in framing.read_chunks(self.reader, size):
+            self.bytes_in += len(chunk)
+            yield chunk
+
+    async def send_file(self, f, size):
+        await framing.write_from_file(self.writer, f, size)
+        self.bytes_out += max(size, 0)
+
+    async def send_bytes(self, data):
+        self.writer.write(data)
+        self.bytes_out += len(data)
+        await self.writer.drain()
+
+    async def send_container(self, server, container, offset, size):
+        """
+        - Send a range of a file that is compressed at rest, as raw bytes like any other file body.
+        """
+        chunks = container.read_range(offset, size)
+        while True:
+            chunk = await server.run_io(next, chunks, None)
+            if chunk is None:
+                break
+            self.writer.write(chunk)
+            self.bytes_out += len(chunk)
+            await self.writer.drain()
+
+    @property
+    def control(self):
+        # the connection that owns sessions and uploads, requests of a multiplexed connection share it
+        return self
+
+    def close(self):
+        self.writer.close()
+
+    def abort(self):
+        self.writer.transport.abort()
+
+
+class MuxConnection:
+    """
+    - A client connection that switched to multiplexed frames (see `framing.py`).
+    - Every request runs as its own task, so a `list` or `delete` is answered while a big transfer is still going.
+    - Frames of the different requests are interleaved on the socket, a file body at most `MUX_CHUNK_SIZE` at a time.
+    """
+
+    def __init__(self, server, client_name, connection):
+        self.server = server
+        self.client_name = client_name
+        self.connection = connection
+
+        # a frame's header and payload must go out back to back
+        self.write_lock = asyncio.Lock()
+        # request id -> channel of a request that is still being handled
+        self.channels = {}
+        self.tasks = set()
+        # events of the client's files, once it asked for them
+        self.subscription = None
+        self.event_task = None
+
+    async def write_frame(self, request_id, stream_id, flags, *parts):
+        channel = self.channels.get(request_id)
+        if channel is not None and channel.cancelled:
+            # nobody reads it anymore, so a download stops at its next piece
+            raise ConnectionError("Client cancelled the request.")
+        writer = self.connection.writer
+        async with self.write_lock:
+            writer.write(framing.MUX_HEADER.pack(request_id, stream_id, flags, sum(len(part) for part in parts)))
+            writer.writelines(parts)
+            await writer.drain()
+
+    async def write_file(self, request_id, f, size):
+        """
+        - Send `size` bytes of `f` as data frames, read (and compressed, if it pays off) piece by piece on the I/O pool.
+        - The lock is only held for one piece, so other requests' frames get in between.
+        - Not `sendfile`: it stops reading the socket while it runs, and new requests would wait for the whole file.
+        """
+        compressor = compression.ChunkCompressor(self.connection.codec)
+        offset = f.tell()
+        end = offset + size
+        while offset < end:
+            length = min(framing.MUX_CHUNK_SIZE, end - offset)
+            compressed, piece = await self.server.run_io(read_piece, f, offset, length, compressor)
+            if not piece:
+                raise ConnectionError("File got shorter while it was being sent.")
+            flags = framing.FLAG_COMPRESSED if compressed else 0
+            await self.write_frame(request_id, framing.STREAM_DATA, flags, piece)
+            offset += length
+        f.seek(end)
+
+    async def write_bytes(self, request_id, data):
+        """
+        - Send file content that is already in memory as data frames, compressed where it pays off.
+        """
+        compressor = compression.ChunkCompressor(self.connection.codec)
+        for start in range(0, len(data), framing.MUX_CHUNK_SIZE):
+            compressed, piece = False, data[start:start + framing.MUX_CHUNK_SIZE]
+            if compressor.enabled:
+                compressed, piece = await self.server.run_io(compressor.compress, piece)
+            flags = framing.FLAG_COMPRESSED if compressed else 0
+            await self.write_frame(request_id, framing.STREAM_DATA, flags, piece)
+
+    async def write_container(self, request_id, container, offset, size):
+        """
+        - Send a range of a file that is compressed at rest.
+        - Whole chunks stored with the connection's codec go out exactly as they are on disk, nothing is recompressed.
+        """
+        codec = self.connection.codec
+        records = container.records(offset, size)
+        while True:
+            record = await self.server.run_io(next, records, None)
+            if record is None:
+                break
+            skip, take, raw_length, compressed, data = record
+
+            if compressed and container.codec == codec and skip == 0 and take == raw_length:
+                await self.write_frame(request_id, framing.STREAM_DATA, framing.FLAG_COMPRESSED, data)
+                continue
+            if compressed:
+                data = await self.server.run_io(compression.decompress, container.codec, data, container.chunk_size)
+            await self.write_frame(request_id, framing.STREAM_DATA, 0, data[skip:skip + take])
+
+    def subscribe(self):
+        if self.subscription is None:
+            self.subscription = self.server.events.subscribe(self.client_name)
+            self.event_task = asyncio.create_task(self.send_events())
+
+    async def send_events(self):
+        """
+        - Forward the subscription's events, each one a frame of its own between the frames of the answers.
+        - While the client is slow to read, this waits in `write_frame` and the events pile up (and coalesce) meanwhile.
+        """
+        while True:
+            event = await self.subscription.get()
+            try:
+                await self.write_frame(
+                    framing.EVENT_REQUEST_ID, framing.STREAM_CONTROL, 0, *framing.encode_message(event)
+                )
+            except ConnectionError:
+                return
+
+    async def run(self):
+        """
+        - Read frames until the client disconnects: a frame with a new request id starts a request,
+          every other frame goes to the request it belongs to.
+        """
+        self.server.muxes.add(self)
+        try:
+            while self.server.running:
+                frame = await framing.read_mux_frame(self.connection.reader)
+                if frame is None:
+                    break
+                request_id, stream_id, flags, payload = frame
+
+                channel = self.channels.get(request_id)
+                if channel is None:
+                    if stream_id != framing.STREAM_CONTROL or flags & framing.FLAG_END:
+                        # the rest of a request the server already gave up on, or a cancel that crossed its end
+                        continue
+                    channel = self.channels[request_id] = MuxChannel(self, request_id)
+                    task = asyncio.create_task(self.run_request(channel, payload))
+                    self.tasks.add(task)
+                    task.add_done_callback(self.tasks.discard)
+                elif flags & framing.FLAG_END:
+                    channel.cancel()
+                elif not channel.cancelled:
+                    # a full inbox stops reading here, which slows the client down through TCP
+                    try:
+                        await asyncio.wait_for(
+                            channel.inbox.put((stream_id, flags, payload)), MuxChannel.INBOX_TIMEOUT
+                        )
+                    except asyncio.TimeoutError:
+                        # its handler doesn't read what it is sent, it must not hold up the other requests
+                        self.server.debug(f"Client {self.client_name} sent frames nobody reads, request cancelled.")
+                        channel.cancel()
+        finally:
+            self.server.muxes.discard(self)
+            if self.subscription is not None:
+                self.server.events.unsubscribe(self.subscription)
+                self.event_task.cancel()
+            for task in list(self.tasks):
+                task.cancel()
+            if self.tasks:
+                await asyncio.wait(self.tasks)
+
+    async def run_request(self, channel, payload):
+        try:
+            # decoded here, so a malformed command only ends its own request
+            command = framing.decode_message(payload)
+            await self.server.handle_command(self.client_name, command, channel)
+        except Exception as e:
+            # only this request is lost, the connection and the other requests go on
+            if channel.cancelled:
+                self.server.debug(f"Client {self.client_name} cancelled a request: {e}")
+            else:
+                self.server.log(f"<e> Error handling client command: {e}")
+                try:
+                    await channel.send({"status": "ERROR", "message": str(e)})
+                except ConnectionError:
+                    pass
+        finally:
+            del self.channels[channel.request_id]
+            try:
+                await self.write_frame(channel.request_id, framing.STREAM_CONTROL, framing.FLAG_END)
+            except ConnectionError:
+                pass
+
+
+class MuxChannel:
+    """
+    - One request of a multiplexed connection, with the same methods as `ClientConnection`,
+      so the command handlers don't know the difference.
+    - A `FLAG_END` frame from the client cancels it: the handler's next read fails, as if the connection had dropped,
+      so it cleans up (temp files and all) the way it does then.
+    """
+
+    # frames buffered for one request before the connection stops reading
+    INBOX_FRAMES = 16
+    # how long the connection waits for room in a full inbox before it cancels the request
+    INBOX_TIMEOUT = 30
+
+    def __init__(self, mux, request_id):
+        self.mux = mux
+        self.request_id = request_id
+        self.inbox = asyncio.Queue(maxsize=self.INBOX_FRAMES)
+        self.cancelled = False
+
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.failed = False
+
+    @property
+    def control(self):
+        return self.mux.connection
+
+    def cancel(self):
+        self.cancelled = True
+        # what it sent is of no use anymore, and the marker must fit even if the handler isn't reading
+        while not self.inbox.empty():
+            self.inbox.get_nowait()
+        self.inbox.put_nowait(CANCELLED)
+
+    async def next_frame(self):
+        item = await self.inbox.get()
+        if item is CANCELLED:
+            # for every read after this one too
+            self.inbox.put_nowait(CANCELLED)
+            raise ConnectionError("Client cancelled the request.")
+        return item
+
+    async def send(self, data):
+        if type(data) is dict and data.get("status") in ERROR_STATUSES:
+            self.failed = True
+        await self.mux.write_frame(self.request_id, framing.STREAM_CONTROL, 0, *framing.encode_message(data))
+
+    async def recv(self):
+        stream_id, _, payload = await self.next_frame()
+        if stream_id != framing.STREAM_CONTROL:
+            raise ValueError("Got file data where a message was expected.")
+        return framing.decode_message(payload)
+
+    async def read_chunks(self, size):
+        remaining = size
+        while remaining > 0:
+            stream_id, flags, payload = await self.next_frame()
+            if stream_id != framing.STREAM_DATA:
+                raise ValueError("Got something else than the announced file data.")
+            if flags & framing.FLAG_COMPRESSED:
+                payload = await self.mux.server.run_io(
+                    compression.decompress, self.control.codec, payload, min(remaining, framing.MUX_CHUNK_SIZE)
+                )
+            if len(payload) > remaining:
+                raise ValueError("Got more file data than announced.")
+            remaining -= len(payload)
+            self.bytes_in += len(payload)
+            yield payload
+
+    async def send_file(self, f, size):
+        await self.mux.write_file(self.request_id, f, size)
+        self.bytes_out += max(size, 0)
+
+    async def send_bytes(self, data):
+        await self.mux.write_bytes(self.request_id, data)
+        self.bytes_out += len(data)
+
+    async def send_container(self, server, container, offset, size):
+        await self.mux.write_container(self.request_id, container, offset, size)
+        self.bytes_out += max(size, 0)
+
+
+class StorageServer:
+    def __init__(self, files_dir, port, host="", metadata_file=None, log=print_log,
+                 max_connections=1000, io_workers=8, metadata_backend="journal", dedup=False, compress_at_rest=None,
+                 verbose=False, stats_interval=None, cache_bytes=0, cache_max_file_size=64 * 1024):
+        self.files_dir = files_dir
+        self.port = port
+        self.host = host
+        self.log = log
+        # also log every command and connection attempt, not just what came out of them
+        self.verbose = verbose
+
+        # every open connection (logged in or not), so the limit also covers half-done handshakes
+        self.max_connections = max_connections
+        self.connections = set()
+
+        # all blocking disk work goes through this pool
+        self.io_workers = io_workers
+        self.io_pool = ThreadPoolExecutor(max_workers=io_workers, thread_name_prefix="storage-io")
+        # jobs handed to the pool that haven't finished yet (running or queued)
+        self.io_pending = 0
+
+        self.clients = {}
+        self.running = False
+
+        # session token -> (client name, control connection), for the extra data connections of parallel transfers
+        self.sessions = {}
+        # upload id -> parallel upload that is still receiving parts
+        self.uploads = {}
+
+        self.loop = None
+        self.server = None
+        self.stop_event = None
+
+        # multiplexed connections, and commands being handled right now
+        self.muxes = set()
+        self.active_commands = 0
+
+        self.metrics = Metrics()
+        self.stats_interval = stats_interval
+        self.metrics.gauge("connections", lambda: len(self.connections))
+        self.metrics.gauge("clients", lambda: len(self.clients))
+        self.metrics.gauge("commands_in_flight", lambda: self.active_commands)
+        self.metrics.gauge("io_queue", lambda: max(0, self.io_pending - self.io_workers))
+        self.metrics.gauge("mux_inbox_frames", lambda: sum(
+            channel.inbox.qsize() for mux in self.muxes for channel in mux.channels.values()
+        ))
+        self.metrics.gauge("parallel_uploads", lambda: len(self.uploads))
+
+        # upload/download/delete events for the owners who asked for them
+        self.events = EventBus()
+        self.metrics.gauge("event_subscribers", lambda: sum(len(subs) for subs in self.events.subscriptions.values()))
+        self.metrics.gauge("events_published", lambda: self.events.published)
+        self.metrics.gauge("events_pending", self.events.pending)
+        self.metrics.gauge("events_coalesced", lambda: self.events.coalesced)
+        self.metrics.gauge("events_dropped", lambda: self.events.dropped)
+
+        # contents of small, often downloaded files, off unless given a budget
+        self.cache = FileCache(cache_bytes, cache_max_file_size) if cache_bytes > 0 else None
+        if self.cache is not None:
+            self.metrics.gauge("cache_hits", lambda: self.cache.hits)
+            self.metrics.gauge("cache_misses", lambda: self.cache.misses)
+            self.metrics.gauge("cache_evictions", lambda: self.cache.evictions)
+            self.metrics.gauge("cache_files", lambda: len(self.cache.entries))
+            self.metrics.gauge("cache_bytes", lambda: self.cache.size)
+
+        # Persist file metadata, every upload/delete only costs O(1) metadata I/O
+        store_class, default_file = METADATA_BACKENDS[metadata_backend]
+        self.metadata_file = metadata_file or default_file
+        self.metadata = store_class(self.metadata_file, log=log)
+
+        # where the uploaded bytes live, with dedup identical content is only stored once
+        storage_class = ContentAddressedStorage if dedup else FlatStorage
+        self.storage = storage_class(files_dir, compress=compress_at_rest)
+        # created on the event loop in `serve`
+        self.name_locks = None
+        self.blob_locks = None
+
+    def run(self):
+        """
+        - Blocks until the server is stopped, meant to be the target of a thread (GUI) or the main thread (CLI).
+        """
+        try:
+            asyncio.run(self.serve())
+        except Exception as e:
+            self.log(f"<e> Server stopped with an error: {e}")
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stop_event = asyncio.Event()
+        self.name_locks = StripedLock()
+        self.blob_locks = StripedLock()
+        self.server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.running = True
+        self.log(f"<s> Server started on port {self.port}")
+
+        dump_task = asyncio.create_task(self.dump_stats()) if self.stats_interval else None
+        try:
+            await self.stop_event.wait()
+        finally:
+            self.running = False
+            self.server.close()
+            if dump_task is not None:
+                dump_task.cancel()
+
+            # Disconnect clients and close their sockets
+            connections = list(self.connections)
+            for connection in connections:
+                try:
+                    connection.close()
+                except Exception as e:
+                    self.log(f"Error closing client socket for {connection.addr}: {e}")
+
+            # give the handlers a moment to notice and clean up after themselves
+            tasks = [connection.task for connection in connections if connection.task is not None]
+            if tasks:
+                _, pending = await asyncio.wait(tasks, timeout=2)
+                # the rest is stopped, none of them may hand work to the I/O pool once it is shut down;
+                # what their clients haven't read is dropped, or their cleanup would wait for it
+                for connection in connections:
+                    if connection.task in pending:
+                        connection.abort()
+                        connection.task.cancel()
+                if pending:
+                    await asyncio.wait(pending)
+
+            await self.server.wait_closed()
+            self.io_pool.shutdown(wait=True)
+            self.metadata.close()
+            self.log("Server shut down successfully.")
+
+    def debug(self, message):
+        if self.verbose:
+            self.log(message)
+
+    def stop(self):
+        """
+        - Safe to call from any thread, e.g. the GUI's.
+        """
+        if self.loop is not None and self.stop_event is not None:
+            self.loop.call_soon_threadsafe(self.stop_event.set)
+
+    async def run_io(self, func, *args):
+        """
+        - Run a blocking disk operation on the I/O pool and wait for it without blocking the event loop.
+        """
+        self.io_pending += 1
+        try:
+            return await self.loop.run_in_executor(self.io_pool, func, *args)
+        finally:
+            self.io_pending -= 1
+
+    async def dump_stats(self):
+        """
+        - Log the metrics table every `stats_interval` seconds, skipped while nothing is happening.
+        """
+        logged_version = self.metrics.version
+        while True:
+            await asyncio.sleep(self.stats_interval)
+            if self.metrics.version != logged_version:
+                logged_version = self.metrics.version
+                self.log(self.metrics.format_text())
+
+    async def handle_client(self, reader, writer):
+        connection = ClientConnection(reader, writer)
+        self.debug(f"Connection attempt from {connection.addr}...")
+
+        # a finished connection is dropped from the set in the finally block below,
+        # so it never grows past the number of clients that are actually connected
+        over_limit = len(self.connections) >= self.max_connections
+        self.connections.add(connection)
+
+        client_name = None  # Ensure client_name is always defined
+        try:
+            handshake = await reader.read(1024)
+            if over_limit:
+                # the handshake is read first, so the client is surely waiting for this answer
+                self.log(f"<e> Rejected {connection.addr}: connection limit ({self.max_connections}) reached.")
+                writer.write(b"ERROR: Server is full, try again later.")
+                await writer.drain()
+                return
+
+            if handshake.startswith(ATTACH_PREFIX):
+                await self.serve_data_connection(handshake[len(ATTACH_PREFIX):].decode(), connection)
+                return
+
+            client_name = handshake.decode()
+            if client_name in self.clients:
+                writer.write(b"ERROR: Name already in use.")
+                await writer.drain()
+                client_name = None
+                return
+
+            self.clients[client_name] = connection
+            self.log(f"<s> Client connected: {client_name}")
+            writer.write(b"CONNECTED")
+            await writer.drain()
+
+            await self.serve_commands(client_name, connection)
+        except asyncio.CancelledError:
+            # the server is shutting down and stopped waiting for this client, the cleanup below still runs
+            pass
+        except Exception as e:
+            self.log(f"<e> Error handling client: {e}")
+        finally:
+            self.connections.discard(connection)
+            if client_name is not None and self.clients.get(client_name) is connection:
+                del self.clients[client_name]
+            try:
+                await self.end_session(connection)
+            except asyncio.CancelledError:
+                pass
+            try:
+                connection.close()
+                await writer.wait_closed()
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                self.log(f"<e> Error closing socket for {client_name}: {e}")
+
+            if client_name is not None:
+                self.log(f"<s> Client disconnected: {client_name}")
+
+    async def serve_commands(self, client_name, connection):
+        while self.running:
+            try:
+                command = await connection.recv()
+                if not command:
+                    break
+                if command["type"] == "mux":
+                    # from here on the connection speaks multiplexed frames until it is closed
+                    await connection.send({"status": "SUCCESS"})
+                    await MuxConnection(self, client_name, connection).run()
+                    break
+                await self.handle_command(client_name, command, connection)
+            except Exception as e:
+                self.log(f"<e> Error handling client command: {e}")
+                break
+
+    async def serve_data_connection(self, token, connection):
+        """
+        - An extra connection of an already logged-in client, used to move parts of a big file in parallel.
+        - It acts on behalf of that client but is not registered as a client itself.
+        """
+        session = self.sessions.get(token)
+        if session is None:
+            connection.writer.write(b"ERROR: Unknown session.")
+            await connection.writer.drain()
+            return
+        client_name, control = session
+
+        control.attached.add(connection)
+        try:
+            connection.writer.write(b"CONNECTED")
+            await connection.writer.drain()
+            await self.serve_commands(client_name, connection)
+        finally:
+            control.attached.discard(connection)
+
+    async def end_session(self, connection):
+        """
+        - Invalidate the session tokens of a closed control connection, close the data connections attached with them
+          and throw away its unfinished uploads.
+        - An upload's temp file is only closed once no part is being written into it anymore, its descriptor must
+          not be reused by another file while a part still writes to it.
+        """
+        for token in connection.tokens:
+            self.sessions.pop(token, None)
+        for data_connection in list(connection.attached):
+            data_connection.close()
+        for upload_id in connection.uploads:
+            upload = self.uploads.pop(upload_id, None)
+            if upload is not None:
+                upload["cancelled"] = True
+                await upload["idle"].wait()
+                await self.run_io(discard_temp_file, upload["temp_path"], upload["file"])
+
+    async def handle_command(self, client_name, command, connection):
+        """
+        - Run one command and record how long it took and how many file bytes it moved.
+        """
+        bytes_in, bytes_out = connection.bytes_in, connection.bytes_out
+        connection.failed = False
+        error = True
+        self.active_commands += 1
+        start = time.perf_counter()
+        try:
+            await self.dispatch_command(client_name, command, connection)
+            error = connection.failed
+        finally:
+            self.active_commands -= 1
+            kind = command.get("type")
+            self.metrics.record(
+                kind if type(kind) is str and kind in COMMAND_TYPES else "unknown", time.perf_counter() - start,
+                connection.bytes_in - bytes_in, connection.bytes_out - bytes_out, error,
+            )
+
+    async def dispatch_command(self, client_name, command, connection):
+        if command["type"] == "upload":
+            self.debug(f"Client {client_name} attempted uploading...")
+            await self.handle_upload(client_name, command, connection)
+        elif command["type"] == "upload_stream":
+            self.debug(f"Client {client_name} attempted uploading (streamed)...")
+            await self.handle_upload_stream(client_name, command, connection)
+        elif command["type"] == "list":
+            self.debug(f"Client {client_name} attempted file-listing...")
+            await self.handle_list(command, connection)
+        elif command["type"] == "delete":
+            self.debug(f"Client {client_name} attempted deleting...")
+            await self.handle_delete(client_name, command, connection)
+        elif command["type"] == "download":
+            self.debug(f"Client {client_name} attempted downloading...")
+            await self.handle_download(client_name, command, connection)
+        elif command["type"] == "download_stream":
+            # parallel downloads send many of these, only the first range of a file is worth a log line
+            if not command.get("offset"):
+                self.debug(f"Client {client_name} attempted downloading (streamed)...")
+            await self.handle_download_stream(client_name, command, connection)
+        elif command["type"] == "open_session":
+            await self.handle_open_session(client_name, connection)
+        elif command["type"] == "upload_begin":
+            self.debug(f"Client {client_name} attempted uploading (parallel)...")
+            await self.handle_upload_begin(client_name, command, connection)
+        elif command["type"] == "upload_part":
+            await self.handle_upload_part(client_name, command, connection)
+        elif command["type"] == "upload_commit":
+            await self.handle_upload_commit(client_name, command, connection)
+        elif command["type"] == "hello":
+            await self.handle_hello(command, connection)
+        elif command["type"] == "stats":
+            await self.handle_stats(connection)
+        elif command["type"] == "upload_batch":
+            self.debug(f"Client {client_name} attempted uploading (batch)...")
+            await self.handle_upload_batch(client_name, command, connection)
+        elif command["type"] == "delete_batch":
+            self.debug(f"Client {client_name} attempted deleting (batch)...")
+            await self.handle_delete_batch(client_name, command, connection)
+        elif command["type"] == "download_batch":
+            self.debug(f"Client {client_name} attempted downloading (batch)...")
+            await self.handle_download_batch(client_name, command, connection)
+        elif command["type"] == "subscribe":
+            await self.handle_subscribe(client_name, connection)
+
+    async def handle_upload(self, client_name, command, connection):
+        try:
+            filename = f"{client_name}_{command['filename']}"
+            content = command['content']
+            temp_path, temp_file = await self.run_io(self.storage.new_temp_file)
+            with temp_file:
+                await self.run_io(temp_file.write, content)
+            connection.bytes_in += len(content)
+
+            sha256 = hashlib.sha256(content).hexdigest()
+            await self.commit_upload(temp_path, filename, client_name, len(content), sha256)
+            self.log(f"<s> File uploaded: ` {filename} ` by {client_name}")
+
+            await connection.send({"status": "UPLOAD_SUCCESS"})
+        except Exception as e:
+            self.log(f"<e> Error handling file upload: {e}")
+            await connection.send({"status": "UPLOAD_FAILED"})
+
+    async def handle_upload_stream(self, client_name, command, connection):
+        """
+        - The header frame only carries the filename and the size, the raw bytes follow right after it.
+        - Bytes go straight into a temp file inside `files_dir`, which is committed once the whole file has arrived.
+        - If writing fails half-way, the rest of the bytes are still drained so the connection stays in sync.
+        """
+        filename = f"{client_name}_{command['filename']}"
+        size = int(command['size'])
+        if size < 0:
+            await connection.send({"status": "UPLOAD_FAILED", "message": "File size can't be negative."})
+            return
+
+        # the client told us the hash up front, so maybe the bytes don't need to be sent at all
+        claimed_sha256 = command.get("sha256")
+        if claimed_sha256 is not None:
+            if await self.run_io(self.is_unchanged, filename, size, claimed_sha256):
+                self.log(f"<s> File unchanged, upload skipped: ` {filename} ` by {client_name}")
+                await connection.send({"status": "UPLOAD_SKIPPED"})
+                return
+            await connection.send({"status": "READY"})
+
+        temp_path, temp_file = await self.run_io(self.storage.new_temp_file)
+        hasher = hashlib.sha256()
+        error = None
+        try:
+            async for chunk in connection.read_chunks(size):
+                if error is None:
+                    try:
+                        await self.run_io(write_chunk, temp_file, hasher, chunk)
+                    except OSError as e:
+                        # keep reading (and dropping) the bytes that are still on their way
+                        error = e
+
+            await self.run_io(temp_file.close)
+        except BaseException:
+            # the stream is broken, so there is nobody left to answer
+            discard_temp_file(temp_path, temp_file)
+            raise
+
+        if error is None and claimed_sha256 is not None and hasher.hexdigest() != claimed_sha256:
+            error = ValueError("Content does not match the hash the client announced.")
+        if error is None:
+            try:
+                await self.commit_upload(temp_path, filename, client_name, size, hasher.hexdigest())
+            except Exception as e:
+                # the stream is fine, so the client hears about it like about a failed write
+                error = e
+
+        if error is not None:
+            # a failed commit may have moved or removed it already
+            await self.run_io(discard_temp_file, temp_path, temp_file)
+            self.log(f"<e> Error handling file upload: {error}")
+            await connection.send({"status": "UPLOAD_FAILED", "message": str(error)})
+            return
+
+        self.log(f"<s> File uploaded: ` {filename} ` by {client_name}")
+        await connection.send({"status": "UPLOAD_SUCCESS"})
+
+    def is_unchanged(self, filename, size, sha256):
+        """
+        - Whether the stored file `filename` already has exactly this size and hash, and its content is still there (runs on the I/O pool).
+        - Only the same name counts: a hash alone is no proof that the client actually has someone else's content.
+        """
+        entry = self.metadata.get(filename)
+        if entry is None or entry["sha256"] != sha256 or entry["size"] != size:
+            return False
+        return os.path.exists(self.storage.file_path(filename, entry))
+
+    async def commit_upload(self, temp_path, filename, owner, size, sha256):
+        """
+        - Move a fully received temp file into the storage and record it in the metadata.
+        """
+        error = (await self.commit_uploads([(temp_path, filename, size, sha256)], owner))[0]
+        if error is not None:
+            raise error
+
+    async def commit_uploads(self, uploads, owner):
+        """
+        - Commit the temp files of `uploads` (`(temp_path, filename, size, sha256)`, distinct names) and record all
+          of them with one metadata write. Returns the error (or `None`) of each.
+        - With dedup on, the content a re-uploaded name used to point at is freed if nobody else references it.
+        """
+        if not uploads:
+            return []
+        filenames = [filename for _, filename, _, _ in uploads]
+        async with self.name_locks.hold(*filenames):
+            previous = await self.run_io(self.get_entries, filenames)
+            # a blob must not be freed by a delete while this upload is about to reference it
+            blobs = [self.blob_key(sha256) for *_, sha256 in uploads] + [self.blob_key(entry) for entry in previous]
+            async with self.blob_locks.hold(*blobs):
+                errors = await self.run_io(self.commit_stored, uploads, owner, previous)
+            if self.cache is not None:
+                for filename in filenames:
+                    self.cache.invalidate(filename)
+
+        for filename, error in zip(filenames, errors):
+            if error is None:
+                self.events.publish("upload", owner, filename[len(owner) + 1:], owner)
+        return errors
+
+    def get_entries(self, filenames):
+        return [self.metadata.get(filename) for filename in filenames]
+
+    def commit_stored(self, uploads, owner, previous):
+        """
+        - The blocking part of `commit_uploads` (runs on the I/O pool), one file failing doesn't stop the others.
+        """
+        errors, committed = [], []
+        for temp_path, filename, size, sha256 in uploads:
+            try:
+                self.storage.commit(temp_path, filename, sha256)
+            except Exception as e:
+                if os.path.exists(temp_path):
+                    os.remove(temp_path)
+                errors.append(e)
+                continue
+            errors.append(None)
+            committed.append((filename, owner, size, time.time(), sha256))
+
+        self.metadata.put_many(committed)
+        for (_, _, _, sha256), entry, error in zip(uploads, previous, errors):
+            if error is None and entry is not None and entry["sha256"] != sha256:
+                self.release_blob(entry)
+        return errors
+
+    async def delete_file(self, filename):
+        """
+        - Delete the stored file `filename`, returns the error (`FileNotFoundError` if there is no such file) or `None`.
+        """
+        return (await self.delete_files([filename]))[0]
+
+    async def delete_files(self, filenames):
+        """
+        - Delete the stored files `filenames` with one metadata write, returns an error or `None` for each one.
+        """
+        async with self.name_locks.hold(*filenames):
+            entries = await self.run_io(self.get_entries, filenames)
+            async with self.blob_locks.hold(*(self.blob_key(entry) for entry in entries)):
+                errors = await self.run_io(self.delete_stored, filenames, entries)
+            if self.cache is not None:
+                for filename in filenames:
+                    self.cache.invalidate(filename)
+
+        for entry, error in zip(entries, errors):
+            if error is None and entry is not None:
+                self.events.publish("delete", entry["owner"], entry["name"], entry["owner"])
+        return errors
+
+    def blob_key(self, entry_or_sha256):
+        """
+        - What to hold in `blob_locks` for a content hash or a metadata entry, `None` if content isn't shared.
+        """
+        if not self.storage.dedup or entry_or_sha256 is None:
+            return None
+        if isinstance(entry_or_sha256, dict):
+            return entry_or_sha256.get("sha256")
+        return entry_or_sha256
+
+    def release_blob(self, entry):
+        """
+        - Delete the content `entry` pointed at, unless another entry still references it (runs on the I/O pool).
+        """
+        sha256 = entry.get("sha256")
+        if sha256 and self.metadata.blob_refcount(sha256) == 0:
+            self.storage.remove_blob(sha256)
+
+    def delete_stored(self, filenames, entries):
+        """
+        - Remove the stored files `filenames` (with metadata `entries`) and their metadata (runs on the I/O pool).
+        - Returns an error or `None` for each one, one file failing doesn't stop the others.
+        """
+        # files first: one that can't be removed keeps its entry, instead of lingering where nothing points at it
+        errors = []
+        for filename, entry in zip(filenames, entries):
+            if entry is None and self.storage.dedup:
+                errors.append(FileNotFoundError(filename))
+                continue
+            try:
+                self.storage.remove_file(filename)
+            except FileNotFoundError as e:
+                if entry is None:
+                    errors.append(e)
+                    continue
+            except OSError as e:
+                errors.append(e)
+                continue
+            errors.append(None)
+
+        removed = [(filename, entry) for filename, entry, error in zip(filenames, entries, errors)
+                   if error is None and entry is not None]
+        self.metadata.remove_many([filename for filename, entry in removed])
+        for filename, entry in removed:
+            self.release_blob(entry)
+        return errors
+
+    def open_stored(self, filename):
+        """
+        - Open the content of the stored file `filename` for reading (runs on the I/O pool).
+        - Once open, the content stays readable even if it is deleted meanwhile.
+        """
+        entry = self.metadata.get(filename) if self.storage.dedup else None
+        return open(self.storage.file_path(filename, entry), 'rb')
+
+    async def open_content(self, filename):
+        """
+        - `(content, etag)` of the stored file `filename`, from the cache, or read into it if the file is small enough.
+        - Otherwise (no cache, or the file is too big for it) the file itself, opened once either way.
+          `OSError` if there is no such file.
+        """
+        if self.cache is None:
+            return await self.run_io(self.open_stored, filename)
+        entry = self.cache.get(filename)
+        if entry is not None:
+            return entry
+
+        generation = self.cache.generation
+        entry = await self.run_io(self.read_small, filename)
+        if type(entry) is tuple:
+            self.cache.put(filename, *entry, generation)
+        return entry
+
+    async def read_batch(self, filenames):
+        """
+        - `(content, etag)` of every file, from the cache where possible, or the answer for a file that can't be sent.
+        - All of it is held in memory at once, so what is read from disk may add up to `MAX_BATCH_BYTES` at most.
+        """
+        results = [self.cache.get(filename) if self.cache is not None else None for filename in filenames]
+        generation = self.cache.generation if self.cache is not None else None
+        missing = [i for i, result in enumerate(results) if result is None]
+
+        loaded = await self.run_io(self.read_files, [filenames[i] for i in missing], MAX_BATCH_BYTES)
+        for i, result in zip(missing, loaded):
+            results[i] = result
+            if self.cache is not None and isinstance(result, tuple):
+                self.cache.put(filenames[i], *result, generation)
+        return results
+
+    def read_files(self, filenames, budget):
+        """
+        - The blocking part of `read_batch` (runs on the I/O pool).
+        """
+        results = []
+        for filename in filenames:
+            try:
+                with self.open_stored(filename) as f:
+                    container = compression.open_container(f)
+                    stat = os.fstat(f.fileno())
+                    size = container.raw_size if container else stat.st_size
+                    if size > budget:
+                        results.append({
+                            "status": "ERROR", "code": "TOO_BIG", "message": "Too big for a batch, download it on its own.",
+                        })
+                        continue
+                    content = container.read_all() if container else f.read()
+            except OSError:
+                results.append({"status": "ERROR", "message": "File not found."})
+                continue
+            budget -= size
+            results.append((content, make_etag(stat)))
+        return results
+
+    def read_small(self, filename):
+        """
+        - The content and etag of `filename` if it is no bigger than the cache takes, otherwise the open file, at its
+          start (runs on the I/O pool).
+        """
+        f = self.open_stored(filename)
+        try:
+            container = compression.open_container(f)
+            stat = os.fstat(f.fileno())
+            if (container.raw_size if container else stat.st_size) > self.cache.max_file_size:
+                return f
+            content = container.read_all() if container else f.read()
+        except BaseException:
+            f.close()
+            raise
+        f.close()
+        return content, make_etag(stat)
+
+    async def handle_hello(self, command, connection):
+        """
+        - Pick the compression codec of this connection out of the ones the client offered.
+        """
+        connection.control.codec = compression.negotiate(command.get("codecs"))
+        await connection.send({"status": "SUCCESS", "codec": connection.control.codec})
+
+    async def handle_stats(self, connection):
+        """
+        - The metrics, only for clients on this machine.
+        """
+        host = connection.control.addr[0] if connection.control.addr else None
+        try:
+            local = ipaddress.ip_address(host).is_loopback
+        except ValueError:
+            local = False
+        if not local:
+            await connection.send({"status": "ERROR", "message": "Stats are only available locally."})
+            return
+        await connection.send({"status": "SUCCESS", "stats": self.metrics.snapshot(), "text": self.metrics.format_text()})
+
+    async def handle_subscribe(self, client_name, connection):
+        """
+        - Push the events of the client's own files to this connection from now on, until it closes.
+        """
+        if not isinstance(connection, MuxChannel):
+            await connection.send({"status": "ERROR", "message": "Events need a multiplexed connection (`mux`)."})
+            return
+        connection.mux.subscribe()
+        await connection.send({"status": "SUCCESS"})
+
+    async def handle_open_session(self, client_name, connection):
+        """
+        - Hand out a token the client's extra data connections log in with (see `ATTACH_PREFIX`).
+        """
+        if self.clients.get(client_name) is not connection.control:
+            await connection.send({"status": "ERROR", "message": "Sessions can only be opened from the main connection."})
+            return
+
+        # one token per control connection is enough, every later transfer reuses it
+        tokens = connection.control.tokens
+        if tokens:
+            token = next(iter(tokens))
+        else:
+            token = secrets.token_hex(16)
+            self.sessions[token] = (client_name, connection.control)
+            tokens.add(token)
+        await connection.send({"status": "SUCCESS", "token": token})
+
+    async def handle_upload_begin(self, client_name, command, connection):
+        """
+        - Start a parallel upload: a temp file of the final size is created, and parts can be written into it
+          from any connection of this client, in any order.
+        - With a `sha256`, an unchanged file is skipped right away, just like `upload_stream`.
+        """
+        filename = f"{client_name}_{command['filename']}"
+        size = int(command['size'])
+        if size < 0:
+            await connection.send({"status": "ERROR", "message": "File size can't be negative."})
+            return
+        sha256 = command.get("sha256")
+        if sha256 is not None and await self.run_io(self.is_unchanged, filename, size, sha256):
+            self.log(f"<s> File unchanged, upload skipped: ` {filename} ` by {client_name}")
+            await connection.send({"status": "UPLOAD_SKIPPED"})
+            return
+
+        temp_path, temp_file = await self.run_io(self.storage.new_temp_file)
+        try:
+            await self.run_io(temp_file.truncate, size)
+        except OSError as e:
+            # no room for the file, nothing has been registered yet
+            await self.run_io(discard_temp_file, temp_path, temp_file)
+            await connection.send({"status": "ERROR", "message": str(e)})
+            return
+
+        upload_id = secrets.token_hex(8)
+        idle = asyncio.Event()
+        idle.set()
+        self.uploads[upload_id] = {
+            "owner": client_name, "filename": filename, "size": size, "sha256": sha256,
+            "temp_path": temp_path, "file": temp_file,
+            # merged (start, end) byte ranges of the parts written so far, a part sent twice is not counted twice
+            "received": [],
+            # parts being written right now, `idle` is set while there are none
+            "writing": 0, "idle": idle, "cancelled": False,
+        }
+        connection.control.uploads.add(upload_id)
+        await connection.send({"status": "READY", "upload_id": upload_id})
+
+    async def handle_upload_part(self, client_name, command, connection):
+        """
+        - `size` raw bytes follow the header, they are written at `offset` of the upload's temp file.
+        - A bad part is still drained from the socket, so the connection stays in sync.
+        - While the part is written the upload counts it in `writing`, so its temp file is neither committed nor
+          closed underneath it. A cancelled upload stops taking the part's bytes at the next chunk.
+        """
+        upload = self.uploads.get(command["upload_id"])
+        start = offset = int(command["offset"])
+        size = int(command["size"])
+
+        error = None
+        if upload is None or upload["owner"] != client_name:
+            error = "Unknown upload."
+        elif offset < 0 or size < 0 or offset + size > upload["size"]:
+            error = "Part is outside of the file."
+
+        writing = error is None
+        if writing:
+            upload["writing"] += 1
+            upload["idle"].clear()
+        try:
+            async for chunk in connection.read_chunks(size):
+                if error is None and upload["cancelled"]:
+                    error = "Upload was cancelled."
+                if error is None:
+                    try:
+                        await self.run_io(os.pwrite, upload["file"].fileno(), chunk, offset)
+                    except OSError as e:
+                        error = str(e)
+                offset += len(chunk)
+        finally:
+            if writing:
+                upload["writing"] -= 1
+                if not upload["writing"]:
+                    upload["idle"].set()
+
+        if error is not None:
+            await connection.send({"status": "ERROR", "message": error})
+            return
+
+        upload["received"] = add_range(upload["received"], start, start + size)
+        await connection.send({"status": "PART_OK"})
+
+    async def handle_upload_commit(self, client_name, command, connection):
+        """
+        - All parts are in: check the content against the announced hash and store the file.
+        """
+        upload = self.uploads.get(command["upload_id"])
+        if upload is None or upload["owner"] != client_name:
+            await connection.send({"status": "UPLOAD_FAILED", "message": "Unknown upload."})
+            return
+        if upload["writing"]:
+            # the upload stays as it is, it can be committed once its parts are acknowledged
+            await connection.send({
+                "status": "ERROR", "message": "Parts are still being written, commit once all of them are acknowledged.",
+            })
+            return
+        del self.uploads[command["upload_id"]]
+        connection.control.uploads.discard(command["upload_id"])
+
+        filename = upload["filename"]
+        try:
+            await self.run_io(upload["file"].close)
+            if upload["size"] and upload["received"] != [(0, upload["size"])]:
+                raise ValueError("Some parts of the file never arrived.")
+
+            sha256 = await self.run_io(hash_file, upload["temp_path"])
+            if upload["sha256"] is not None and sha256 != upload["sha256"]:
+                raise ValueError("Content does not match the hash the client announced.")
+
+            await self.commit_upload(upload["temp_path"], filename, client_name, upload["size"], sha256)
+        except Exception as e:
+            await self.run_io(discard_temp_file, upload["temp_path"], upload["file"])
+            self.log(f"<e> Error handling file upload: {e}")
+            await connection.send({"status": "UPLOAD_FAILED", "message": str(e)})
+            return
+
+        self.log(f"<s> File uploaded: ` {filename} ` by {client_name}")
+        await connection.send({"status": "UPLOAD_SUCCESS"})
+
+    async def handle_upload_batch(self, client_name, command, connection):
+        """
+        - Many small files in one request, their contents back to back in one stream (see `BatchReceiver`).
+        - Files the server already has are skipped, everything that arrived is committed together at the end.
+        """
+        items = command.get("files") or []
+        try:
+            filenames = [f"{client_name}_{item['filename']}" for item in items]
+            sizes = [int(item["size"]) for item in items]
+            hashes = [item.get("sha256") for item in items]
+        except (TypeError, KeyError, ValueError):
+            filenames = sizes = None
+        # nothing has been read yet, so a bad batch is turned down as a whole and the stream stays in sync
+        if sizes is None or any(size < 0 for size in sizes):
+            await connection.send({"status": "ERROR", "message": "Every file of a batch needs a filename and a size."})
+            return
+        if len(items) > MAX_BATCH_FILES or len(set(filenames)) != len(filenames):
+            await connection.send({
+                "status": "ERROR", "message": f"A batch takes at most {MAX_BATCH_FILES} files, each name only once.",
+            })
+            return
+
+        unchanged = await self.run_io(
+            lambda: [self.is_unchanged(*args) for args in zip(filenames, sizes, hashes)]
+        )
+        await connection.send({"status": "READY", "files": ["UPLOAD_SKIPPED" if u else "READY" for u in unchanged]})
+
+        wanted = [i for i, u in enumerate(unchanged) if not u]
+        receiver = BatchReceiver(self.storage, [(sizes[i], hashes[i]) for i in wanted])
+        try:
+            await self.run_io(receiver.start)
+            async for chunk in connection.read_chunks(sum(sizes[i] for i in wanted)):
+                await self.run_io(receiver.write, chunk)
+            await self.run_io(receiver.finish)
+        except BaseException:
+            # the stream is broken, so there is nobody left to answer
+            receiver.discard()
+            raise
+
+        results = [{"status": "UPLOAD_SKIPPED"} if u else None for u in unchanged]
+        uploads, uploaded = [], []
+        for i, (temp_path, sha256, error) in zip(wanted, receiver.received):
+            if error is None:
+                uploads.append((temp_path, filenames[i], sizes[i], sha256))
+                uploaded.append(i)
+            else:
+                results[i] = {"status": "UPLOAD_FAILED", "message": str(error)}
+        try:
+            errors = await self.commit_uploads(uploads, client_name)
+        except Exception as e:
+            errors = [e] * len(uploads)
+        for i, error in zip(uploaded, errors):
+            results[i] = {"status": "UPLOAD_SUCCESS"} if error is None else {"status": "UPLOAD_FAILED", "message": str(error)}
+
+        stored = sum(result["status"] == "UPLOAD_SUCCESS" for result in results)
+        skipped = sum(result["status"] == "UPLOAD_SKIPPED" for result in results)
+        self.log(f"<s> Batch upload by {client_name}: {stored} stored, {skipped} unchanged, "
+                 f"{len(results) - stored - skipped} failed")
+        await connection.send({"status": "SUCCESS", "files": results})
+
+    async def handle_delete_batch(self, client_name, command, connection):
+        names = command.get("files") or []
+        if len(names) > MAX_BATCH_FILES:
+            await connection.send({"status": "ERROR", "message": f"A batch takes at most {MAX_BATCH_FILES} files."})
+            return
+
+        errors = await self.delete_files([f"{client_name}_{name}" for name in names])
+        self.log(f"<s> Batch delete by {client_name}: {errors.count(None)} of {len(names)} files deleted")
+        await connection.send({"status": "SUCCESS", "files": [
+            {"status": "DELETE_SUCCESS"} if error is None else {"status": "ERROR", "message": delete_message(error)}
+            for error in errors
+        ]})
+
+    async def handle_download_batch(self, client_name, command, connection):
+        """
+        - Sizes and etags of all the files first, then their contents back to back.
+        """
+        items = command.get("files") or []
+        if len(items) > MAX_BATCH_FILES:
+            await connection.send({"status": "ERROR", "message": f"A batch takes at most {MAX_BATCH_FILES} files."})
+            return
+
+        results = await self.read_batch([f"{item['owner']}_{item['filename']}" for item in items])
+        await connection.send({"status": "SUCCESS", "files": [
+            {"status": "SUCCESS", "size": len(result[0]), "etag": result[1]} if isinstance(result, tuple) else result
+            for result in results
+        ]})
+        for item, result in zip(items, results):
+            if isinstance(result, tuple):
+                await connection.send_bytes(result[0])
+                self.events.publish("download", item["owner"], item["filename"], client_name)
+
+    async def handle_list(self, command, connection):
+        """
+        - Without filters or a page size, every file is sent in one go (what older clients expect).
+        - Otherwise only the matching files after `cursor` are sent, at most `limit` of them, plus the next cursor.
+        - With a `page_size`, the answer is streamed page by page (see `stream_list`).
+        """
+        if "page_size" in command:
+            await self.stream_list(command, connection)
+            return
+
+        paged = any(key in command for key in ("owner", "prefix", "cursor", "limit"))
+        files, next_cursor = await self.run_io(
+            self.metadata.query,
+            command.get("owner"),
+            command.get("prefix"),
+            command.get("cursor"),
+            command.get("limit"),
+        )
+
+        if paged:
+            await connection.send({"status": "SUCCESS", "files": files, "cursor": next_cursor})
+        else:
+            # each item still has the file's (stored) name and its owner, like it has always been
+            await connection.send(files)
+
+    async def stream_list(self, command, connection):
+        """
+        - Send the listing as a series of pages, each one queried right before it is sent.
+        - Neither end ever holds more than one page, and a slow reader just makes `send` wait.
+        - All pages come from one snapshot of the catalog, as it was when the listing started.
+        """
+        page_size = max(1, min(int(command["page_size"]), MAX_PAGE_SIZE))
+        remaining = command.get("limit")
+        cursor = command.get("cursor")
+
+        if remaining is not None and remaining <= 0:
+            await connection.send({"status": "PAGE", "files": [], "cursor": cursor, "last": True})
+            return
+
+        snapshot = await self.run_io(self.metadata.snapshot, command.get("owner"))
+        try:
+            while True:
+                size = page_size if remaining is None else min(page_size, remaining)
+                files, cursor = await self.run_io(
+                    snapshot.query, command.get("owner"), command.get("prefix"), cursor, size
+                )
+                if remaining is not None:
+                    remaining -= len(files)
+
+                last = cursor is None or remaining == 0
+                await connection.send({"status": "PAGE", "files": files, "cursor": cursor, "last": last})
+                if last:
+                    break
+        finally:
+            await self.run_io(snapshot.close)
+
+    # in order to delete a file, that specific owner should determine the exact file
+    # obviously, one can NOT delete someone else's file
+    async def handle_delete(self, client_name, command, connection):
+        filename = f"{client_name}_{command['filename']}"
+        error = await self.delete_file(filename)
+        if error is not None:
+            await connection.send({"status": "ERROR", "message": delete_message(error)})
+            return
+
+        self.log(f"<s> File deleted: {filename}")
+        await connection.send({"status": "DELETE_SUCCESS"})
+
+    async def handle_download(self, client_name, command, connection):
+        filename = f"{command['owner']}_{command['filename']}"
+        try:
+            content = await self.open_content(filename)
+        except OSError:
+            await connection.send({"status": "ERROR", "message": "File not found."})
+            return
+
+        if type(content) is tuple:
+            file_content = content[0]
+        else:
+            with content as f:
+                container = await self.run_io(compression.open_container, f)
+                file_content = await self.run_io(container.read_all if container else f.read)
+        await connection.send({"status": "SUCCESS", "content": file_content})
+        connection.bytes_out += len(file_content)
+        self.events.publish("download", command["owner"], command["filename"], client_name)
+
+    async def handle_download_stream(self, client_name, command, connection):
+        """
+        - Only a small header is encoded, the file body follows it as raw bytes.
+        - The body is handed to the kernel with `sendfile` so it never gets copied into Python.
+        - `offset`/`length` ask for just a range of the file, and `if_match` makes sure it is still the same file
+          (the `etag` of an earlier answer), so an interrupted download can be resumed instead of started over.
+        - A small file in the cache is sent straight from memory.
+        """
+        filename = f"{command['owner']}_{command['filename']}"
+        try:
+            content = await self.open_content(filename)
+        except OSError:
+            await connection.send({"status": "ERROR", "message": "File not found."})
+            return
+        cached, f = (content, None) if type(content) is tuple else (None, content)
+
+        with f or contextlib.nullcontext():
+            if cached is not None:
+                content, etag = cached
+                container = None
+                total_size = len(content)
+            else:
+                # a file compressed at rest is sent as its original bytes, ranges count in those too
+                container = await self.run_io(compression.open_container, f)
+                stat = os.fstat(f.fileno())
+                total_size = container.raw_size if container else stat.st_size
+                etag = make_etag(stat)
+
+            if_match = command.get("if_match")
+            if if_match is not None and if_match != etag:
+                await connection.send({
+                    "status": "ERROR", "code": "CHANGED", "message": "File changed since the last download.",
+                    "total_size": total_size, "etag": etag,
+                })
+                return
+
+            offset = int(command.get("offset", 0))
+            if not 0 <= offset <= total_size:
+                await connection.send({"status": "ERROR", "message": "Requested range is outside of the file."})
+                return
+
+            size = total_size - offset
+            if command.get("length") is not None:
+                size = max(0, min(int(command["length"]), size))
+
+            await connection.send({
+                "status": "SUCCESS", "size": size, "offset": offset, "total_size": total_size, "etag": etag,
+            })
+            if cached is not None:
+                await connection.send_bytes(memoryview(content)[offset:offset + size])
+            elif container is not None:
+                await connection.send_container(self, container, offset, size)
+            else:
+                f.seek(offset)
+                await connection.send_file(f, size)
+
+        # a download is complete with the range that reaches the end of the file (not with a `length: 0` probe),
+        # so a resumed or parallel download is one event too
+        if offset + size == total_size and (size or command.get("length") is None):
+            self.events.publish("download", command["owner"], command["filename"], client_name)
+
+
+# small blocking helpers that are handed to the I/O pool
+
+def make_etag(stat):
+    """
+    - Changes whenever the stored file is replaced or modified, taken from the open file so it matches what is sent.
+    """
+    return f"{stat.st_ino:x}-{stat.st_mtime_ns:x}-{stat.st_size:x}"
+
+
+def hash_file(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(framing.DEFAULT_READ_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def read_piece(f, offset, length, compressor):
+    piece = os.pread(f.fileno(), length, offset)
+    return compressor.compress(piece)
+
+
+def add_range(ranges, start, end):
+    """
+    - `ranges` (sorted, non-overlapping `(start, end)` pairs) with `start`-`end` added, overlapping or touching
+      ranges merged into one.
+    """
+    if start >= end:
+        return ranges
+    merged = []
+    for range_start, range_end in ranges:
+        if range_end < start or range_start > end:
+            merged.append((range_start, range_end))
+        else:
+            start, end = min(start, range_start), max(end, range_end)
+    merged.append((start, end))
+    merged.sort()
+    return merged
+
+
+def discard_temp_file(temp_path, temp_file):
+    temp_file.close()
+    if os.path.exists(temp_path):
+        os.remove(temp_path)
+
+
+def delete_message(error):
+    # a missing file gets the message clients have always got
+    return "File not found." if isinstance(error, FileNotFoundError) else str(error)
+
+
+def write_chunk(f, hasher, chunk):
+    f.write(chunk)
+    hasher.update(chunk)
+
+
+class BatchReceiver:
+    """
+    - Splits the one stream of a batch upload into a temp file per file, checking each one against its hash.
+    - `received` ends up with `(temp_path, sha256, error)` per file. Blocking, every method runs on the I/O pool.
+    - After a write error the rest of the stream is still taken (and dropped), so the connection stays in sync.
+    """
+
+    def __init__(self, storage, files):
+        self.storage = storage
+        # (size, claimed sha256) of every file, in stream order
+        self.files = files
+        self.received = []
+        self.error = None
+
+        self.file = None
+        self.temp_path = None
+        self.hasher = None
+        self.remaining = 0
+
+    def start(self):
+        self.next_file()
+
+    def next_file(self):
+        """
+        - Close the current temp file and open the next one, skipping over empty files (they are complete at once).
+        """
+        while True:
+            self.close_file()
+            if len(self.received) == len(self.files) or self.error is not None:
+                return
+            self.temp_path, self.file = self.storage.new_temp_file()
+            self.hasher = hashlib.sha256()
+            self.remaining = self.files[len(self.received)][0]
+            if self.remaining:
+                return
+
+    def close_file(self):
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        sha256 = self.hasher.hexdigest()
+        claimed = self.files[len(self.received)][1]
+        error = None
+        if claimed is not None and claimed != sha256:
+            error = ValueError("Content does not match the hash the client announced.")
+            os.remove(self.temp_path)
+        self.received.append((self.temp_path, sha256, error))
+
+    def write(self, chunk):
+        view = memoryview(chunk)
+        while view and self.file is not None:
+            piece = view[:self.remaining]
+            try:
+                self.file.write(piece)
+            except OSError as e:
+                self.error = e
+                self.drop_file()
+                return
+            self.hasher.update(piece)
+            self.remaining -= len(piece)
+            view = view[len(piece):]
+            if not self.remaining:
+                self.next_file()
+
+    def finish(self):
+        # whatever never (completely) arrived
+        for _ in range(len(self.received), len(self.files)):
+            self.received.append((None, None, self.error or ValueError("The file never arrived.")))
+
+    def drop_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+            os.remove(self.temp_path)
+
+    def discard(self):
+        """
+        - Remove every temp file, for when the batch won't be committed at all.
+        """
+        self.drop_file()
+        for temp_path, _, error in self.received:
+            if error is None and os.path.exists(temp_path):
+                os.remove(temp_path)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the Cloud File SUtorage server without a GUI.")
+    parser.add_argument("--dir", required=True, help="directory the uploaded files are stored in")
+    parser.add_argument("--port", type=int, required=True, help="port to listen on")
+    parser.add_argument("--host", default="", help="address to bind to (default: all interfaces)")
+    parser.add_argument("--metadata-file", default=None, help="where file metadata is persisted (default depends on the backend)")
+    parser.add_argument("--metadata-backend", choices=sorted(METADATA_BACKENDS), default="journal",
+                        help="journal: in-memory catalog with an append-only journal, sqlite: indexed database")
+    parser.add_argument("--dedup", action="store_true", help="store identical content only once (content-addressed)")
+    parser.add_argument("--compress-at-rest", choices=compression.CODECS, default=None,
+                        help="keep content that compresses well compressed on disk")
+    parser.add_argument("--max-connections", type=int, default=1000, help="clients served at once, others are rejected")
+    parser.add_argument("--io-workers", type=int, default=8, help="threads doing disk I/O")
+    parser.add_argument("--cache-mb", type=float, default=0, help="memory for caching small files (default: no cache)")
+    parser.add_argument("--cache-max-file-kb", type=float, default=64, help="only files up to this size are cached")
+    parser.add_argument("--log-file", default=None, help="write the log to this (rotating) file instead of stdout")
+    parser.add_argument("--verbose", action="store_true", help="also log every command and connection attempt")
+    parser.add_argument("--stats-interval", type=float, default=60,
+                        help="log a metrics table this often, in seconds (0 turns it off)")
+    args = parser.parse_args()
+
+    if not os.path.isdir(args.dir):
+        parser.error(f"{args.dir} is not a directory")
+
+    log = LogSink(path=args.log_file) if args.log_file else LogSink(stream=sys.stdout)
+    server = StorageServer(args.dir, args.port, host=args.host, metadata_file=args.metadata_file, log=log,
+                           max_connections=args.max_connections, io_workers=args.io_workers,
+                           metadata_backend=args.metadata_backend, dedup=args.dedup,
+                           compress_at_rest=args.compress_at_rest, verbose=args.verbose,
+                           stats_interval=args.stats_interval or None, cache_bytes=int(args.cache_mb * 1024 * 1024),
+                           cache_max_file_size=int(args.cache_max_file_kb * 1024))
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        # the finally block in `serve` has already saved the metadata by now
+        pass
+    finally:
+        log.close()
+
+
+if __name__ == "__main__":
+    main()
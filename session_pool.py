@@ -0,0 +1,212 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Session Pool
+
+## Overview
+With a single connection, one network hiccup breaks every later request until the user connects again by hand. A
+`SessionPool` keeps `size` logged-in, multiplexed sessions (see `mux.py`) to the server and hands them out round robin.
+
+- **Sessions**: a name can only be logged in once, so the first session logs in with the username and the others
+  attach with a session token, like the data connections of `transfer.py`.
+- **Keepalive**: every socket has TCP keepalive on, so a connection that silently died is noticed instead of hanging.
+- **Reconnect**: a broken session is replaced the next time it is handed out, replaying the whole handshake
+  (username or token, `hello`, `mux`). Failed attempts are retried with exponential backoff and jitter.
+- **Retries**: `run(work)` runs `work(mux)`, and again if a connection broke underneath it, on a fresh session if it
+  was the session's own. Only idempotent work may be run like that, anything else takes a `session()` and fails like
+  before.
+
+## Notes
+- Right after a drop the server may not have noticed yet that the old login is gone, and refuses the name for a moment.
+  A reconnect retries that like any other failure, only the very first login fails right away.
+- Server events (`on_event`) and parallel transfers (`open_session`) need the first session, `primary=True` asks for it.
+  With an `on_event`, the first session subscribes to the events of the user's files (again after every reconnect).
+"""
+
+
+import random
+import socket
+import threading
+import time
+
+import compression
+import framing
+from mux import MuxClient
+from transfer import ATTACH_PREFIX
+
+
+# how often `run` tries again on a fresh session
+DEFAULT_RETRIES = 3
+
+# reconnect attempts per broken session, the wait between them doubles from `BACKOFF_START` up to `BACKOFF_MAX`
+RECONNECT_ATTEMPTS = 6
+BACKOFF_START = 0.2
+BACKOFF_MAX = 5.0
+
+# failures that mean the connection is gone, not that the request itself was wrong
+CONNECTION_ERRORS = (ConnectionError, TimeoutError)
+
+
+class LoginError(ConnectionError):
+    """
+    - The server refused the username, the message is the server's own.
+    """
+
+
+def open_session(server_address, greeting, codecs, on_event=None):
+    """
+    - Connect, log in with `greeting` (a username or an attach token), agree on a codec and switch to multiplexed frames.
+    """
+    sock = socket.create_connection(server_address)
+    try:
+        framing.set_keepalive(sock)
+        sock.sendall(greeting)
+        response = sock.recv(1024).decode()
+        if response != "CONNECTED":
+            raise LoginError(response or "Server closed the connection.")
+
+        # agree on how file data may be compressed
+        framing.send_frame(sock, {"type": "hello", "codecs": list(codecs)})
+        codec = recv_reply(sock).get("codec")
+
+        # from now on several requests can share the connection
+        framing.send_frame(sock, {"type": "mux"})
+        recv_reply(sock)
+    except BaseException:
+        sock.close()
+        raise
+
+    mux = MuxClient(sock, on_event=on_event, codec=codec)
+    if on_event is not None:
+        try:
+            response = mux.call({"type": "subscribe"})
+        except BaseException:
+            mux.close()
+            raise
+        if response.get("status") != "SUCCESS":
+            mux.close()
+            raise ConnectionError(response.get("message", "Could not subscribe to events."))
+    return mux
+
+
+def recv_reply(sock):
+    response = framing.recv_frame(sock)
+    if response is None:
+        raise ConnectionError("Server closed the connection.")
+    return response
+
+
+class SessionPool:
+    def __init__(self, server_address, username, size=1, codecs=compression.CODECS, on_event=None, log=print,
+                 retries=DEFAULT_RETRIES):
+        self.server_address = server_address
+        self.username = username
+        self.codecs = codecs
+        self.on_event = on_event
+        self.log = log
+        self.retries = retries
+
+        self.lock = threading.Lock()
+        self.turn = 0
+        self.closed = False
+        # one lock per slot, so only the users of a broken session wait for its reconnect
+        self.slot_locks = [threading.Lock() for _ in range(max(size, 1))]
+        self.sessions = [self.login()] + [None] * (len(self.slot_locks) - 1)
+        try:
+            for index in range(1, len(self.sessions)):
+                self.sessions[index] = self.attach()
+        except BaseException:
+            self.close()
+            raise
+
+    def login(self):
+        return open_session(self.server_address, self.username.encode(), self.codecs, self.on_event)
+
+    def attach(self):
+        response = self.session(primary=True).call({"type": "open_session"})
+        if response.get("status") != "SUCCESS":
+            raise ConnectionError(response.get("message", "Could not open a session."))
+        return open_session(self.server_address, ATTACH_PREFIX + response["token"].encode(), self.codecs)
+
+    def session(self, primary=False):
+        """
+        - A working session (the next one in turn, or the first one with `primary`), reconnected if it was broken.
+        """
+        if self.closed:
+            raise ConnectionError("The client was closed.")
+        index = 0
+        if not primary:
+            with self.lock:
+                index = self.turn % len(self.sessions)
+                self.turn += 1
+
+        with self.slot_locks[index]:
+            mux = self.sessions[index]
+            if mux is None or mux.error is not None:
+                mux = self.sessions[index] = self.reconnect(index)
+            return mux
+
+    def reconnect(self, index):
+        """
+        - Replace the broken session `index`, backing off exponentially between failed attempts.
+        """
+        if self.sessions[index] is not None:
+            self.sessions[index].close()
+            self.sessions[index] = None
+
+        delay = BACKOFF_START
+        for attempt in range(1, RECONNECT_ATTEMPTS + 1):
+            try:
+                mux = self.login() if index == 0 else self.attach()
+            except OSError as e:
+                if attempt == RECONNECT_ATTEMPTS or self.closed:
+                    raise ConnectionError(f"Could not reconnect to the server: {e}") from e
+                self.log(f"<e> Reconnecting failed ({e}), trying again in {delay:.1f}s...")
+                # the jitter keeps clients that lost the server at the same moment from coming back all at once
+                time.sleep(delay * random.uniform(0.5, 1.0))
+                delay = min(delay * 2, BACKOFF_MAX)
+                continue
+            self.log("<s> Reconnected to the server")
+            return mux
+
+    def discard(self, mux):
+        """
+        - Close a session whose connection failed, the next `session()` that lands on it reconnects.
+        - A session that is still fine is kept: the work may have failed on a connection of its own (the data
+          connections of a parallel transfer), and the first session carries the events and the tokens.
+        """
+        if mux.error is None:
+            return
+        mux.close()
+        for index, lock in enumerate(self.slot_locks):
+            with lock:
+                if self.sessions[index] is mux:
+                    self.sessions[index] = None
+
+    def run(self, work, primary=False):
+        """
+        - Return `work(mux)`, run again if a connection breaks (on a fresh session if it was this one), `retries` times
+          at most.
+        - `work` has to be idempotent: it may have partly (or even fully) happened before the connection broke.
+        """
+        attempt = 0
+        while True:
+            mux = self.session(primary)
+            try:
+                return work(mux)
+            except CONNECTION_ERRORS as e:
+                if attempt >= self.retries or self.closed:
+                    raise
+                attempt += 1
+                self.discard(mux)
+                self.log(f"<e> Connection lost ({e}), retrying...")
+
+    def close(self):
+        # work that is still running fails instead of reconnecting
+        self.closed = True
+        for mux in self.sessions:
+            if mux is not None:
+                mux.close()
@@ -0,0 +1,208 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# SQLite Metadata Store
+
+## Overview
+Same interface as `MetadataStore` (see `metadata_store.py`), but the catalog lives in an indexed SQLite database
+instead of an in-memory dictionary. Listing one user's files, or the files starting with some prefix, is an index
+range scan, so it stays cheap no matter how big the whole catalog gets.
+
+## Notes
+- The database runs in WAL mode, so readers never wait for the writer and a commit doesn't rewrite anything.
+- Every thread reads through its own connection, all writes go through one connection guarded by a lock.
+- Pagination is keyset based: the cursor is the last stored filename of the previous page.
+- `snapshot()` opens a read transaction on a connection of its own, WAL mode keeps showing it the database as it was
+  when the transaction started, until the snapshot is closed.
+"""
+
+
+import sqlite3
+import threading
+
+from metadata_store import make_entry
+
+
+# the largest code point, anything starting with a prefix sorts below `prefix + PREFIX_END`
+PREFIX_END = "\U0010ffff"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    filename TEXT PRIMARY KEY,
+    owner    TEXT NOT NULL,
+    name     TEXT NOT NULL,
+    size     INTEGER,
+    mtime    REAL,
+    sha256   TEXT
+);
+CREATE INDEX IF NOT EXISTS files_by_owner ON files (owner, filename);
+CREATE INDEX IF NOT EXISTS files_by_name ON files (name);
+CREATE INDEX IF NOT EXISTS files_by_hash ON files (sha256);
+"""
+
+COLUMNS = "filename, owner, name, size, mtime, sha256"
+
+
+class SQLiteMetadataStore:
+    def __init__(self, path, log=print):
+        self.path = path
+        self.log = log
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        # every per-thread reader, so `close` can close them all
+        self.readers = []
+
+        self.conn = self.connect()
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        # in WAL mode this only fsyncs on checkpoints, a commit is just an append to the WAL
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+        self.conn.commit()
+
+        count = len(self)
+        if count:
+            self.log(f"<s> Loaded metadata ({count} files).")
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def reader(self):
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = self.connect()
+            with self.lock:
+                self.readers.append(conn)
+        return conn
+
+    def get(self, filename):
+        row = self.reader().execute(f"SELECT {COLUMNS} FROM files WHERE filename = ?", (filename,)).fetchone()
+        return dict(row) if row is not None else None
+
+    def __contains__(self, filename):
+        return self.get(filename) is not None
+
+    def __len__(self):
+        return self.reader().execute("SELECT COUNT(*) FROM files").fetchone()[0]
+
+    def blob_refcount(self, sha256):
+        return self.reader().execute("SELECT COUNT(*) FROM files WHERE sha256 = ?", (sha256,)).fetchone()[0]
+
+    def query(self, owner=None, prefix=None, cursor=None, limit=None):
+        """
+        - Entries ordered by stored filename, optionally only one owner's and/or names starting with `prefix`.
+        - Only entries after `cursor` (a stored filename) are returned, at most `limit` of them.
+        - Returns `(entries, next_cursor)`, where `next_cursor` is `None` once there is nothing left.
+        """
+        return run_query(self.reader(), owner, prefix, cursor, limit)
+
+    def snapshot(self, owner=None):
+        """
+        - A `SQLiteSnapshot`, for paging through a consistent listing (`owner` is filtered in `query` anyway).
+        """
+        return SQLiteSnapshot(self.connect())
+
+    def put(self, filename, owner, size=None, mtime=None, sha256=None):
+        entry = make_entry(filename, owner, size, mtime, sha256)
+        with self.lock:
+            self.conn.execute(
+                f"INSERT OR REPLACE INTO files ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                (entry["filename"], entry["owner"], entry["name"], entry["size"], entry["mtime"], entry["sha256"]),
+            )
+            self.conn.commit()
+
+    def remove(self, filename):
+        with self.lock:
+            self.conn.execute("DELETE FROM files WHERE filename = ?", (filename,))
+            self.conn.commit()
+
+    def put_many(self, items):
+        """
+        - `put` for every `(filename, owner, size, mtime, sha256)` in `items`, in one transaction.
+        """
+        entries = [make_entry(filename, *rest) for filename, *rest in items]
+        with self.lock:
+            self.conn.executemany(
+                f"INSERT OR REPLACE INTO files ({COLUMNS}) VALUES (?, ?, ?, ?, ?, ?)",
+                [(e["filename"], e["owner"], e["name"], e["size"], e["mtime"], e["sha256"]) for e in entries],
+            )
+            self.conn.commit()
+
+    def remove_many(self, filenames):
+        with self.lock:
+            self.conn.executemany("DELETE FROM files WHERE filename = ?", [(filename,) for filename in filenames])
+            self.conn.commit()
+
+    def close(self):
+        with self.lock:
+            # fold the WAL back into the main database file so it is self-contained on disk
+            for conn in self.readers:
+                conn.close()
+            self.conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            self.conn.close()
+        self.log("<s> Saved metadata.")
+
+
+def run_query(conn, owner, prefix, cursor, limit):
+    """
+    - `query` on the connection `conn`.
+    """
+    conditions = []
+    params = []
+    if owner is not None:
+        conditions.append("owner = ?")
+        params.append(owner)
+        if prefix:
+            # the stored name is `{owner}_{name}`, so the prefix becomes a range on the primary key
+            conditions.append("filename >= ? AND filename < ?")
+            params += [f"{owner}_{prefix}", f"{owner}_{prefix}{PREFIX_END}"]
+    elif prefix:
+        conditions.append("name >= ? AND name < ?")
+        params += [prefix, prefix + PREFIX_END]
+    if cursor is not None:
+        conditions.append("filename > ?")
+        params.append(cursor)
+
+    sql = f"SELECT {COLUMNS} FROM files"
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY filename"
+    if limit is not None:
+        # one extra, to know whether there is another page
+        sql += " LIMIT ?"
+        params.append(limit + 1)
+
+    rows = conn.execute(sql, params).fetchall()
+    has_more = limit is not None and len(rows) > limit
+    entries = [dict(row) for row in rows[:limit]]
+
+    next_cursor = entries[-1]["filename"] if has_more else None
+    return entries, next_cursor
+
+
+class SQLiteSnapshot:
+    """
+    - The catalog as it was when this was created, through a read transaction on its own connection.
+    - Its queries may run on any thread, one at a time.
+    """
+
+    def __init__(self, conn):
+        self.conn = conn
+        self.lock = threading.Lock()
+        self.conn.execute("BEGIN")
+        # the transaction only pins its snapshot with its first read
+        self.conn.execute("SELECT COUNT(*) FROM files WHERE filename = ''").fetchone()
+
+    def query(self, owner=None, prefix=None, cursor=None, limit=None):
+        with self.lock:
+            return run_query(self.conn, owner, prefix, cursor, limit)
+
+    def close(self):
+        with self.lock:
+            self.conn.rollback()
+            self.conn.close()
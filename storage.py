@@ -0,0 +1,121 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# File Storage Backends
+
+## Overview
+Decides where the bytes of an uploaded file end up inside `files_dir`.
+
+- **FlatStorage** (default): every upload is its own file, `files_dir/{owner}_{filename}`, like it has always been.
+- **ContentAddressedStorage** (`--dedup`): the bytes are stored once per distinct content, as
+  `files_dir/.blobs/<first 2 hex digits>/<sha256>`. Per-user names are just metadata entries pointing at a blob,
+  so uploading something that is already stored costs no extra disk.
+
+Either one can also keep the content compressed at rest (`--compress-at-rest`), as a container of compressed chunks
+(see `compression.py`). Content that doesn't compress is stored plain.
+
+## Notes
+- The metadata store counts how many entries reference each hash, a blob is only deleted when the last one goes.
+- Files that were stored flat before `--dedup` was turned on are still found (and deleted) at their old place.
+- Every method here blocks on disk I/O, the server calls them on its I/O pool.
+"""
+
+
+import os
+import tempfile
+
+import compression
+
+
+class FlatStorage:
+    dedup = False
+
+    def __init__(self, files_dir, compress=None):
+        self.files_dir = files_dir
+        # codec files are compressed with at rest, or `None`
+        self.compress = compress
+
+    def flat_path(self, filename):
+        return os.path.join(self.files_dir, filename)
+
+    def file_path(self, filename, entry=None):
+        """
+        - Where the content of the stored file `filename` (with metadata `entry`) can be read from.
+        """
+        return self.flat_path(filename)
+
+    def new_temp_file(self):
+        """
+        - An open temp file inside `files_dir`, so committing it later is a rename on the same disk.
+        """
+        fd, temp_path = tempfile.mkstemp(prefix=".upload_", suffix=".tmp", dir=self.files_dir)
+        return temp_path, os.fdopen(fd, 'wb')
+
+    def pack(self, temp_path):
+        """
+        - Compress a fully received temp file in place, if that is turned on and worth it.
+        """
+        if compression.starts_like_container(temp_path):
+            # stored plain, it would be mistaken for a container when it is read back
+            compression.compress_file(temp_path, self.compress or compression.CODECS[0], force=True)
+        elif self.compress:
+            compression.compress_file(temp_path, self.compress)
+
+    def commit(self, temp_path, filename, sha256):
+        self.pack(temp_path)
+        os.replace(temp_path, self.flat_path(filename))
+
+    def remove_file(self, filename):
+        # raises FileNotFoundError, which the server reports back as "File not found."
+        os.remove(self.flat_path(filename))
+
+    def remove_blob(self, sha256):
+        # nothing is shared between files here
+        pass
+
+
+class ContentAddressedStorage(FlatStorage):
+    dedup = True
+
+    def __init__(self, files_dir, compress=None):
+        super().__init__(files_dir, compress)
+        self.blob_dir = os.path.join(files_dir, ".blobs")
+        os.makedirs(self.blob_dir, exist_ok=True)
+
+    def blob_path(self, sha256):
+        # a level of sub-directories keeps any single directory from getting huge
+        return os.path.join(self.blob_dir, sha256[:2], sha256)
+
+    def file_path(self, filename, entry=None):
+        if entry is not None and entry.get("sha256"):
+            path = self.blob_path(entry["sha256"])
+            if os.path.exists(path):
+                return path
+        # stored before dedup was turned on
+        return self.flat_path(filename)
+
+    def commit(self, temp_path, filename, sha256):
+        path = self.blob_path(sha256)
+        if os.path.exists(path):
+            # identical bytes are already stored, the new entry just references them
+            os.remove(temp_path)
+            return
+        self.pack(temp_path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(temp_path, path)
+
+    def remove_file(self, filename):
+        # the blob itself is only removed once nothing references it anymore (see `remove_blob`)
+        try:
+            os.remove(self.flat_path(filename))
+        except FileNotFoundError:
+            pass
+
+    def remove_blob(self, sha256):
+        try:
+            os.remove(self.blob_path(sha256))
+        except FileNotFoundError:
+            pass
@@ -0,0 +1,576 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Storage Client
+
+## Overview
+Everything the client does, without any GUI: `StorageClient` logs in, negotiates compression (`hello`), switches to
+multiplexed frames (`mux`) and then offers `upload`, `download`, `list_pages`, `delete` and `stats` as plain methods.
+`client.py` (the Tkinter GUI) is just a front end on top of it, and so is the command line below.
+
+A `StorageClient` keeps a few connections open (`sessions`, see `session_pool.py`), and its methods may be called
+from several threads at once: every call is its own request on one of the multiplexed connections (see `mux.py`), big
+files still move over extra connections (see `transfer.py`). A dropped connection is reconnected on its own, and
+idempotent calls (everything but `delete` and `delete_batch`) are simply tried again on the new one.
+
+## Command Line
+```
+python storage_client.py --port 5000 --user alice --sessions 4 upload ./photos --prefix photos/ --jobs 8
+python storage_client.py --port 5000 --user alice download ./restore --prefix photos/ --jobs 8
+python storage_client.py --port 5000 --user alice list
+python storage_client.py --port 5000 --user alice delete notes.txt todo.txt
+```
+- `upload` takes files and whole directory trees. A file's path below the uploaded directory becomes its name, with
+  `/` written as `%2F` (and `%` as `%25`), since names on the server are flat. Unchanged files are skipped by the server.
+- `download` fetches every file of an owner (optionally only names starting with `--prefix`, which is cut off again)
+  and rebuilds the tree. Files that are already there with the same content are skipped, so running it again only
+  fetches what changed.
+- A `--prefix` is encoded like a path in both directions, so the two commands above give back the same tree.
+- Small files are moved in batches (`upload_batch`, `download_batch`), many per request and with one metadata write
+  on the server, big ones one by one. `delete` sends all its names as one batch.
+
+## Notes
+- Failures are reported through the return values (the server's answer) or exceptions, progress goes to `log`.
+- With `on_event`, the server pushes an event whenever one of the user's files is uploaded, downloaded or deleted
+  (see `events.py`). It is called on the connection's reader thread, so it should be quick.
+- A listing that breaks off is picked up again after the last page that arrived, using its `cursor`.
+- `upload` and `download` take an optional `progress(moved, total)`, called from the transferring thread(s) with the
+  bytes moved since the last call. A retry that has to start over reports the bytes it takes back as a negative `moved`.
+"""
+
+
+import argparse
+import hashlib
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote
+
+import compression
+import framing
+import transfer
+from session_pool import CONNECTION_ERRORS, DEFAULT_RETRIES, LoginError, SessionPool
+
+
+# how many files the server sends per page when listing
+LIST_PAGE_SIZE = 1000
+
+DEFAULT_JOBS = 4
+DEFAULT_SESSIONS = 2
+
+# files up to this size go into batches, a batch has at most this many files and bytes
+BATCH_FILE_SIZE = 1024 * 1024
+BATCH_FILES = 500
+BATCH_BYTES = 8 * 1024 * 1024
+
+
+# the hash is computed chunk by chunk, so big files never have to fit in memory
+def file_sha256(path):
+    hasher = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(framing.DEFAULT_READ_SIZE), b""):
+            hasher.update(chunk)
+    return hasher.hexdigest()
+
+
+def tree_name(relative_path):
+    """
+    - The flat name a file at `relative_path` (below an uploaded directory) is stored under.
+    """
+    return relative_path.replace(os.sep, "/").replace("%", "%25").replace("/", "%2F")
+
+
+def tree_path(name):
+    """
+    - Where a file stored as `name` goes below a download directory, or `None` if it would end up outside of it.
+    """
+    parts = unquote(name).split("/")
+    if any(part in ("", ".", "..") or os.sep in part or (os.altsep and os.altsep in part) for part in parts):
+        return None
+    return os.path.join(*parts)
+
+
+class TransferProgress:
+    """
+    - Passes the bytes a transfer moved on to `report(moved, total)` (if any), and takes them back when a retry starts over.
+    - The parts of a parallel transfer report from their own threads, hence the lock.
+    """
+
+    def __init__(self, report, total):
+        self.report = report
+        self.total = total
+        self.moved = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, moved):
+        if self.report is None:
+            return
+        with self.lock:
+            self.moved += moved
+        self.report(moved, self.total)
+
+    def restart(self):
+        with self.lock:
+            moved, self.moved = self.moved, 0
+        if moved:
+            self.report(-moved, self.total)
+
+
+class StorageClient:
+    def __init__(self, host, port, username, codecs=compression.CODECS, on_event=None, log=print,
+                 sessions=1, retries=DEFAULT_RETRIES):
+        self.server_address = (host, port)
+        self.username = username
+        self.log = log
+        self.pool = SessionPool(self.server_address, username, sessions, codecs, on_event, log, retries)
+
+    def close(self):
+        self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def upload(self, path, filename=None, progress=None):
+        """
+        - Upload the file at `path` as `filename` (its own name by default).
+        - Returns the server's final answer: `UPLOAD_SUCCESS`, `UPLOAD_SKIPPED` (it had this exact file already)
+          or `UPLOAD_FAILED`.
+        """
+        filename = filename or os.path.basename(path)
+        size = os.path.getsize(path)
+        sha256 = file_sha256(path)
+
+        # big files are split over several connections, the rest go through the main one
+        if size >= transfer.PARALLEL_THRESHOLD:
+            progress = TransferProgress(progress, size)
+
+            def work(mux):
+                progress.restart()
+                return transfer.parallel_upload(mux, self.server_address, path, filename, size, sha256, progress=progress)
+
+            return self.pool.run(work, primary=True)
+        return self.stream_upload(path, filename, size, sha256, progress)
+
+    def stream_upload(self, path, filename, size, sha256, progress=None):
+        """
+        - Only the name, size and hash go into the header frame,
+          the content itself is streamed right after it (if the server needs it at all).
+        """
+        command = {"type": "upload_stream", "filename": filename, "size": size, "sha256": sha256}
+        progress = TransferProgress(progress, size)
+
+        def work(mux):
+            progress.restart()
+            with mux.request(command) as request:
+                response = request.recv()
+                if response.get("status") != "READY":
+                    return response
+
+                with open(path, 'rb') as f:
+                    request.send_file(f, size, progress)
+                return request.recv()
+
+        return self.pool.run(work)
+
+    def upload_batch(self, items):
+        """
+        - Upload many small files in one request, `items` are `(path, filename)`.
+        - Returns the server's answer for each file (`{"status": ...}` like `upload`), in the same order.
+        """
+        files = [{"filename": name, "size": os.path.getsize(path), "sha256": file_sha256(path)} for path, name in items]
+
+        def work(mux):
+            with mux.request({"type": "upload_batch", "files": files}) as request:
+                response = request.recv()
+                if response.get("status") != "READY":
+                    return [response] * len(items)
+
+                for (path, _), info, status in zip(items, files, response["files"]):
+                    if status == "READY":
+                        with open(path, 'rb') as f:
+                            request.send_file(f, info["size"])
+                return batch_results(request.recv(), len(items))
+
+        return self.pool.run(work)
+
+    def delete_batch(self, filenames):
+        """
+        - Delete many files in one request, returns the server's answer for each.
+        - Not retried: if the connection broke after the server was done, a second try would report them as missing.
+        """
+        return batch_results(self.pool.session().call({"type": "delete_batch", "files": list(filenames)}), len(filenames))
+
+    def download_batch(self, items):
+        """
+        - Download many small files in one request, `items` are `(filename, owner, save_path)`.
+        - Returns the server's answer for each file. One with `code: TOO_BIG` has to be fetched with `download`.
+        """
+        command = {"type": "download_batch", "files": [{"filename": name, "owner": owner} for name, owner, _ in items]}
+
+        def work(mux):
+            with mux.request(command) as request:
+                results = batch_results(request.recv(), len(items))
+                for (_, _, save_path), result in zip(items, results):
+                    if result["status"] != "SUCCESS":
+                        continue
+                    part_path = save_path + ".part"
+                    with open(part_path, 'wb') as f:
+                        request.recv_to_file(result["size"], f)
+                    os.replace(part_path, save_path)
+            return results
+
+        return self.pool.run(work)
+
+    def list_pages(self, owner=None, prefix=None, page_size=LIST_PAGE_SIZE):
+        """
+        - Yield the file list page by page (lists of `{filename, owner, name, size, mtime, sha256}`),
+          each one as soon as it arrives.
+        - If the connection breaks, the listing goes on from the last page on a new one (`retries` times in a row at most).
+        """
+        command = {"type": "list", "page_size": page_size}
+        if owner is not None:
+            command["owner"] = owner
+        if prefix:
+            command["prefix"] = prefix
+
+        attempt = 0
+        while True:
+            mux = self.pool.session()
+            try:
+                with mux.request(command) as request:
+                    while True:
+                        page = request.recv()
+                        if not isinstance(page, dict) or page.get("status") != "PAGE":
+                            raise ValueError("Server response is not a valid file list page.")
+                        yield page["files"]
+                        if page["last"]:
+                            return
+                        command["cursor"] = page["cursor"]
+                        attempt = 0
+            except CONNECTION_ERRORS as e:
+                if attempt >= self.pool.retries or self.pool.closed:
+                    raise
+                attempt += 1
+                self.pool.discard(mux)
+                self.log(f"<e> Connection lost while listing ({e}), going on from the last page...")
+
+    def list_files(self, owner=None, prefix=None):
+        return [entry for page in self.list_pages(owner, prefix) for entry in page]
+
+    def delete(self, filename):
+        """
+        - Returns the server's answer, `DELETE_SUCCESS` or `ERROR`. Not retried, like `delete_batch`.
+        """
+        return self.pool.session().call({"type": "delete", "filename": filename})
+
+    def stats(self):
+        return self.pool.run(lambda mux: mux.call({"type": "stats"}))
+
+    def download(self, filename, owner, save_path, progress=None):
+        """
+        - Big files are fetched in parallel ranges over extra connections.
+        - Everything else (and any download that was interrupted before) goes through `resume_download`.
+        - Returns `False` (after logging why) if the server refused.
+        """
+        if not os.path.exists(save_path + ".part"):
+            response = self.pool.run(lambda mux: transfer.probe_download(mux, owner, filename))
+            if response["status"] != "SUCCESS":
+                self.log(f"<e> Error in file download's status code:\n\t{response['message']}")
+                return False
+
+            if response["total_size"] >= transfer.PARALLEL_THRESHOLD:
+                progress = TransferProgress(progress, response["total_size"])
+
+                def work(mux):
+                    progress.restart()
+                    transfer.parallel_download(
+                        mux, self.server_address, owner, filename, save_path,
+                        response["total_size"], response["etag"], progress=progress,
+                    )
+
+                self.pool.run(work, primary=True)
+                return True
+
+        return self.resume_download(filename, owner, save_path, progress)
+
+    def resume_download(self, filename, owner, save_path, progress=None):
+        """
+        - Bytes go into `<save_path>.part`, which is renamed to `save_path` once complete.
+        - If the connection drops, the part file stays, together with the server's `etag` for it in `<save_path>.part.etag`.
+        - The next attempt only asks for the missing range, and starts over if the file changed on the server meanwhile.
+          That is also how a retry on a new connection (see `session_pool.py`) goes on where the old one stopped.
+        """
+        part_path = save_path + ".part"
+        etag_path = part_path + ".etag"
+        # the total is what is still missing when the first answer arrives, a retry goes on from there
+        tracker = None
+
+        def work(mux):
+            nonlocal tracker
+            offset, etag = 0, None
+            if os.path.exists(part_path) and os.path.exists(etag_path):
+                offset = os.path.getsize(part_path)
+                with open(etag_path) as f:
+                    etag = f.read().strip()
+
+            command = {"type": "download_stream", "filename": filename, "owner": owner}
+            if etag:
+                command.update({"offset": offset, "if_match": etag})
+            with mux.request(command) as request:
+                response = request.recv()
+                if response["status"] == "SUCCESS":
+                    if tracker is None:
+                        tracker = TransferProgress(progress, response["size"])
+                    self.receive_part(request, response, part_path, etag_path, tracker)
+            return response
+
+        response = self.pool.run(work)
+
+        if response.get("code") == "CHANGED":
+            # what we have belongs to an older version of the file
+            self.log("<e> File changed on the server since the interrupted download, starting over...")
+            os.remove(part_path)
+            os.remove(etag_path)
+            if tracker is not None:
+                tracker.restart()
+            return self.resume_download(filename, owner, save_path, progress)
+
+        if response["status"] != "SUCCESS":
+            self.log(f"<e> Error in file download's status code:\n\t{response['message']}")
+            return False
+
+        os.replace(part_path, save_path)
+        os.remove(etag_path)
+        return True
+
+    def receive_part(self, request, response, part_path, etag_path, progress=None):
+        with open(etag_path, 'w') as f:
+            f.write(response["etag"])
+        if response["offset"]:
+            self.log(f"Resuming download at {response['offset']} of {response['total_size']} bytes...")
+
+        with open(part_path, 'ab' if response["offset"] else 'wb') as f:
+            request.recv_to_file(response["size"], f, progress)
+
+
+def batch_results(response, count):
+    """
+    - The per-file answers of a batch request, or the answer to the whole request once for every file.
+    """
+    if response.get("status") == "SUCCESS":
+        return response["files"]
+    return [response] * count
+
+
+# whole directory trees
+
+def collect_uploads(paths, prefix=""):
+    """
+    - `(local path, name)` of every file in `paths`, directories are walked and their files named after their path.
+    """
+    uploads = []
+    for path in paths:
+        if os.path.isdir(path):
+            for directory, _, files in os.walk(path):
+                for file in sorted(files):
+                    local = os.path.join(directory, file)
+                    uploads.append((local, prefix + tree_name(os.path.relpath(local, path))))
+        else:
+            uploads.append((path, prefix + tree_name(os.path.basename(path))))
+    return uploads
+
+
+def is_unchanged(path, entry):
+    return (
+        os.path.isfile(path) and os.path.getsize(path) == entry["size"]
+        and entry["sha256"] is not None and file_sha256(path) == entry["sha256"]
+    )
+
+
+def make_batches(items, size_of):
+    """
+    - Group small `items` into batches (lists), every big one is a batch of its own.
+    """
+    batches, batch, batch_bytes = [], [], 0
+    for item in items:
+        size = size_of(item)
+        if size > BATCH_FILE_SIZE:
+            batches.append([item])
+            continue
+        if batch and (len(batch) >= BATCH_FILES or batch_bytes + size > BATCH_BYTES):
+            batches.append(batch)
+            batch, batch_bytes = [], 0
+        batch.append(item)
+        batch_bytes += size
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def run_jobs(jobs, work, count):
+    """
+    - Run `work(job)` for every job on `count` threads, each returns a list of results.
+    - Returns how many of each result there were.
+    """
+    results = {}
+    with ThreadPoolExecutor(max_workers=count) as pool:
+        for job_results in pool.map(work, jobs):
+            for result in job_results:
+                results[result] = results.get(result, 0) + 1
+    return results
+
+
+def upload_tree(client, paths, prefix="", jobs=DEFAULT_JOBS):
+    prefix = tree_name(prefix)
+
+    def work(batch):
+        try:
+            if len(batch) == 1:
+                responses = [client.upload(*batch[0])]
+            else:
+                responses = client.upload_batch(batch)
+        except Exception as e:
+            for _, name in batch:
+                client.log(f"<e> {name}: {e}")
+            return ["failed"] * len(batch)
+
+        results = []
+        for (_, name), response in zip(batch, responses):
+            status = response.get("status")
+            if status == "UPLOAD_SUCCESS":
+                client.log(f"<s> Uploaded {name}")
+                results.append("uploaded")
+            elif status == "UPLOAD_SKIPPED":
+                results.append("unchanged")
+            else:
+                client.log(f"<e> Server could not store {name}")
+                results.append("failed")
+        return results
+
+    uploads = collect_uploads(paths, prefix)
+    return run_jobs(make_batches(uploads, lambda job: os.path.getsize(job[0])), work, jobs)
+
+
+def download_tree(client, destination, owner, prefix=None, jobs=DEFAULT_JOBS):
+    prefix = tree_name(prefix or "")
+
+    def work(batch):
+        results, wanted = [], []
+        for entry in batch:
+            path = tree_path(entry["name"][len(prefix):])
+            if path is None:
+                client.log(f"<e> {entry['name']}: not a safe path, skipped")
+                results.append("failed")
+                continue
+            path = os.path.join(destination, path)
+            try:
+                if is_unchanged(path, entry):
+                    results.append("unchanged")
+                    continue
+                os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            except OSError as e:
+                client.log(f"<e> {entry['name']}: {e}")
+                results.append("failed")
+                continue
+            wanted.append((entry["name"], owner, path))
+
+        try:
+            # a lone file isn't worth a batch
+            responses = client.download_batch(wanted) if len(wanted) > 1 else [None] * len(wanted)
+        except Exception as e:
+            for name, _, _ in wanted:
+                client.log(f"<e> {name}: {e}")
+            return results + ["failed"] * len(wanted)
+
+        for (name, _, path), response in zip(wanted, responses):
+            try:
+                if response is None or response.get("code") == "TOO_BIG":
+                    ok = client.download(name, owner, path)
+                else:
+                    ok = response["status"] == "SUCCESS"
+                    if not ok:
+                        client.log(f"<e> {name}: {response.get('message')}")
+            except Exception as e:
+                client.log(f"<e> {name}: {e}")
+                ok = False
+            if ok:
+                client.log(f"<s> Downloaded {name}")
+            results.append("downloaded" if ok else "failed")
+        return results
+
+    entries = client.list_files(owner, prefix or None)
+    return run_jobs(make_batches(entries, lambda entry: entry["size"]), work, jobs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Command line client for Cloud File SUtorage.")
+    parser.add_argument("--host", default="127.0.0.1", help="server address (default: 127.0.0.1)")
+    parser.add_argument("--port", type=int, required=True, help="server port")
+    parser.add_argument("--user", required=True, help="username to connect as")
+    parser.add_argument("--jobs", type=int, default=DEFAULT_JOBS, help="files transferred at once")
+    parser.add_argument("--sessions", type=int, default=DEFAULT_SESSIONS, help="connections to the server")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    upload = commands.add_parser("upload", help="upload files and directory trees")
+    upload.add_argument("paths", nargs="+")
+    upload.add_argument("--prefix", default="", help="put this in front of every name")
+
+    download = commands.add_parser("download", help="download every file (of an owner) into a directory tree")
+    download.add_argument("destination")
+    download.add_argument("--owner", default=None, help="whose files (default: your own)")
+    download.add_argument("--prefix", default=None, help="only names starting with this")
+
+    listing = commands.add_parser("list", help="list the files on the server")
+    listing.add_argument("--owner", default=None)
+    listing.add_argument("--prefix", default=None)
+
+    delete = commands.add_parser("delete", help="delete some of your files")
+    delete.add_argument("names", nargs="+")
+
+    commands.add_parser("stats", help="the server's metrics (only from the server's own machine)")
+    args = parser.parse_args()
+
+    try:
+        client = StorageClient(args.host, args.port, args.user, sessions=args.sessions)
+    except (OSError, LoginError) as e:
+        sys.exit(f"<e> Could not connect: {e}")
+
+    start = time.perf_counter()
+    with client:
+        if args.command == "upload":
+            results = upload_tree(client, args.paths, args.prefix, args.jobs)
+        elif args.command == "download":
+            results = download_tree(client, args.destination, args.owner or args.user, args.prefix, args.jobs)
+        elif args.command == "list":
+            for page in client.list_pages(args.owner, args.prefix):
+                for entry in page:
+                    print(f"{entry['owner']}\t{entry['size']}\t{entry['name']}")
+            return
+        elif args.command == "delete":
+            results = {}
+            for name, response in zip(args.names, client.delete_batch(args.names)):
+                result = "deleted" if response.get("status") == "DELETE_SUCCESS" else "failed"
+                if result == "failed":
+                    print(f"<e> {name}: {response.get('message', 'could not delete')}")
+                results[result] = results.get(result, 0) + 1
+        else:
+            response = client.stats()
+            print(response.get("text") or response.get("message"))
+            return
+
+    summary = ", ".join(f"{count} {result}" for result, count in sorted(results.items())) or "nothing to do"
+    print(f"Done in {time.perf_counter() - start:.1f}s: {summary}")
+    if results.get("failed"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
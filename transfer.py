@@ -0,0 +1,200 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Parallel Transfers
+
+## Overview
+On high-latency links one TCP connection can't fill the pipe, so big files are moved over several connections at once.
+
+The client asks the server for a session token on its normal (control) connection, then opens a few extra data
+connections that log in with that token instead of a username. The file is split into fixed-size parts, and every
+data connection keeps taking the next part until none are left.
+
+- **Upload**: `upload_begin` (control) -> `upload_part` for every part (data connections) -> `upload_commit` (control).
+  The server writes each part at its offset into one temp file and checks the whole thing against the hash at the end.
+- **Download**: every part is just a ranged `download_stream`, pinned to the same version of the file with `if_match`.
+
+## Notes
+- There is no GUI code in here, `client.py` calls these functions with its already connected `MuxClient` (`mux.py`),
+  so the control requests of a transfer can run next to other requests on the same connection.
+- Parts are written to/read from the file at their own offset, so they can finish in any order.
+- `progress(n)` (optional) is called with the size of every part once it is done, from the part's own thread.
+"""
+
+
+import os
+import queue
+import socket
+import threading
+
+import framing
+
+
+# a data connection sends this (plus the session token) instead of a username
+ATTACH_PREFIX = b"\x00ATTACH "
+
+# files at least this big are moved in parallel
+PARALLEL_THRESHOLD = 64 * 1024 * 1024
+
+# how much one connection moves per request
+PART_SIZE = 8 * 1024 * 1024
+
+# extra data connections per transfer
+DEFAULT_CONNECTIONS = 4
+
+
+def open_data_connections(control, server_address, count):
+    """
+    - Get a session token over the control connection and log `count` new connections in with it.
+    """
+    response = control.call({"type": "open_session"})
+    if response.get("status") != "SUCCESS":
+        raise ConnectionError(response.get("message", "Could not open a session."))
+
+    socks = []
+    try:
+        for _ in range(count):
+            sock = socket.create_connection(server_address)
+            socks.append(sock)
+            framing.set_keepalive(sock)
+            sock.sendall(ATTACH_PREFIX + response["token"].encode())
+            reply = sock.recv(1024)
+            if reply != b"CONNECTED":
+                raise ConnectionError(reply.decode() or "Server closed the data connection.")
+    except BaseException:
+        close_all(socks)
+        raise
+    return socks
+
+
+def close_all(socks):
+    for sock in socks:
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+
+def split_parts(size, part_size=PART_SIZE):
+    return [(offset, min(part_size, size - offset)) for offset in range(0, size, part_size)]
+
+
+def run_parallel(socks, parts, work):
+    """
+    - Every socket gets its own thread, which keeps calling `work(sock, offset, length)` for the next part.
+    - Stops handing out parts after the first error, and re-raises it once all threads are done.
+    """
+    jobs = queue.SimpleQueue()
+    for part in parts:
+        jobs.put(part)
+    errors = []
+
+    def worker(sock):
+        while not errors:
+            try:
+                offset, length = jobs.get_nowait()
+            except queue.Empty:
+                return
+            try:
+                work(sock, offset, length)
+            except Exception as e:
+                errors.append(e)
+                return
+
+    threads = [threading.Thread(target=worker, args=(sock,), daemon=True) for sock in socks]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if errors:
+        raise errors[0]
+
+
+def parallel_upload(control, server_address, path, filename, size, sha256,
+                    connections=DEFAULT_CONNECTIONS, part_size=PART_SIZE, progress=None):
+    """
+    - Upload the file at `path` as `filename`, split over `connections` extra connections.
+    - Returns the server's final answer (`UPLOAD_SUCCESS`, `UPLOAD_SKIPPED` or `UPLOAD_FAILED`).
+    """
+    response = control.call({"type": "upload_begin", "filename": filename, "size": size, "sha256": sha256})
+    if response.get("status") != "READY":
+        return response
+
+    upload_id = response["upload_id"]
+
+    def send_part(sock, offset, length):
+        framing.send_frame(sock, {"type": "upload_part", "upload_id": upload_id, "offset": offset, "size": length})
+        with open(path, 'rb') as f:
+            f.seek(offset)
+            framing.send_from_file(sock, f, length)
+        reply = framing.recv_frame(sock)
+        if not reply or reply.get("status") != "PART_OK":
+            raise IOError(reply.get("message", "Part was rejected.") if reply else "Server closed the data connection.")
+        if progress is not None:
+            progress(length)
+
+    error = None
+    socks = open_data_connections(control, server_address, min(connections, len(split_parts(size, part_size))))
+    try:
+        run_parallel(socks, split_parts(size, part_size), send_part)
+    except Exception as e:
+        # still commit, so the server notices the missing parts and throws the temp file away
+        error = e
+    finally:
+        close_all(socks)
+
+    response = control.call({"type": "upload_commit", "upload_id": upload_id})
+    if error is not None:
+        raise error
+    return response
+
+
+def parallel_download(control, server_address, owner, filename, save_path, total_size, etag,
+                      connections=DEFAULT_CONNECTIONS, part_size=PART_SIZE, progress=None):
+    """
+    - Download a file of `total_size` bytes (version `etag`) into `save_path`, split over `connections` extra connections.
+    - The parts land in `<save_path>.part`, which is renamed once all of them are in.
+    """
+    part_path = save_path + ".part"
+    with open(part_path, 'wb') as f:
+        f.truncate(total_size)
+
+    def fetch_part(sock, offset, length):
+        framing.send_frame(sock, {
+            "type": "download_stream", "filename": filename, "owner": owner,
+            "offset": offset, "length": length, "if_match": etag,
+        })
+        response = framing.recv_frame(sock)
+        if not response or response.get("status") != "SUCCESS":
+            raise IOError(response.get("message", "Part was refused.") if response else "Server closed the data connection.")
+        with open(part_path, 'r+b') as f:
+            f.seek(offset)
+            framing.recv_to_file(sock, response["size"], f)
+        if progress is not None:
+            progress(length)
+
+    parts = split_parts(total_size, part_size)
+    try:
+        socks = open_data_connections(control, server_address, min(connections, len(parts)))
+        try:
+            run_parallel(socks, parts, fetch_part)
+        finally:
+            close_all(socks)
+    except BaseException:
+        os.remove(part_path)
+        raise
+
+    os.replace(part_path, save_path)
+
+
+def probe_download(control, owner, filename):
+    """
+    - Ask for an empty range, just to learn the file's `total_size` and `etag`.
+    """
+    return control.call({
+        "type": "download_stream", "filename": filename, "owner": owner, "offset": 0, "length": 0,
+    })
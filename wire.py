@@ -0,0 +1,244 @@
+"""
+
+# CS 408 Project: Cloud File SUtorage
+
+---
+
+# Message Encoding
+
+## Overview
+How a message (a `dict`, or the `list` an old-style `list` command answers with) is turned into bytes and back.
+`framing.py` uses this for every frame, so client and server share it.
+
+Unpickling whatever arrives from the network lets the sender run code on the receiver, and pickling a
+multi-megabyte `content` copies it into the pickle first. This format only knows plain data, and raw bytes stay raw.
+
+## Layout
+- A fixed header, `MESSAGE_HEADER`: format version, message type, flags, body length and payload length.
+- The message type is the command's `type` as a one-byte id from `MESSAGE_TYPES` (0 for answers), so it is not in the body.
+- The body is one tagged value. Dictionary keys listed in `FIELDS` take one byte, any other key is sent as a string.
+- With `FLAG_PAYLOAD`, the top-level `content` bytes are not in the body at all: they follow it as they are,
+  and are never copied into an encoding buffer. On the receiving end `content` is a `memoryview` of the frame.
+
+## Notes
+- Only `None`, `bool`, `int` (64 bit), `float`, `str`, `bytes`, `list`/`tuple` and `dict` can be encoded.
+- `MESSAGE_TYPES` and `FIELDS` are part of the format: new names may only be appended, ids never change meaning.
+- A message with a different `VERSION` is refused instead of being guessed at.
+"""
+
+
+import struct
+
+
+VERSION = 1
+
+# version, message type, flags, body length, payload length
+MESSAGE_HEADER = struct.Struct("!BBBII")
+
+# the top-level `content` follows the body as raw bytes
+FLAG_PAYLOAD = 1
+
+# index = id in the header, 0 is a message without a (known) type
+MESSAGE_TYPES = (
+    "", "upload", "upload_stream", "list", "delete", "download", "download_stream",
+    "open_session", "upload_begin", "upload_part", "upload_commit", "mux", "hello", "stats",
+    "upload_batch", "delete_batch", "download_batch", "subscribe",
+)
+
+# index + 1 = id of the key, 0 means the key itself follows as a string
+FIELDS = (
+    "type", "status", "message", "code", "filename", "owner", "name", "size", "mtime", "sha256", "content",
+    "files", "cursor", "limit", "prefix", "page_size", "last", "offset", "length", "if_match", "etag",
+    "total_size", "token", "upload_id", "codecs", "codec", "stats", "text",
+    "event", "by", "count", "dropped", "time",
+)
+
+TYPE_IDS = {name: i for i, name in enumerate(MESSAGE_TYPES) if name}
+FIELD_IDS = {name: bytes([i + 1]) for i, name in enumerate(FIELDS)}
+
+# value tags
+T_NONE, T_TRUE, T_FALSE, T_INT, T_FLOAT, T_STR, T_BYTES, T_LIST, T_DICT = range(9)
+
+TAGGED_INT = struct.Struct("!Bq")
+TAGGED_FLOAT = struct.Struct("!Bd")
+TAGGED_LENGTH = struct.Struct("!BI")
+KEY_LENGTH = struct.Struct("!BH")
+INT = struct.Struct("!q")
+FLOAT = struct.Struct("!d")
+LENGTH = struct.Struct("!I")
+SHORT = struct.Struct("!H")
+
+NONE = bytes([T_NONE])
+TRUE = bytes([T_TRUE])
+FALSE = bytes([T_FALSE])
+
+
+class DecodeError(ValueError):
+    pass
+
+
+def encode(data):
+    """
+    - Encode one message, returned as a list of buffers to be sent one after the other.
+    - The second buffer (if any) is the message's own `content` object, not a copy of it.
+    """
+    type_id = 0
+    flags = 0
+    payload = None
+    skip = ()
+
+    if type(data) is dict:
+        command_type = data.get("type")
+        # any other `type` (even a list) is just a value in the body
+        type_id = TYPE_IDS.get(command_type, 0) if type(command_type) is str else 0
+        content = data.get("content")
+        if isinstance(content, (bytes, bytearray, memoryview)):
+            flags |= FLAG_PAYLOAD
+            payload = content
+        if type_id or payload is not None:
+            skip = ("type" if type_id else None, "content" if payload is not None else None)
+
+    body = bytearray()
+    if skip:
+        encode_dict(body, data, skip)
+    else:
+        encode_value(body, data)
+
+    header = MESSAGE_HEADER.pack(VERSION, type_id, flags, len(body), len(payload) if payload is not None else 0)
+    if payload is None:
+        return [header + body]
+    return [header + body, payload]
+
+
+def encode_dict(out, data, skip=()):
+    items = [(k, v) for k, v in data.items() if k not in skip] if skip else data.items()
+    out += TAGGED_LENGTH.pack(T_DICT, len(items))
+    for key, value in items:
+        key_id = FIELD_IDS.get(key)
+        if key_id is not None:
+            out += key_id
+        elif type(key) is str:
+            raw = key.encode()
+            out += KEY_LENGTH.pack(0, len(raw))
+            out += raw
+        else:
+            raise TypeError(f"Message keys must be strings, not {type(key).__name__}.")
+        encode_value(out, value)
+
+
+def encode_value(out, value):
+    kind = type(value)
+    if kind is str:
+        raw = value.encode()
+        out += TAGGED_LENGTH.pack(T_STR, len(raw))
+        out += raw
+    elif kind is int:
+        out += TAGGED_INT.pack(T_INT, value)
+    elif kind is dict:
+        encode_dict(out, value)
+    elif value is None:
+        out += NONE
+    elif kind is bool:
+        out += TRUE if value else FALSE
+    elif kind is float:
+        out += TAGGED_FLOAT.pack(T_FLOAT, value)
+    elif kind is list or kind is tuple:
+        out += TAGGED_LENGTH.pack(T_LIST, len(value))
+        for item in value:
+            encode_value(out, item)
+    elif kind is bytes or kind is bytearray or kind is memoryview:
+        out += TAGGED_LENGTH.pack(T_BYTES, len(value))
+        out += value
+    else:
+        raise TypeError(f"Can't encode a {kind.__name__} in a message.")
+
+
+def decode(buffer):
+    """
+    - Decode one whole message from `buffer` (`bytes` or `bytearray`).
+    """
+    if len(buffer) < MESSAGE_HEADER.size:
+        raise DecodeError("Message is shorter than its header.")
+    version, type_id, flags, body_length, payload_length = MESSAGE_HEADER.unpack_from(buffer)
+    if version != VERSION:
+        raise DecodeError(f"Unsupported message version {version}, expected {VERSION}.")
+    if flags & ~FLAG_PAYLOAD:
+        raise DecodeError(f"Unsupported message flags {flags}.")
+
+    start = MESSAGE_HEADER.size
+    end = start + body_length
+    if end + payload_length != len(buffer):
+        raise DecodeError("Message length does not match its header.")
+
+    try:
+        value, pos = decode_value(buffer, start)
+    except (IndexError, struct.error, UnicodeDecodeError, RecursionError) as e:
+        raise DecodeError(f"Malformed message: {e}") from None
+    if pos != end:
+        raise DecodeError("Message body has trailing bytes.")
+
+    if type_id or flags & FLAG_PAYLOAD:
+        if type(value) is not dict:
+            raise DecodeError("Only a dictionary can have a type or a payload.")
+        if type_id:
+            if type_id >= len(MESSAGE_TYPES):
+                raise DecodeError(f"Unknown message type {type_id}.")
+            value["type"] = MESSAGE_TYPES[type_id]
+        if flags & FLAG_PAYLOAD:
+            # no copy, the frame's buffer belongs to this message alone
+            value["content"] = memoryview(buffer)[end:]
+    return value
+
+
+def decode_value(buffer, pos):
+    tag = buffer[pos]
+    pos += 1
+    if tag == T_STR:
+        (length,) = LENGTH.unpack_from(buffer, pos)
+        pos += 4
+        end = pos + length
+        if end > len(buffer):
+            raise IndexError("string runs past the end")
+        return str(buffer[pos:end], "utf-8"), end
+    if tag == T_INT:
+        return INT.unpack_from(buffer, pos)[0], pos + 8
+    if tag == T_DICT:
+        (count,) = LENGTH.unpack_from(buffer, pos)
+        pos += 4
+        result = {}
+        for _ in range(count):
+            key_id = buffer[pos]
+            pos += 1
+            if key_id:
+                key = FIELDS[key_id - 1]
+            else:
+                (length,) = SHORT.unpack_from(buffer, pos)
+                pos += 2
+                key = str(buffer[pos:pos + length], "utf-8")
+                pos += length
+            result[key], pos = decode_value(buffer, pos)
+        return result, pos
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_FLOAT:
+        return FLOAT.unpack_from(buffer, pos)[0], pos + 8
+    if tag == T_LIST:
+        (count,) = LENGTH.unpack_from(buffer, pos)
+        pos += 4
+        result = []
+        for _ in range(count):
+            item, pos = decode_value(buffer, pos)
+            result.append(item)
+        return result, pos
+    if tag == T_BYTES:
+        (length,) = LENGTH.unpack_from(buffer, pos)
+        pos += 4
+        end = pos + length
+        if end > len(buffer):
+            raise IndexError("bytes run past the end")
+        return bytes(buffer[pos:end]), end
+    raise DecodeError(f"Unknown value tag {tag}.")